@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from accounts import revocation
+import time
+
+
+class Command(BaseCommand):
+    help = 'Delete expired refresh tokens from the outstanding and blacklisted token tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report how many would be removed')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--pause', type=float, default=0, help='Seconds to wait between batches')
+        parser.add_argument('--every', type=int, default=0,
+                            help='Keep running and prune every this many seconds')
+
+    def handle(self, *args, **options):
+        while True:
+            removed = revocation.prune_expired(
+                batch_size=options['batch_size'], pause=options['pause'], dry_run=options['dry_run']
+            )
+            verb = 'Would remove' if options['dry_run'] else 'Removed'
+            self.stdout.write(self.style.SUCCESS(f"{verb} {removed} expired tokens"))
+            if not options['every']:
+                return
+            time.sleep(options['every'])
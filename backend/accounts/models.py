@@ -36,8 +36,18 @@ class User(AbstractUser):
     email = models.EmailField(unique=True)
     role = models.CharField(max_length=10, choices=ROLE_CHOICES, default='GUEST')
     totp_secret = models.CharField(max_length=32, null=True, blank=True)
+    # Bytes of uploaded files, maintained incrementally by filemanager
+    storage_used = models.BigIntegerField(default=0)
+    # Per-user override of settings.STORAGE_QUOTAS; null uses the role default
+    storage_quota = models.BigIntegerField(null=True, blank=True)
 
     objects = UserManager()
 
     USERNAME_FIELD = 'email'
-    REQUIRED_FIELDS = []
\ No newline at end of file
+    REQUIRED_FIELDS = []
+
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            # User management lists users by email within a role
+            models.Index(fields=['role', 'email'], name='user_role_email_idx'),
+        ]
\ No newline at end of file
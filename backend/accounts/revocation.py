@@ -0,0 +1,157 @@
+"""Revoked refresh tokens: a Bloom filter in front of the blacklist, and pruning.
+
+Every refresh blacklists the token it rotates away and checks the incoming
+one against BlacklistedToken. Nearly all incoming tokens are not revoked, so
+each process keeps a Bloom filter of the revoked jtis that are still
+unexpired. The table is only queried when the filter says "maybe".
+
+Other processes learn about new revocations through the shared cache. Each
+one increments a generation counter and stores its jti under the new
+generation. Before answering, a process reads the counter and adds the jtis
+it hasn't seen yet. It rebuilds the filter from the table when it falls too
+far behind, when an entry has expired from the cache, when the filter is
+full, or every REVOCATION_FILTER_MAX_AGE seconds. The rebuild also drops
+expired tokens.
+
+The counter read is a cache round trip, so the filter only saves anything
+when the cache is not the database. It is on by default only with Redis
+(REVOCATION_FILTER).
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+from rest_framework_simplejwt.tokens import RefreshToken
+import hashlib
+import math
+import threading
+import time
+from core.cache import incr_with_ttl
+
+GENERATION_KEY = 'revoked_tokens:generation'
+
+
+def _entry_key(generation):
+    return f'revoked_tokens:{generation}'
+
+
+class BloomFilter:
+    """Set membership with no false negatives and about error_rate false positives up to capacity"""
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = max(capacity, 1024)
+        self.size = math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        # Double hashing: k positions from two 64-bit halves of one digest
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    @property
+    def full(self):
+        return self.count > self.capacity
+
+
+def revoked_jtis():
+    """The jtis of blacklisted tokens that haven't expired"""
+    return BlacklistedToken.objects.filter(token__expires_at__gt=timezone.now()).values_list('token__jti', flat=True)
+
+
+class RevocationFilter:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.bloom = None
+        self.generation = 0
+        self.built_at = 0
+
+    def _rebuild(self, generation):
+        jtis = list(revoked_jtis())
+        bloom = BloomFilter(len(jtis) * 2)
+        for jti in jtis:
+            bloom.add(jti)
+        self.bloom, self.generation, self.built_at = bloom, generation, time.monotonic()
+
+    def _catch_up(self, generation):
+        """Add the jtis revoked since our generation; False if they are no longer all in the cache"""
+        behind = range(self.generation + 1, generation + 1)
+        if len(behind) > getattr(settings, 'REVOCATION_FILTER_CATCH_UP', 1000):
+            return False
+        entries = cache.get_many([_entry_key(number) for number in behind])
+        if len(entries) < len(behind):
+            return False
+        for jti in entries.values():
+            self.bloom.add(jti)
+        self.generation = generation
+        return not self.bloom.full
+
+    def might_be_revoked(self, jti):
+        # Read before rebuilding, so revocations committed during the rebuild are caught up next time
+        generation = cache.get(GENERATION_KEY, 0)
+        with self.lock:
+            max_age = getattr(settings, 'REVOCATION_FILTER_MAX_AGE', 3600)
+            if (
+                self.bloom is None
+                or generation < self.generation
+                or time.monotonic() - self.built_at > max_age
+                or (generation > self.generation and not self._catch_up(generation))
+            ):
+                self._rebuild(generation)
+            return jti in self.bloom
+
+
+revocations = RevocationFilter()
+
+
+def _publish(jti):
+    generation = incr_with_ttl(GENERATION_KEY, None)
+    lifetime = settings.SIMPLE_JWT.get('REFRESH_TOKEN_LIFETIME')
+    cache.set(_entry_key(generation), jti, int(lifetime.total_seconds()) if lifetime else None)
+
+
+def token_revoked(jti):
+    """Tell every process's filter about jti once the blacklisting commits"""
+    if getattr(settings, 'REVOCATION_FILTER', False):
+        transaction.on_commit(lambda: _publish(jti))
+
+
+class FilteredRefreshToken(RefreshToken):
+    """RefreshToken that asks the revocation filter before querying the blacklist"""
+
+    def check_blacklist(self):
+        if getattr(settings, 'REVOCATION_FILTER', False):
+            if not revocations.might_be_revoked(self.payload[api_settings.JTI_CLAIM]):
+                return
+        super().check_blacklist()
+
+
+def prune_expired(batch_size=1000, pause=0, dry_run=False):
+    """Delete expired outstanding tokens and their blacklist rows; returns the number removed.
+
+    Each batch is its own short delete, so refreshes aren't held up behind
+    one long one; pause (seconds) spaces them out further.
+    """
+    expired = OutstandingToken.objects.filter(expires_at__lte=timezone.now())
+    if dry_run:
+        return expired.count()
+    removed = 0
+    while ids := list(expired.order_by('pk').values_list('pk', flat=True)[:batch_size]):
+        # The blacklist rows go in the same transaction, by the cascade
+        removed += OutstandingToken.objects.filter(pk__in=ids).delete()[1].get(OutstandingToken._meta.label, 0)
+        if pause:
+            time.sleep(pause)
+    return removed
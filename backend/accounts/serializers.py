@@ -1,4 +1,6 @@
 from rest_framework import serializers
+from rest_framework_simplejwt.serializers import TokenRefreshSerializer
+from .revocation import FilteredRefreshToken
 from .models import User
 from django.utils.html import escape
 
@@ -32,4 +34,7 @@ class TOTPVerifySerializer(serializers.Serializer):
 class LoginWithMFASerializer(serializers.Serializer):
     email = serializers.EmailField()
     password = serializers.CharField()
-    totp_code = serializers.CharField(min_length=6, max_length=6)
\ No newline at end of file
+    totp_code = serializers.CharField(min_length=6, max_length=6)
+
+class CookieTokenRefreshSerializer(TokenRefreshSerializer):
+    token_class = FilteredRefreshToken
@@ -0,0 +1,20 @@
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+from core import responsecache
+from .models import User
+from .revocation import token_revoked
+
+
+@receiver(post_save, sender=User)
+def invalidate_cached_role(sender, instance, created, update_fields=None, **kwargs):
+    # Logins save last_login alone; only role and email show up in cached responses
+    if created or (update_fields and not {'role', 'email'} & set(update_fields)):
+        return
+    responsecache.invalidate([responsecache.user_token(instance.pk)])
+
+
+@receiver(post_save, sender=BlacklistedToken)
+def publish_revocation(sender, instance, created, **kwargs):
+    if created:
+        token_revoked(instance.token.jti)
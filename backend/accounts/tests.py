@@ -6,6 +6,17 @@ from .models import User
 import pyotp
 from unittest.mock import patch
 from django.conf import settings
+from rest_framework_simplejwt.tokens import RefreshToken
+from core.testing import QueryBudgetMixin
+from django.core.cache import cache
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from datetime import timedelta
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+from . import revocation
 
 class AuthenticationTests(TestCase):
     def setUp(self):
@@ -150,3 +161,217 @@ class AuthenticationTests(TestCase):
             secure=True
         )
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class AccountQueryBudgetTests(QueryBudgetMixin, TestCase):
+    """Pin the query count of every route in accounts/urls.py"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.admin_user = User.objects.create_user(email='admin@example.com', password='adminpass123')
+        self.user = User.objects.create_user(email='user@example.com', password='userpass123')
+        for index in range(5):
+            User.objects.create_user(email=f'user{index}@example.com', password='userpass123')
+
+    def login(self, user):
+        refresh = RefreshToken.for_user(user)
+        self.client.cookies[settings.SIMPLE_JWT['AUTH_COOKIE']] = str(refresh.access_token)
+        self.client.cookies[settings.SIMPLE_JWT['AUTH_COOKIE_REFRESH']] = str(refresh)
+
+    def test_register_budget(self):
+        with self.assertMaxQueries(3):
+            response = self.client.post(
+                reverse('register'), {'email': 'new@example.com', 'password': 'newpass123'}, format='json'
+            )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_login_budget(self):
+        # Includes the throttle counter, which lives in the database cache here
+        with self.assertMaxQueries(8):
+            response = self.client.post(
+                reverse('login'), {'email': 'user@example.com', 'password': 'userpass123'}, format='json'
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_logout_budget(self):
+        self.login(self.user)
+        with self.assertMaxQueries(7):
+            response = self.client.post(reverse('logout'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_token_refresh_budget(self):
+        self.login(self.user)
+        with self.assertMaxQueries(8):
+            response = self.client.post('/accounts/token/refresh/', {}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+
+    def test_mfa_setup_budget(self):
+        self.login(self.user)
+        with self.assertMaxQueries(2):
+            response = self.client.get(reverse('mfa-setup'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        with self.assertMaxQueries(1):
+            response = self.client.post(
+                reverse('mfa-setup'), {'totp_code': pyotp.TOTP(response.data['secret']).now()}, format='json'
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_check_auth_budget(self):
+        self.login(self.user)
+        with self.assertMaxQueries(1):
+            response = self.client.get(reverse('check-auth'))
+        self.assertTrue(response.data['authenticated'])
+
+    def test_user_management_budget(self):
+        self.login(self.admin_user)
+        with self.assertMaxQueries(2):
+            response = self.client.get(reverse('user-management'))
+        self.assertEqual(len(response.data['results']), 6)
+        with self.assertMaxQueries(3):
+            response = self.client.put(
+                reverse('user-management'), {'id': self.user.id, 'role': 'USER'}, format='json'
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_bulk_role_budget(self):
+        self.login(self.admin_user)
+        ids = list(User.objects.exclude(id=self.admin_user.id).values_list('id', flat=True))
+        with self.assertMaxQueries(2):
+            response = self.client.post(reverse('user-bulk-role'), {'ids': ids, 'role': 'USER'}, format='json')
+        self.assertEqual(response.data['updated'], 6)
+
+
+class UserManagementTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.admin_user = User.objects.create_user(email='admin@example.com', password='adminpass123')
+        for index in range(12):
+            User.objects.create_user(email=f'member{index:02d}@example.com', password='memberpass123')
+        User.objects.create_user(email='outsider@example.org', password='outsiderpass123')
+        User.objects.filter(email__in=['member03@example.com', 'member07@example.com']).update(role='USER')
+        refresh = RefreshToken.for_user(self.admin_user)
+        self.client.cookies[settings.SIMPLE_JWT['AUTH_COOKIE']] = str(refresh.access_token)
+
+    def list_users(self, **params):
+        return self.client.get(reverse('user-management'), params)
+
+    def test_pages_cover_every_user_once(self):
+        """Test following next cursors walks all users in email order"""
+        emails, cursor = [], None
+        while True:
+            params = {'limit': 5}
+            if cursor:
+                params['cursor'] = cursor
+            data = self.list_users(**params).data
+            emails += [row['email'] for row in data['results']]
+            cursor = data['next']
+            if not cursor:
+                break
+        self.assertEqual(emails, sorted(User.objects.exclude(id=self.admin_user.id).values_list('email', flat=True)))
+        self.assertEqual(self.list_users(cursor='garbage').status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_prefix_search_and_role_filter(self):
+        """Test email prefix and role filters narrow the list in the query"""
+        data = self.list_users(q='member1').data
+        self.assertEqual([row['email'] for row in data['results']], ['member10@example.com', 'member11@example.com'])
+        data = self.list_users(q='member', role='USER').data
+        self.assertEqual([row['email'] for row in data['results']], ['member03@example.com', 'member07@example.com'])
+        self.assertEqual(data['results'][0]['storage_quota'], settings.STORAGE_QUOTAS['USER'])
+        self.assertEqual(self.list_users(role='OWNER').status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_bulk_role_update(self):
+        """Test many roles change in one request and the admin's own is left alone"""
+        ids = list(User.objects.filter(email__startswith='member').values_list('id', flat=True))
+        response = self.client.post(
+            reverse('user-bulk-role'), {'ids': ids + [self.admin_user.id], 'role': 'GUEST'}, format='json'
+        )
+        self.assertEqual(response.data['updated'], 12)
+        self.assertFalse(User.objects.filter(email__startswith='member').exclude(role='GUEST').exists())
+        self.admin_user.refresh_from_db()
+        self.assertEqual(self.admin_user.role, 'ADMIN')
+
+        guest = User.objects.get(email='outsider@example.org')
+        refresh = RefreshToken.for_user(guest)
+        self.client.cookies[settings.SIMPLE_JWT['AUTH_COOKIE']] = str(refresh.access_token)
+        response = self.client.post(reverse('user-bulk-role'), {'ids': ids, 'role': 'ADMIN'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+
+@override_settings(REVOCATION_FILTER=True)
+class TokenRevocationTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='user@example.com', password='userpass123')
+        revocation.revocations = revocation.RevocationFilter()
+
+    def test_bloom_filter(self):
+        """Test every added item is found and few others are"""
+        bloom = revocation.BloomFilter(2000)
+        for index in range(2000):
+            bloom.add(f'jti-{index}')
+        self.assertTrue(all(f'jti-{index}' in bloom for index in range(2000)))
+        false_positives = sum(f'other-{index}' in bloom for index in range(10000))
+        self.assertLess(false_positives, 300)
+
+    def test_unrevoked_token_skips_blacklist(self):
+        """Test a token the filter doesn't know is accepted without querying the blacklist"""
+        revocation.FilteredRefreshToken(str(RefreshToken.for_user(self.user)))
+        token = str(RefreshToken.for_user(self.user))
+        with CaptureQueriesContext(connection) as queries:
+            revocation.FilteredRefreshToken(token)
+        self.assertFalse([query for query in queries if 'blacklistedtoken' in query['sql']])
+
+    def test_revocations_reach_other_filters(self):
+        """Test a filter built before a logout catches up from the cache and rejects the token"""
+        other_process = revocation.RevocationFilter()
+        other_process.might_be_revoked('warm-up')
+        built_at = other_process.built_at
+
+        refresh = RefreshToken.for_user(self.user)
+        self.client.cookies[settings.SIMPLE_JWT['AUTH_COOKIE']] = str(refresh.access_token)
+        self.client.cookies[settings.SIMPLE_JWT['AUTH_COOKIE_REFRESH']] = str(refresh)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.client.post(reverse('logout')).status_code, status.HTTP_200_OK)
+
+        self.assertTrue(other_process.might_be_revoked(refresh['jti']))
+        self.assertEqual(other_process.built_at, built_at)
+        with self.assertRaises(TokenError):
+            revocation.FilteredRefreshToken(str(refresh))
+
+    def test_missing_entry_rebuilds(self):
+        """Test a filter that can't catch up from the cache rebuilds from the table"""
+        other_process = revocation.RevocationFilter()
+        other_process.might_be_revoked('warm-up')
+        refresh = RefreshToken.for_user(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            refresh.blacklist()
+        cache.delete(revocation._entry_key(cache.get(revocation.GENERATION_KEY)))
+        self.assertTrue(other_process.might_be_revoked(refresh['jti']))
+
+    def test_rotated_token_is_rejected(self):
+        """Test a refresh token can't be used again once the refresh endpoint rotated it"""
+        refresh = str(RefreshToken.for_user(self.user))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.cookies[settings.SIMPLE_JWT['AUTH_COOKIE_REFRESH']] = refresh
+            response = self.client.post('/accounts/token/refresh/', {}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.client.cookies[settings.SIMPLE_JWT['AUTH_COOKIE_REFRESH']] = refresh
+        response = self.client.post('/accounts/token/refresh/', {}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_prune_expired(self):
+        """Test expired tokens and their blacklist rows are removed in batches and live ones kept"""
+        past = timezone.now() - timedelta(hours=1)
+        for index in range(5):
+            token = OutstandingToken.objects.create(user=self.user, jti=f'old-{index}', token='x', expires_at=past)
+            BlacklistedToken.objects.create(token=token)
+        live = RefreshToken.for_user(self.user)
+
+        self.assertEqual(revocation.prune_expired(dry_run=True), 5)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(revocation.prune_expired(batch_size=2), 5)
+        # Per batch: the ids, the rows for the cascade and the two deletes
+        self.assertLessEqual(len(queries), 3 * 4 + 1)
+        self.assertEqual(list(OutstandingToken.objects.values_list('jti', flat=True)), [live['jti']])
+        self.assertFalse(BlacklistedToken.objects.exists())
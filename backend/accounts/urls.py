@@ -1,6 +1,6 @@
 from django.urls import path
 from rest_framework_simplejwt.views import TokenRefreshView
-from .views import RegisterView, LoginView, LogoutView, TOTPSetupView, CheckAuthView, CookieTokenRefreshView, UserManagementView
+from .views import RegisterView, LoginView, LogoutView, TOTPSetupView, CheckAuthView, CookieTokenRefreshView, UserManagementView, BulkRoleUpdateView
 
 urlpatterns = [
     path('register/', RegisterView.as_view(), name='register'),
@@ -10,4 +10,5 @@ urlpatterns = [
     path('mfa/setup/', TOTPSetupView.as_view(), name='mfa-setup'),
     path('check-auth/', CheckAuthView.as_view(), name='check-auth'),
     path('users/', UserManagementView.as_view(), name='user-management'),
+    path('users/bulk-role/', BulkRoleUpdateView.as_view(), name='user-bulk-role'),
 ]
\ No newline at end of file
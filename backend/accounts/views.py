@@ -4,7 +4,11 @@ from rest_framework.response import Response
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.contrib.auth import authenticate
-from .serializers import UserRegistrationSerializer, UserLoginSerializer, TOTPSetupSerializer, TOTPVerifySerializer, LoginWithMFASerializer
+from .serializers import (
+    UserRegistrationSerializer, UserLoginSerializer, TOTPSetupSerializer, TOTPVerifySerializer, LoginWithMFASerializer,
+    CookieTokenRefreshSerializer,
+)
+from .revocation import FilteredRefreshToken
 from rest_framework_simplejwt.exceptions import TokenError
 import pyotp
 import qrcode
@@ -16,13 +20,20 @@ from django.http import JsonResponse
 from .authentication import CookieJWTAuthentication
 from rest_framework_simplejwt.views import TokenRefreshView
 from .models import User
+from filemanager.quotas import quota_for
+from core.pagination import InvalidCursor, decode_cursor, encode_cursor, parse_limit
 from rest_framework.exceptions import PermissionDenied
-from django.core.cache import cache
 from rest_framework.exceptions import Throttled
+from core.cache import SlidingWindowCounter
+from core import responsecache
 import logging
 
 logger = logging.getLogger(__name__)
 
+# 20 attempts per 15 minutes per IP, counted in the shared cache so the limit
+# holds across all workers
+login_throttle = SlidingWindowCounter('login_attempts', limit=20, window=900)
+
 class RegisterView(APIView):
     permission_classes = (AllowAny,)
     authentication_classes = []
@@ -106,13 +117,11 @@ class LoginView(APIView):
     def post(self, request):
         # Rate limiting
         ip = request.META.get('REMOTE_ADDR')
-        key = f'login_attempts_{ip}'
-        attempts = cache.get(key, 0)
-        
-        if attempts >= 20:  # 20 attempts per 15 minutes
-            raise Throttled(detail="Too many login attempts. Please try again later.")
-        
-        cache.set(key, attempts + 1, 900)  # 15 minutes timeout
+        if login_throttle.exceeded(ip):
+            raise Throttled(
+                wait=login_throttle.retry_after(),
+                detail="Too many login attempts. Please try again later."
+            )
 
         if 'totp_code' in request.data:
             serializer = LoginWithMFASerializer(data=request.data)
@@ -209,7 +218,7 @@ class LogoutView(APIView):
         try:
             refresh_token = request.COOKIES.get(settings.SIMPLE_JWT['AUTH_COOKIE_REFRESH'])
             if refresh_token:
-                token = RefreshToken(refresh_token)
+                token = FilteredRefreshToken(refresh_token)
                 token.blacklist()
             
             response = Response({"message": "Logged out successfully"})
@@ -228,19 +237,24 @@ class CheckAuthView(APIView):
     
     def get(self, request):
         if request.user.is_authenticated:
-            return Response({
-                'authenticated': True,
-                'user': {
-                    'email': request.user.email,
-                    'role': request.user.role,
-                }
-            })
+            return responsecache.cached_response(
+                request, 'auth', [responsecache.user_token(request.user.pk), responsecache.ROLES],
+                lambda: {
+                    'authenticated': True,
+                    'user': {
+                        'email': request.user.email,
+                        'role': request.user.role,
+                    }
+                },
+            )
         return Response({
             'authenticated': False,
             'user': None
         }, status=status.HTTP_200_OK)  # Return 200 even when not authenticated
 
 class CookieTokenRefreshView(TokenRefreshView):
+    serializer_class = CookieTokenRefreshSerializer
+
     def post(self, request, *args, **kwargs):
         refresh_token = request.COOKIES.get(settings.SIMPLE_JWT['AUTH_COOKIE_REFRESH'])
         if refresh_token:
@@ -259,33 +273,67 @@ class CookieTokenRefreshView(TokenRefreshView):
         
         return response
 
+ROLES = [role for role, _ in User.ROLE_CHOICES]
+
+def page_users(queryset, cursor, limit):
+    """Return (rows, next_cursor) of user dicts ordered by email"""
+    queryset = queryset.order_by('email')
+    if cursor:
+        values = decode_cursor(cursor)
+        if len(values) != 1 or not isinstance(values[0], str):
+            raise InvalidCursor('Invalid cursor')
+        queryset = queryset.filter(email__gt=values[0])
+
+    rows = list(queryset.values('id', 'email', 'role', 'storage_used', 'storage_quota')[:limit + 1])
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([rows[-1]['email']])
+    return rows, next_cursor
+
 class UserManagementView(APIView):
     permission_classes = (IsAuthenticated,)
     authentication_classes = (CookieJWTAuthentication,)
 
     def get(self, request):
+        """List users by email, a page at a time, optionally by email prefix and role"""
         if request.user.role != 'ADMIN':
             raise PermissionDenied("Only admins can access user management")
-        
-        try:            
-            # Get all users first
-            all_users = User.objects.all()
-            # Then exclude current user
-            users = all_users.exclude(id=request.user.id)
-            
-            user_data = [{
-                'id': user.id,
-                'email': user.email,
-                'role': user.role
-            } for user in users]
-            return Response(user_data)
-            
+
+        users = User.objects.exclude(id=request.user.id)
+        role = request.query_params.get('role')
+        if role:
+            if role not in ROLES:
+                return Response({"error": "Invalid role specified"}, status=status.HTTP_400_BAD_REQUEST)
+            users = users.filter(role=role)
+        prefix = request.query_params.get('q', '').strip()
+        if prefix:
+            # A range rather than LIKE so the email index is used on every backend
+            users = users.filter(email__gte=prefix, email__lt=prefix + '\U0010ffff')
+
+        try:
+            rows, next_cursor = page_users(
+                users,
+                request.query_params.get('cursor'),
+                parse_limit(request.query_params.get('limit'))
+            )
+        except InvalidCursor:
+            return Response({'error': 'Invalid cursor'}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
             return Response(
                 {"error": "Failed to fetch users"}, 
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+        results = [{
+            'id': row['id'],
+            'email': row['email'],
+            'role': row['role'],
+            'storage_used': row['storage_used'],
+            'storage_quota': quota_for(row['role'], row['storage_quota'])
+        } for row in rows]
+        return Response({'results': results, 'next': next_cursor})
+
     def put(self, request, *args, **kwargs):
         if request.user.role != 'ADMIN':
             raise PermissionDenied("Only admins can update user roles")
@@ -302,7 +350,7 @@ class UserManagementView(APIView):
             )
         
         # Add validation
-        if new_role not in ['ADMIN', 'USER', 'GUEST']:
+        if new_role not in ROLES:
             return Response(
                 {"error": "Invalid role specified"}, 
                 status=status.HTTP_400_BAD_REQUEST,
@@ -339,4 +387,41 @@ class UserManagementView(APIView):
                 status=status.HTTP_404_NOT_FOUND,
                 headers={'Access-Control-Allow-Origin': 'https://localhost:3000',
                         'Access-Control-Allow-Credentials': 'true'}
-            )
\ No newline at end of file
+            )
+
+class BulkRoleUpdateView(APIView):
+    permission_classes = (IsAuthenticated,)
+    authentication_classes = (CookieJWTAuthentication,)
+
+    def post(self, request):
+        """Give many users the same role in one UPDATE"""
+        if request.user.role != 'ADMIN':
+            raise PermissionDenied("Only admins can update user roles")
+
+        user_ids = request.data.get('ids')
+        new_role = request.data.get('role')
+        if not isinstance(user_ids, list) or not user_ids or new_role not in ROLES:
+            return Response(
+                {"error": "ids must be a non-empty list and role a valid role"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        max_users = getattr(settings, 'USER_BULK_UPDATE_MAX', 1000)
+        if len(user_ids) > max_users:
+            return Response(
+                {"error": f"At most {max_users} users can be updated at once"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        try:
+            user_ids = {int(user_id) for user_id in user_ids}
+        except (TypeError, ValueError):
+            return Response({"error": "Invalid user id"}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Admins can't change their own role, here or through PUT /users/
+        updated = User.objects.filter(id__in=user_ids).exclude(id=request.user.id).update(role=new_role)
+        # update() sends no post_save; one token covers every cached response that shows a role
+        responsecache.invalidate([responsecache.ROLES])
+        logger.info(
+            f"Bulk role update - User: {request.user.email}, "
+            f"Users: {updated}, New Role: {new_role}"
+        )
+        return Response({'updated': updated, 'role': new_role})
@@ -0,0 +1,32 @@
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.http.cookie import parse_cookie
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from .authentication import CookieJWTAuthentication
+
+
+@database_sync_to_async
+def get_user(raw_token):
+    authentication = CookieJWTAuthentication()
+    try:
+        validated_token = authentication.get_validated_token(raw_token)
+        return authentication.get_user(validated_token)
+    except (InvalidToken, TokenError, AuthenticationFailed):
+        return AnonymousUser()
+
+
+class CookieJWTAuthMiddleware(BaseMiddleware):
+    """Sets scope['user'] from the access_token cookie, like CookieJWTAuthentication does for HTTP"""
+
+    async def __call__(self, scope, receive, send):
+        cookies = {}
+        for name, value in scope.get('headers', []):
+            if name == b'cookie':
+                cookies = parse_cookie(value.decode('latin1'))
+                break
+        raw_token = cookies.get(settings.SIMPLE_JWT['AUTH_COOKIE'])
+        scope['user'] = await get_user(raw_token) if raw_token else AnonymousUser()
+        return await super().__call__(scope, receive, send)
@@ -0,0 +1,131 @@
+"""Shared cache helpers.
+
+settings.CACHES points every worker at the same backend (Redis when
+REDIS_URL is set, otherwise the database cache below), so counters and
+cached values are seen by all processes instead of one LocMem per worker.
+"""
+from django.core.cache import caches
+from django.core.cache.backends.db import DatabaseCache as BaseDatabaseCache
+from django.db import connections, models, router, transaction
+from django.utils.timezone import now as tz_now
+import base64
+import pickle
+import time
+
+
+class DatabaseCache(BaseDatabaseCache):
+    """Database cache whose incr() is a single read-modify-write transaction.
+
+    Django's DatabaseCache implements incr() as a separate get() and set(),
+    so two workers incrementing the same counter can lose updates.
+    """
+
+    def incr(self, key, delta=1, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        db = router.db_for_write(self.cache_model_class)
+        connection = connections[db]
+        quote_name = connection.ops.quote_name
+        table = quote_name(self._table)
+
+        with transaction.atomic(using=db), connection.cursor() as cursor:
+            if connection.features.has_select_for_update:
+                lock = ' FOR UPDATE'
+            else:
+                # SQLite has no row locks; a no-op write takes the database
+                # write lock before we read so concurrent incr() calls serialize
+                lock = ''
+                cursor.execute(
+                    'UPDATE %s SET %s = %s WHERE %s = %%s'
+                    % (table, quote_name('cache_key'), quote_name('cache_key'), quote_name('cache_key')),
+                    [key],
+                )
+            cursor.execute(
+                'SELECT %s, %s FROM %s WHERE %s = %%s%s'
+                % (quote_name('value'), quote_name('expires'), table, quote_name('cache_key'), lock),
+                [key],
+            )
+            row = cursor.fetchone()
+            if row is None:
+                raise ValueError(f"Key '{key}' not found")
+
+            value, expires = row
+            expression = models.Expression(output_field=models.DateTimeField())
+            for converter in connection.ops.get_db_converters(expression) + expression.get_db_converters(connection):
+                expires = converter(expires, expression, connection)
+            if expires < tz_now():
+                raise ValueError(f"Key '{key}' not found")
+
+            value = pickle.loads(base64.b64decode(connection.ops.process_clob(value).encode()))
+            new_value = value + delta
+            pickled = base64.b64encode(pickle.dumps(new_value, self.pickle_protocol)).decode('latin1')
+            cursor.execute(
+                'UPDATE %s SET %s = %%s WHERE %s = %%s'
+                % (table, quote_name('value'), quote_name('cache_key')),
+                [pickled, key],
+            )
+        return new_value
+
+
+def incr_with_ttl(key, ttl, delta=1, cache_alias='default'):
+    """Atomically increment key, creating it with a ttl (seconds) if missing"""
+    cache = caches[cache_alias]
+    if cache.add(key, delta, ttl):
+        return delta
+    try:
+        return cache.incr(key, delta)
+    except ValueError:
+        # Expired between add() and incr()
+        cache.add(key, delta, ttl)
+        return delta
+
+
+class SlidingWindowCounter:
+    """Approximate sliding-window counter on top of the shared cache.
+
+    Hits are counted in fixed buckets of `window` seconds. The current
+    estimate is the current bucket plus the previous bucket weighted by how
+    much of it still overlaps the window, which smooths out the burst a plain
+    fixed window allows at bucket boundaries.
+    """
+
+    def __init__(self, prefix, limit, window, cache_alias='default'):
+        self.prefix = prefix
+        self.limit = limit
+        self.window = window
+        self.cache_alias = cache_alias
+
+    def _now(self):
+        return time.time()
+
+    def _keys(self, ident, now):
+        bucket = int(now // self.window)
+        return f'{self.prefix}:{ident}:{bucket}', f'{self.prefix}:{ident}:{bucket - 1}'
+
+    def _estimate(self, current, previous, now):
+        elapsed = (now % self.window) / self.window
+        return current + previous * (1 - elapsed)
+
+    def hit(self, ident):
+        """Record one hit and return the estimated count in the window"""
+        now = self._now()
+        current_key, previous_key = self._keys(ident, now)
+        current = incr_with_ttl(current_key, self.window * 2, cache_alias=self.cache_alias)
+        previous = caches[self.cache_alias].get(previous_key, 0)
+        return self._estimate(current, previous, now)
+
+    def count(self, ident):
+        now = self._now()
+        current_key, previous_key = self._keys(ident, now)
+        values = caches[self.cache_alias].get_many([current_key, previous_key])
+        return self._estimate(values.get(current_key, 0), values.get(previous_key, 0), now)
+
+    def exceeded(self, ident):
+        """Record a hit and return True if it goes over the limit"""
+        return self.hit(ident) > self.limit
+
+    def retry_after(self):
+        """Seconds until the current bucket rolls over"""
+        return int(self.window - (self._now() % self.window)) + 1
+
+    def reset(self, ident):
+        caches[self.cache_alias].delete_many(self._keys(ident, self._now()))
@@ -0,0 +1,56 @@
+"""Counters shared by every worker, for the admin metrics endpoint.
+
+Counting each event straight into the shared cache would add a cache write
+(a database transaction with the database cache) to the requests being
+measured, so each process counts in memory and adds its totals to the
+cache at most every METRICS_FLUSH_SECONDS.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from collections import Counter
+import threading
+import time
+from .cache import incr_with_ttl
+
+KEY_PREFIX = 'metrics'
+
+_counts = Counter()
+_lock = threading.Lock()
+_last_flush = time.monotonic()
+
+
+def _key(name):
+    return f'{KEY_PREFIX}:{name}'
+
+
+def flush():
+    """Add this process's pending counts to the shared totals"""
+    global _last_flush
+    with _lock:
+        pending = dict(_counts)
+        _counts.clear()
+        _last_flush = time.monotonic()
+    for name, count in pending.items():
+        incr_with_ttl(_key(name), None, count)
+
+
+def incr(name, count=1):
+    with _lock:
+        _counts[name] += count
+        due = time.monotonic() - _last_flush >= getattr(settings, 'METRICS_FLUSH_SECONDS', 10)
+    if due:
+        flush()
+
+
+def read(names):
+    """{name: total} for the given counters, including this process's pending counts"""
+    flush()
+    values = cache.get_many([_key(name) for name in names])
+    return {name: values.get(_key(name), 0) for name in names}
+
+
+def reset(names):
+    with _lock:
+        for name in names:
+            _counts.pop(name, None)
+    cache.delete_many([_key(name) for name in names])
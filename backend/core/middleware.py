@@ -0,0 +1,59 @@
+from django.conf import settings
+from django.db import connections
+from collections import Counter
+from contextlib import ExitStack
+import logging
+import re
+from .profiling import QueryRecorder
+
+logger = logging.getLogger(__name__)
+
+_IN_LIST = re.compile(r'IN \((?:%s, )*%s\)')
+_LIMIT = re.compile(r'LIMIT \d+')
+
+
+def query_shape(sql):
+    """Normalize a query so the same statement with different params matches"""
+    return _LIMIT.sub('LIMIT ?', _IN_LIST.sub('IN (...)', sql))
+
+
+def duplicate_shapes(queries, threshold):
+    """Return {shape: count} for every query shape run at least threshold times"""
+    shapes = Counter(query_shape(query['sql']) for query in queries)
+    return {shape: count for shape, count in shapes.items() if count >= threshold}
+
+
+class QueryBudgetMiddleware:
+    """Counts queries and DB time per request and flags repeated query shapes.
+
+    Enabled by settings.QUERY_INSTRUMENTATION (on when DEBUG) and never meant
+    for production: every query goes through a Python execute wrapper.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.enabled = getattr(settings, 'QUERY_INSTRUMENTATION', settings.DEBUG)
+        self.duplicate_threshold = getattr(settings, 'QUERY_DUPLICATE_THRESHOLD', 3)
+
+    def __call__(self, request):
+        if not self.enabled:
+            return self.get_response(request)
+
+        recorder = QueryRecorder()
+        with ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(recorder))
+            response = self.get_response(request)
+
+        query_ms = sum(query['ms'] for query in recorder.queries)
+        duplicates = duplicate_shapes(recorder.queries, self.duplicate_threshold)
+        response['X-Query-Count'] = str(len(recorder.queries))
+        response['X-Query-Time-Ms'] = f'{query_ms:.3f}'
+        response['X-Query-Duplicates'] = str(sum(duplicates.values()))
+
+        for shape, count in duplicates.items():
+            logger.warning(
+                f"Possible N+1 on {request.method} {request.path}: "
+                f"{count} queries shaped like {shape[:300]}"
+            )
+        return response
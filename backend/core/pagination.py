@@ -0,0 +1,34 @@
+"""Keyset (seek) pagination helpers.
+
+A cursor is the opaque, url-safe encoding of the sort key of the last row on
+the previous page, so fetching page N costs the same as fetching page 1.
+"""
+import base64
+import json
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values, default=str).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
+        raise InvalidCursor('Invalid cursor')
+    if not isinstance(values, list):
+        raise InvalidCursor('Invalid cursor')
+    return values
+
+
+def parse_limit(value, default=50, maximum=200):
+    try:
+        limit = int(value) if value is not None else default
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(limit, maximum))
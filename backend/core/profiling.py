@@ -0,0 +1,261 @@
+"""On-demand request profiling for admins.
+
+An ADMIN can profile a single request by sending ``X-Profile: cprofile`` (or
+``sample``) or by adding ``?_profile=cprofile`` to the URL. The profile and the
+SQL queries the request ran are stored under ``settings.PROFILE_ROOT`` and can
+be fetched later from ``/profiles/``. Requests without the flag only pay for
+one header lookup.
+"""
+from django.conf import settings
+from django.db import connections
+from django.http import FileResponse, Http404
+from django.utils import timezone
+from rest_framework.exceptions import PermissionDenied
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from accounts.authentication import CookieJWTAuthentication
+from collections import Counter
+from contextlib import ExitStack
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+PROFILE_PARAM = '_profile'
+PROFILE_MODES = ('cprofile', 'sample')
+
+
+def get_profile_root():
+    return getattr(settings, 'PROFILE_ROOT', os.path.join(settings.BASE_DIR, 'profiles'))
+
+
+class QueryRecorder:
+    """Database execute wrapper that records every query with its duration"""
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append({
+                'alias': context['connection'].alias,
+                'sql': sql,
+                'params': repr(params)[:500],
+                'ms': round((time.perf_counter() - start) * 1000, 3),
+            })
+
+
+class StackSampler:
+    """Samples the stack of one thread at a fixed interval"""
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_filename}:{code.co_name}:{frame.f_lineno}')
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def collapsed(self):
+        """Samples in the collapsed-stack format used by flame graph tools"""
+        return '\n'.join(f'{stack} {count}' for stack, count in self.samples.most_common())
+
+
+def _requested_mode(request):
+    mode = request.META.get(PROFILE_HEADER)
+    if mode is None and PROFILE_PARAM in request.GET:
+        mode = request.GET.get(PROFILE_PARAM) or 'cprofile'
+    return mode
+
+
+def _is_admin(request):
+    try:
+        result = CookieJWTAuthentication().authenticate(request)
+    except Exception:
+        return False
+    return result is not None and result[0].role == 'ADMIN'
+
+
+class ProfiledStream:
+    """Streaming body that calls finish() once the response is closed"""
+
+    def __init__(self, chunks, finish):
+        self.chunks = chunks
+        self.finish = finish
+        self.finished = False
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def close(self):
+        if not self.finished:
+            self.finished = True
+            self.finish()
+
+
+class RequestProfilerMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        mode = _requested_mode(request)
+        if mode is None:
+            return self.get_response(request)
+        if mode not in PROFILE_MODES or not _is_admin(request):
+            return self.get_response(request)
+        return self.profile(request, mode)
+
+    def profile(self, request, mode):
+        profile_id = uuid.uuid4().hex
+        recorder = QueryRecorder()
+        profiler = cProfile.Profile() if mode == 'cprofile' else None
+        sampler = StackSampler(threading.get_ident()) if mode == 'sample' else None
+
+        start = time.perf_counter()
+        stack = ExitStack()
+        for alias in connections:
+            stack.enter_context(connections[alias].execute_wrapper(recorder))
+        if sampler:
+            stack.enter_context(sampler)
+        if profiler:
+            profiler.enable()
+            stack.callback(profiler.disable)
+        try:
+            response = self.get_response(request)
+        except BaseException:
+            stack.close()
+            raise
+
+        def finish():
+            stack.close()
+            duration = time.perf_counter() - start
+            try:
+                self.store(profile_id, request, response, mode, duration, recorder, profiler, sampler)
+                return True
+            except OSError as e:
+                logger.error(f"Failed to store request profile {profile_id}: {str(e)}")
+                return False
+
+        if response.streaming:
+            # A download's body is read, decrypted and paced while the server
+            # iterates it, after this returns; keep profiling until it closes
+            response.streaming_content = ProfiledStream(response.streaming_content, finish)
+            response['X-Profile-Id'] = profile_id
+        elif finish():
+            response['X-Profile-Id'] = profile_id
+        return response
+
+    def store(self, profile_id, request, response, mode, duration, recorder, profiler, sampler):
+        root = get_profile_root()
+        os.makedirs(root, exist_ok=True)
+
+        report = {
+            'id': profile_id,
+            'mode': mode,
+            'method': request.method,
+            'path': request.get_full_path(),
+            'status': response.status_code,
+            'created_at': timezone.now().isoformat(),
+            'duration_ms': round(duration * 1000, 3),
+            'query_count': len(recorder.queries),
+            'query_ms': round(sum(query['ms'] for query in recorder.queries), 3),
+            'queries': recorder.queries,
+        }
+
+        if profiler:
+            profiler.dump_stats(os.path.join(root, f'{profile_id}.prof'))
+            output = io.StringIO()
+            pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(50)
+            report['stats'] = output.getvalue()
+        if sampler:
+            report['samples'] = sampler.collapsed()
+
+        with open(os.path.join(root, f'{profile_id}.json'), 'w') as f:
+            json.dump(report, f)
+
+
+class AdminOnlyMixin:
+    permission_classes = (IsAuthenticated,)
+    authentication_classes = (CookieJWTAuthentication,)
+
+    def check_admin(self, request):
+        if request.user.role != 'ADMIN':
+            raise PermissionDenied("Only admins can access request profiles")
+
+
+def _profile_path(profile_id, extension):
+    # Profile ids are uuid hex strings; anything else could escape PROFILE_ROOT
+    try:
+        profile_id = uuid.UUID(hex=profile_id).hex
+    except ValueError:
+        raise Http404
+    return os.path.join(get_profile_root(), f'{profile_id}.{extension}')
+
+
+class ProfileListView(AdminOnlyMixin, APIView):
+    def get(self, request):
+        self.check_admin(request)
+        root = get_profile_root()
+        if not os.path.isdir(root):
+            return Response([])
+
+        profiles = []
+        for entry in os.scandir(root):
+            if not entry.name.endswith('.json'):
+                continue
+            with open(entry.path) as f:
+                report = json.load(f)
+            profiles.append({key: report[key] for key in (
+                'id', 'mode', 'method', 'path', 'status', 'created_at', 'duration_ms', 'query_count'
+            )})
+        profiles.sort(key=lambda profile: profile['created_at'], reverse=True)
+        return Response(profiles)
+
+
+class ProfileDetailView(AdminOnlyMixin, APIView):
+    def get(self, request, profile_id):
+        self.check_admin(request)
+
+        # ?raw=1 downloads the cProfile dump itself for snakeviz/pstats
+        if request.query_params.get('raw'):
+            path = _profile_path(profile_id, 'prof')
+            if not os.path.exists(path):
+                raise Http404
+            return FileResponse(open(path, 'rb'), as_attachment=True, filename=f'{profile_id}.prof')
+
+        path = _profile_path(profile_id, 'json')
+        if not os.path.exists(path):
+            raise Http404
+        with open(path) as f:
+            return Response(json.load(f))
@@ -0,0 +1,126 @@
+"""Per-user caching of list responses, invalidated by generation tokens.
+
+A cached payload is stored under a key derived from the user, the
+endpoint, the query string and the current value of every generation
+token it depends on (``user:<id>`` for the user's own data, ``files`` for
+any file, ``roles`` for bulk role changes). Signals replace the tokens a
+change affects with fresh random values once its transaction commits, so
+stale payloads are never read again and simply expire.
+
+The same digest is sent as a weak ETag; a client revalidating an unchanged
+list gets a 304 after one cache read, without the payload being fetched.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.http import parse_etags
+from rest_framework import status
+from rest_framework.response import Response
+import hashlib
+import uuid
+from . import metrics
+
+SCOPES = ('files', 'shared', 'auth')
+OUTCOMES = ('hit', 'miss', 'not_modified')
+FILES = 'files'
+ROLES = 'roles'
+
+_MISSING = object()
+
+
+def user_token(user_id):
+    return f'user:{user_id}'
+
+
+def _token_key(name):
+    return f'response_cache:token:{name}'
+
+
+def _tokens(names):
+    """Current values of the named tokens, creating the missing ones.
+
+    Returns (tokens, created); nothing can be cached yet under a token that
+    was just created.
+    """
+    keys = [_token_key(name) for name in names]
+    values = cache.get_many(keys)
+    created = False
+    for key in keys:
+        if key not in values:
+            token = uuid.uuid4().hex
+            values[key] = token if cache.add(key, token, None) else cache.get(key)
+            created = True
+    return [values[key] for key in keys], created
+
+
+def _bump(names):
+    token = uuid.uuid4().hex
+    cache.set_many({_token_key(name): token for name in names}, None)
+
+
+def enabled():
+    return bool(getattr(settings, 'RESPONSE_CACHE_TIMEOUT', 300))
+
+
+def invalidate(names):
+    """Retire every payload depending on the named tokens when the transaction commits"""
+    # Nothing is cached while the cache is off, so there is nothing to retire
+    if not enabled():
+        return
+    names = set(names)
+    if names:
+        transaction.on_commit(lambda: _bump(names))
+
+
+def _not_modified(request, etag):
+    header = request.META.get('HTTP_IF_NONE_MATCH')
+    if not header:
+        return False
+    etags = parse_etags(header)
+    return '*' in etags or any(tag.removeprefix('W/') == etag.removeprefix('W/') for tag in etags)
+
+
+def cached_response(request, scope, depends, build):
+    """Response for build()'s data, served from the cache while depends' tokens are unchanged"""
+    timeout = getattr(settings, 'RESPONSE_CACHE_TIMEOUT', 300)
+    # Only the JSON rendering is cached; the browsable API renders per request
+    if not timeout or not request.user.is_authenticated or request.accepted_renderer.format != 'json':
+        return Response(build())
+
+    tokens, created = _tokens(depends)
+    query = sorted(request.query_params.lists())
+    digest = hashlib.sha256(repr((scope, request.user.pk, query, tokens)).encode()).hexdigest()[:32]
+    etag = f'W/"{digest}"'
+
+    if _not_modified(request, etag):
+        outcome = 'not_modified'
+        response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        key = f'response_cache:{digest}'
+        data = _MISSING if created else cache.get(key, _MISSING)
+        if data is _MISSING:
+            outcome = 'miss'
+            data = build()
+            cache.set(key, data, timeout)
+        else:
+            outcome = 'hit'
+        response = Response(data)
+    metrics.incr(f'response_cache.{scope}.{outcome}')
+
+    response['ETag'] = etag
+    # Always revalidate; the ETag makes that cheap
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def stats():
+    """{scope: {'hit', 'miss', 'not_modified', 'hit_ratio'}}, counting 304s as hits"""
+    names = [f'response_cache.{scope}.{outcome}' for scope in SCOPES for outcome in OUTCOMES]
+    counts = metrics.read(names)
+    result = {}
+    for scope in SCOPES:
+        scope_counts = {outcome: counts[f'response_cache.{scope}.{outcome}'] for outcome in OUTCOMES}
+        total = sum(scope_counts.values())
+        served = scope_counts['hit'] + scope_counts['not_modified']
+        result[scope] = {**scope_counts, 'hit_ratio': round(served / total, 4) if total else None}
+    return result
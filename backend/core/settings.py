@@ -43,9 +43,13 @@ INSTALLED_APPS = [
     'accounts',
     'rest_framework_simplejwt.token_blacklist',
     'django_extensions',
+    'channels',
     'filemanager',
 ]
 
+# WebSockets (live file events) are served by core/asgi.py
+ASGI_APPLICATION = 'core.asgi.application'
+
 # Custom User Model
 AUTH_USER_MODEL = 'accounts.User'
 
@@ -71,8 +75,15 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'core.profiling.RequestProfilerMiddleware',
+    'core.middleware.QueryBudgetMiddleware',
 ]
 
+# Per-request query counting and N+1 detection (see core/middleware.py).
+# Adds an execute wrapper to every query, so keep it off in production.
+QUERY_INSTRUMENTATION = os.getenv('QUERY_INSTRUMENTATION', str(DEBUG)) == 'True'
+QUERY_DUPLICATE_THRESHOLD = int(os.getenv('QUERY_DUPLICATE_THRESHOLD', '3'))
+
 ROOT_URLCONF = 'core.urls'
 
 TEMPLATES = [
@@ -105,6 +116,25 @@ DATABASES = {
 }
 
 
+# Cache shared by all workers, used for throttling and response caches.
+# Set REDIS_URL to use Redis; otherwise the database above is used (create the
+# table with `python manage.py createcachetable`).
+if os.getenv('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv('REDIS_URL'),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'core.cache.DatabaseCache',
+            'LOCATION': 'cache_table',
+            'OPTIONS': {'MAX_ENTRIES': 100000},
+        }
+    }
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -216,11 +246,25 @@ CORS_EXPOSE_HEADERS = [
 ]
 
 # If you're using channels/websockets, configure them for SSL
-CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer"
+# The in-memory layer only reaches sockets served by the same process. The
+# entrypoint serves HTTP and WebSockets from separate processes, so set
+# REDIS_URL for events raised by HTTP requests to reach any socket.
+if os.getenv('REDIS_URL'):
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "CONFIG": {"hosts": [os.getenv('REDIS_URL')]},
+        }
+    }
+else:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer"
+        }
     }
-}
+
+# Minimum seconds between upload.progress events for one upload
+UPLOAD_PROGRESS_INTERVAL = 0.5
 
 # Add these settings for cookies and CSRF
 CSRF_COOKIE_SAMESITE = 'Strict'
@@ -245,6 +289,94 @@ X_FRAME_OPTIONS = 'DENY'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Storage quota per role in bytes; None means unlimited. A user's
+# storage_quota overrides the role default.
+STORAGE_QUOTAS = {
+    'ADMIN': None,
+    'USER': int(os.getenv('USER_STORAGE_QUOTA', str(10 * 1024 ** 3))),
+    'GUEST': int(os.getenv('GUEST_STORAGE_QUOTA', str(1 * 1024 ** 3))),
+}
+
+# Largest number of users one bulk role change may update
+USER_BULK_UPDATE_MAX = 1000
+
+# Largest number of files a single bulk ZIP download may include
+BULK_DOWNLOAD_MAX_FILES = int(os.getenv('BULK_DOWNLOAD_MAX_FILES', '1000'))
+
+# Preview renditions for VIEW shares (see filemanager/previews.py)
+PREVIEW_WORKERS = int(os.getenv('PREVIEW_WORKERS', '2'))
+PREVIEW_IMAGE_SIZE = 256
+PREVIEW_TEXT_BYTES = 16 * 1024
+# Larger images and PDFs get no preview
+PREVIEW_MAX_SOURCE_BYTES = 64 * 1024 * 1024
+PREVIEW_CACHE_SECONDS = 24 * 60 * 60
+
+# Shared decrypt streams for concurrent downloads of one file, in 64 KiB
+# chunks (see filemanager/coalesce.py): readers further behind than the
+# buffer are detached, and the producer stays at most LEAD ahead of the fastest
+COALESCE_BUFFER_CHUNKS = 64
+COALESCE_LEAD_CHUNKS = 8
+
+# Download governor (see filemanager/governor.py). A limit is
+# {'rate': bytes per second, 'concurrent': transfers}; a missing key or
+# None means unlimited. User limits go by the downloader's role, link limits
+# by the role of the user who created the link, IP limits apply to
+# anonymous downloads.
+DOWNLOAD_USER_LIMITS = {
+    'ADMIN': None,
+    'USER': {'rate': 50 * 1024 * 1024, 'concurrent': 4},
+    'GUEST': {'rate': 10 * 1024 * 1024, 'concurrent': 2},
+}
+DOWNLOAD_LINK_LIMITS = {
+    'ADMIN': {'rate': 200 * 1024 * 1024, 'concurrent': 100},
+    'USER': {'rate': 100 * 1024 * 1024, 'concurrent': 50},
+    'GUEST': {'rate': 20 * 1024 * 1024, 'concurrent': 10},
+}
+DOWNLOAD_IP_LIMITS = {'rate': 20 * 1024 * 1024, 'concurrent': 4}
+# How long a download over a concurrency limit waits for a slot before
+# getting 429, and the Retry-After it is sent
+DOWNLOAD_QUEUE_SECONDS = 0
+DOWNLOAD_RETRY_AFTER = 5
+
+# File versions (see filemanager/versions.py): content-defined chunk sizes
+# in bytes and how many versions of a file are kept. Quotas charge the
+# current version only; older versions share most of its chunks
+FILE_CHUNK_SIZES = {'min': 256 * 1024, 'avg': 1024 * 1024, 'max': 4 * 1024 * 1024}
+FILE_VERSIONS_KEPT = int(os.getenv('FILE_VERSIONS_KEPT', '10'))
+# Bytes of uploaded chunks a user may hold before committing a version that
+# uses them; they also count against the quota meanwhile
+PENDING_CHUNKS_MAX_BYTES = int(os.getenv('PENDING_CHUNKS_MAX_BYTES', str(1024 ** 3)))
+# Encrypted blobs up to this many bytes are kept in the File row instead of
+# the storage (see filemanager/blobs.py); 0 stores every blob in the storage
+INLINE_BLOB_MAX_BYTES = int(os.getenv('INLINE_BLOB_MAX_BYTES', str(16 * 1024)))
+
+# Seconds the file list, shared list and check-auth payloads are cached per
+# user (see core/responsecache.py); 0 disables the cache. Off by default
+# without Redis: a database cache lookup costs more queries than it saves
+RESPONSE_CACHE_TIMEOUT = int(os.getenv('RESPONSE_CACHE_TIMEOUT', '300' if os.getenv('REDIS_URL') else '0'))
+# Rows the storage dashboard's totals and daily counts are split over (see
+# filemanager/stats.py); more rows mean less contention between uploads
+STORAGE_STATS_SHARDS = 8
+# Check refresh tokens against an in-process Bloom filter of revoked tokens
+# before the blacklist table (see accounts/revocation.py). Off by default
+# without Redis: reading the shared generation costs a query itself
+REVOCATION_FILTER = os.getenv('REVOCATION_FILTER', '1' if os.getenv('REDIS_URL') else '0') == '1'
+REVOCATION_FILTER_MAX_AGE = 3600
+# How often each worker adds its counters to the shared metrics (core/metrics.py)
+METRICS_FLUSH_SECONDS = 10
+# Download access log (see filemanager/audit.py): events are queued in
+# process and written in batches. When the queue is full AUDIT_OVERFLOW
+# 'drop' discards new events, 'block' waits up to AUDIT_BLOCK_SECONDS first
+AUDIT_QUEUE_SIZE = 10000
+AUDIT_BATCH_SIZE = 500
+AUDIT_FLUSH_INTERVAL = 1.0
+AUDIT_OVERFLOW = os.getenv('AUDIT_OVERFLOW', 'drop')
+AUDIT_BLOCK_SECONDS = 0.05
+AUDIT_BACKGROUND_FLUSH = True
+
+# Request profiles captured on demand by admins (see core/profiling.py)
+PROFILE_ROOT = os.getenv('PROFILE_ROOT', os.path.join(BASE_DIR, 'profiles'))
+
 def get_env_value(env_variable):
     try:
         return os.environ[env_variable]
@@ -257,6 +389,40 @@ FILE_ENCRYPTION_KEY = os.getenv('FILE_ENCRYPTION_KEY')
 if not FILE_ENCRYPTION_KEY:
     raise ImproperlyConfigured('FILE_ENCRYPTION_KEY environment variable is required')
 
+# Additional master keys as "id:secret,id:secret"; FILE_ENCRYPTION_KEY is the
+# key with id 'default'. Every blob records the id of the key it was
+# encrypted with, so retired keys stay here until rotate_encryption_key has
+# re-encrypted everything under FILE_ENCRYPTION_KEY_ID.
+FILE_ENCRYPTION_KEYS = {}
+for entry in filter(None, os.getenv('FILE_ENCRYPTION_KEYS', '').split(',')):
+    key_id, _, secret = entry.partition(':')
+    FILE_ENCRYPTION_KEYS[key_id.strip()] = secret.strip()
+FILE_ENCRYPTION_KEY_ID = os.getenv('FILE_ENCRYPTION_KEY_ID', 'default')
+if FILE_ENCRYPTION_KEY_ID != 'default' and FILE_ENCRYPTION_KEY_ID not in FILE_ENCRYPTION_KEYS:
+    raise ImproperlyConfigured(f'FILE_ENCRYPTION_KEY_ID {FILE_ENCRYPTION_KEY_ID} is not in FILE_ENCRYPTION_KEYS')
+
+# Share links are handed out signed (see filemanager/signedlinks.py) and
+# checked without the database. Extra signing keys as "id:secret,id:secret"
+# (ids without dots); the key with id 'default' is derived from SECRET_KEY
+SIGNED_SHARE_LINKS = os.getenv('SIGNED_SHARE_LINKS', '1') == '1'
+SHARE_LINK_KEYS = {}
+for entry in filter(None, os.getenv('SHARE_LINK_KEYS', '').split(',')):
+    key_id, _, secret = entry.partition(':')
+    SHARE_LINK_KEYS[key_id.strip()] = secret.strip()
+SHARE_LINK_KEY_ID = os.getenv('SHARE_LINK_KEY_ID', 'default')
+if SHARE_LINK_KEY_ID != 'default' and SHARE_LINK_KEY_ID not in SHARE_LINK_KEYS:
+    raise ImproperlyConfigured(f'SHARE_LINK_KEY_ID {SHARE_LINK_KEY_ID} is not in SHARE_LINK_KEYS')
+# Seconds a process keeps a linked file's metadata, and between reloads of
+# the list of deleted links
+SIGNED_LINK_FILE_CACHE_SECONDS = 60
+SIGNED_LINK_FILE_CACHE_SIZE = 1024
+SIGNED_LINK_REVOCATION_REFRESH = 5
+# Days expired share links are kept (the access log refers to them) before
+# purge_expired_links deletes them, and how many dead link ids each process
+# remembers so repeat requests for them skip the database
+SHARE_LINK_RETENTION_DAYS = int(os.getenv('SHARE_LINK_RETENTION_DAYS', '30'))
+REJECTED_LINK_CACHE_SIZE = 10000
+
 # CSRF Settings
 CSRF_COOKIE_SAMESITE = 'Lax'
 CSRF_COOKIE_HTTPONLY = False
@@ -335,4 +501,8 @@ if 'test' in sys.argv:
     SECURE_HSTS_SECONDS = 0
     SECURE_HSTS_INCLUDE_SUBDOMAINS = False
     SECURE_HSTS_PRELOAD = False
-    MEDIA_ROOT = os.path.join(BASE_DIR, 'media_test')
\ No newline at end of file
+    MEDIA_ROOT = os.path.join(BASE_DIR, 'media_test')
+    PROFILE_ROOT = os.path.join(BASE_DIR, 'profiles_test')
+    # Tests write the access log with audit.flush(); a flusher thread would
+    # write outside the test's transaction
+    AUDIT_BACKGROUND_FLUSH = False
\ No newline at end of file
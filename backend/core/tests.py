@@ -0,0 +1,176 @@
+from django.conf import settings
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+from accounts.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from filemanager.models import File
+from filemanager.utils import encrypt_file
+from django.core.cache import cache
+from unittest.mock import patch
+from .cache import SlidingWindowCounter, incr_with_ttl
+from .middleware import duplicate_shapes
+from .renderers import FastJSONRenderer
+from rest_framework.renderers import JSONRenderer
+import datetime
+import uuid
+import shutil
+
+
+class RequestProfilerTests(TestCase):
+    def setUp(self):
+        """Set up an admin and a regular user with JWT cookies"""
+        self.client = APIClient()
+        self.admin_user = User.objects.create_user(email='admin@example.com', password='adminpass123')
+        self.user = User.objects.create_user(email='user@example.com', password='userpass123')
+
+    def login(self, user):
+        self.client.cookies[settings.SIMPLE_JWT['AUTH_COOKIE']] = str(AccessToken.for_user(user))
+
+    def test_admin_can_profile_request(self):
+        """Test an admin request with the profile header is stored and retrievable"""
+        self.login(self.admin_user)
+        response = self.client.get(reverse('file-list'), HTTP_X_PROFILE='cprofile')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        profile_id = response['X-Profile-Id']
+
+        response = self.client.get(reverse('profile-detail', kwargs={'profile_id': profile_id}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['path'], reverse('file-list'))
+        self.assertGreater(response.data['query_count'], 0)
+        self.assertIn('stats', response.data)
+
+        response = self.client.get(reverse('profile-list'))
+        self.assertEqual([profile['id'] for profile in response.data], [profile_id])
+
+    def test_sampling_profile_via_query_flag(self):
+        """Test the sampling profiler can be triggered from the query string"""
+        self.login(self.admin_user)
+        response = self.client.get(reverse('file-list') + '?_profile=sample')
+        self.assertIn('X-Profile-Id', response)
+
+    def test_non_admin_is_not_profiled(self):
+        """Test the profile flag is ignored for non-admins and the API is admin only"""
+        self.login(self.user)
+        response = self.client.get(reverse('file-list'), HTTP_X_PROFILE='cprofile')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('X-Profile-Id', response)
+
+        response = self.client.get(reverse('profile-list'))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_streaming_download_profiled_until_closed(self):
+        """Test a download's profile covers decrypting the body and is stored once it is closed"""
+        file_obj = File.objects.create(
+            uploaded_by=self.admin_user,
+            file=SimpleUploadedFile('profiled.enc', encrypt_file(b'profile me' * 1000)),
+            original_name='profiled.txt',
+            file_size=10000,
+            content_type='text/plain',
+        )
+        self.addCleanup(lambda: file_obj.file.delete(save=False))
+        self.login(self.admin_user)
+        response = self.client.get(
+            reverse('file-download', kwargs={'file_id': str(file_obj.id)}), HTTP_X_PROFILE='cprofile'
+        )
+        profile_url = reverse('profile-detail', kwargs={'profile_id': response['X-Profile-Id']})
+        self.assertEqual(self.client.get(profile_url).status_code, status.HTTP_404_NOT_FOUND)
+
+        self.assertEqual(b''.join(response.streaming_content), b'profile me' * 1000)
+        response.close()
+        report = self.client.get(profile_url).data
+        self.assertIn('decrypt_stream', report['stats'])
+
+    def tearDown(self):
+        shutil.rmtree(settings.PROFILE_ROOT, ignore_errors=True)
+
+
+class QueryBudgetMiddlewareTests(TestCase):
+    def test_headers_when_enabled(self):
+        """Test query count and time headers are added in instrumented mode"""
+        user = User.objects.create_user(email='user@example.com', password='userpass123')
+        with override_settings(QUERY_INSTRUMENTATION=True):
+            client = APIClient()
+            client.cookies[settings.SIMPLE_JWT['AUTH_COOKIE']] = str(AccessToken.for_user(user))
+            response = client.get(reverse('file-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertGreater(int(response['X-Query-Count']), 0)
+        self.assertIn('X-Query-Time-Ms', response)
+        self.assertEqual(response['X-Query-Duplicates'], '0')
+
+    def test_headers_absent_when_disabled(self):
+        """Test the middleware is a pass-through when instrumentation is off"""
+        with override_settings(QUERY_INSTRUMENTATION=False):
+            response = APIClient().get(reverse('check-auth'))
+        self.assertNotIn('X-Query-Count', response)
+
+    def test_duplicate_shapes(self):
+        """Test queries differing only in params or IN-list length share a shape"""
+        queries = [
+            {'sql': 'SELECT * FROM t WHERE id = %s'},
+            {'sql': 'SELECT * FROM t WHERE id = %s'},
+            {'sql': 'SELECT * FROM t WHERE id IN (%s, %s)'},
+            {'sql': 'SELECT * FROM t WHERE id IN (%s)'},
+        ]
+        self.assertEqual(duplicate_shapes(queries, 2), {
+            'SELECT * FROM t WHERE id = %s': 2,
+            'SELECT * FROM t WHERE id IN (...)': 2,
+        })
+
+
+class SharedCacheTests(TestCase):
+    def test_database_cache_incr(self):
+        """Test incr on the database cache updates in place and rejects missing keys"""
+        cache.set('counter', 5, 60)
+        self.assertEqual(cache.incr('counter', 3), 8)
+        self.assertEqual(cache.get('counter'), 8)
+        with self.assertRaises(ValueError):
+            cache.incr('missing')
+
+    def test_incr_with_ttl(self):
+        """Test incr_with_ttl creates then increments a counter"""
+        self.assertEqual(incr_with_ttl('hits', 60), 1)
+        self.assertEqual(incr_with_ttl('hits', 60), 2)
+
+    def test_sliding_window_weights_previous_bucket(self):
+        """Test the previous bucket counts in proportion to its overlap"""
+        counter = SlidingWindowCounter('test', limit=10, window=100)
+        with patch.object(SlidingWindowCounter, '_now', return_value=1050.0):
+            for _ in range(4):
+                counter.hit('client')
+        with patch.object(SlidingWindowCounter, '_now', return_value=1125.0):
+            self.assertEqual(counter.hit('client'), 1 + 4 * 0.75)
+        with patch.object(SlidingWindowCounter, '_now', return_value=1300.0):
+            self.assertEqual(counter.count('client'), 0)
+
+    def test_login_throttle(self):
+        """Test login is throttled after 20 attempts from one IP"""
+        client = APIClient()
+        data = {'email': 'nobody@example.com', 'password': 'wrongpass'}
+        for _ in range(20):
+            response = client.post(reverse('login'), data, format='json')
+            self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        response = client.post(reverse('login'), data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertIn('Retry-After', response)
+
+
+class FastJSONRendererTests(TestCase):
+    def test_matches_json_renderer(self):
+        """Test FastJSONRenderer renders the same bytes as DRF's JSONRenderer"""
+        data = {
+            'id': uuid.uuid4(),
+            'name': 'caf\u00e9 \U0001f600 \u2028"quoted"\n',
+            'when': datetime.datetime(2024, 5, 1, 12, 30, 15, 123456, tzinfo=datetime.timezone.utc),
+            'items': [1, -2, True, False, None, {'nested': []}],
+            'huge': 2 ** 70,
+        }
+        for payload in (data, [data, data], {}, 'text', 3, None):
+            self.assertEqual(FastJSONRenderer().render(payload), JSONRenderer().render(payload))
+
+    def test_indent_falls_back(self):
+        """Test a requested indent is honoured through JSONRenderer"""
+        rendered = FastJSONRenderer().render({'a': 1}, 'application/json; indent=2')
+        self.assertEqual(rendered, b'{\n  "a": 1\n}')
@@ -21,12 +21,17 @@ from django.conf.urls.static import static
 from django.views.generic.base import RedirectView
 from django.contrib.staticfiles.storage import staticfiles_storage
 from rest_framework_simplejwt.views import TokenRefreshView
+from .profiling import ProfileListView, ProfileDetailView
+from .views import MetricsView
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('accounts/', include('accounts.urls')),
     path('files/', include('filemanager.urls')),
     path('token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
+    path('profiles/', ProfileListView.as_view(), name='profile-list'),
+    path('profiles/<str:profile_id>/', ProfileDetailView.as_view(), name='profile-detail'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
     path(
         'favicon.ico',
         RedirectView.as_view(url=staticfiles_storage.url('favicon.ico')),
@@ -0,0 +1,12 @@
+from rest_framework.exceptions import PermissionDenied
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from .profiling import AdminOnlyMixin
+from . import responsecache
+
+
+class MetricsView(AdminOnlyMixin, APIView):
+    def get(self, request):
+        if request.user.role != 'ADMIN':
+            raise PermissionDenied("Only admins can access metrics")
+        return Response({'response_cache': responsecache.stats()})
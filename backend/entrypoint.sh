@@ -3,5 +3,19 @@
 # Apply database migrations
 python manage.py migrate
 
-# Start the server
+# Create the shared cache table (no-op when it exists or Redis is used)
+python manage.py createcachetable
+
+# Prune expired refresh tokens, share links and unused version chunks hourly
+# in the background
+python manage.py prune_tokens --every 3600 --pause 0.1 &
+python manage.py purge_expired_links --every 3600 --pause 0.1 &
+python manage.py prune_chunks --every 3600 &
+
+# Serve the /ws/ WebSocket routes from Daphne on port 8001. HTTP stays on
+# the WSGI server: under ASGI Django buffers a streaming response in full
+# before sending it, which would undo the streamed, paced downloads
+daphne -e ssl:8001:interface=0.0.0.0:privateKey=/app/certificates/localhost.key:certKey=/app/certificates/localhost.crt core.asgi:application &
+
+# Start the WSGI server for HTTP
 exec python manage.py runserver_plus --cert-file /app/certificates/localhost.crt --key-file /app/certificates/localhost.key 0.0.0.0:8000 
\ No newline at end of file
@@ -0,0 +1,217 @@
+"""Access log of downloads, written in batches off the request path.
+
+Download views wrap their response body in track(), which counts the
+bytes sent and, when the response is closed, puts an AccessEvent on a
+bounded in-process queue. A flusher thread writes the queue with
+bulk_create every AUDIT_FLUSH_INTERVAL seconds or AUDIT_BATCH_SIZE events,
+so a download never waits for an INSERT.
+
+When the queue is full (the database is slow or down) AUDIT_OVERFLOW
+decides: 'drop' discards the event at once, 'block' makes the request
+wait up to AUDIT_BLOCK_SECONDS for room first. Dropped events are counted
+in the metrics. Whatever is still queued is written when the process
+exits.
+"""
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+import atexit
+import logging
+import queue
+import threading
+import time
+from core import metrics
+from core.pagination import InvalidCursor, decode_cursor, encode_cursor
+from .models import AccessEvent
+
+logger = logging.getLogger(__name__)
+
+METRICS = ('audit.written', 'audit.dropped')
+FIELDS = ('id', 'kind', 'file_id', 'link_id', 'user_id', 'ip', 'bytes', 'duration_ms', 'completed', 'occurred_at')
+
+
+class AuditBuffer:
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=getattr(settings, 'AUDIT_QUEUE_SIZE', 10000))
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopping = threading.Event()
+        # Serializes writers so flush() and the thread don't split a batch
+        self.write_lock = threading.Lock()
+
+    def put(self, event):
+        try:
+            if getattr(settings, 'AUDIT_OVERFLOW', 'drop') == 'block':
+                self.queue.put(event, timeout=getattr(settings, 'AUDIT_BLOCK_SECONDS', 0.05))
+            else:
+                self.queue.put_nowait(event)
+        except queue.Full:
+            metrics.incr('audit.dropped')
+            return False
+        self._ensure_thread()
+        return True
+
+    def _ensure_thread(self):
+        if self.thread is not None or not getattr(settings, 'AUDIT_BACKGROUND_FLUSH', True):
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='audit-flusher', daemon=True)
+                self.thread.start()
+
+    def drain(self, limit=None):
+        """Take up to limit queued events without waiting"""
+        events = []
+        while limit is None or len(events) < limit:
+            try:
+                events.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return events
+
+    def _next_batch(self, batch_size, interval):
+        """Wait for the first event, then collect for at most interval seconds"""
+        try:
+            events = [self.queue.get(timeout=interval)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + interval
+        while len(events) < batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                events.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return events
+
+    def write(self, events):
+        if not events:
+            return 0
+        with self.write_lock:
+            try:
+                AccessEvent.objects.bulk_create(events, batch_size=getattr(settings, 'AUDIT_BATCH_SIZE', 500))
+            except Exception as e:
+                logger.error(f"Failed to write {len(events)} access events: {str(e)}")
+                metrics.incr('audit.dropped', len(events))
+                return 0
+        metrics.incr('audit.written', len(events))
+        return len(events)
+
+    def _run(self):
+        while not self.stopping.is_set():
+            batch = self._next_batch(
+                getattr(settings, 'AUDIT_BATCH_SIZE', 500),
+                getattr(settings, 'AUDIT_FLUSH_INTERVAL', 1.0),
+            )
+            try:
+                self.write(batch)
+            finally:
+                if batch:
+                    close_old_connections()
+
+    def flush(self):
+        """Write everything queued so far from the calling thread; returns the number written"""
+        written = 0
+        while events := self.drain(getattr(settings, 'AUDIT_BATCH_SIZE', 500)):
+            written += self.write(events)
+        return written
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(timeout=getattr(settings, 'AUDIT_FLUSH_INTERVAL', 1.0) * 2)
+        self.flush()
+
+
+buffer = AuditBuffer()
+
+
+@atexit.register
+def _flush_on_exit():
+    try:
+        buffer.stop()
+    except Exception as e:
+        logger.error(f"Failed to flush access events on exit: {str(e)}")
+
+
+def flush():
+    return buffer.flush()
+
+
+def client_ip(request):
+    return request.META.get('REMOTE_ADDR') or None
+
+
+class TrackedStream:
+    """Response body that records an AccessEvent once the response is closed.
+
+    Like governor.GovernedStream, a class so that close() runs even if
+    iteration never started.
+    """
+
+    def __init__(self, chunks, event, expected_bytes=None):
+        self.chunks = chunks
+        self.event = event
+        self.expected_bytes = expected_bytes
+        self.started = time.monotonic()
+        self.finished = False
+        self.recorded = False
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            self.event.bytes += len(chunk)
+            yield chunk
+        self.finished = True
+
+    def close(self):
+        try:
+            close = getattr(self.chunks, 'close', None)
+            if close:
+                close()
+        finally:
+            if not self.recorded:
+                self.recorded = True
+                self.event.duration_ms = int((time.monotonic() - self.started) * 1000)
+                self.event.completed = self.finished and (
+                    self.expected_bytes is None or self.event.bytes == self.expected_bytes
+                )
+                buffer.put(self.event)
+
+
+def track(chunks, request, file_obj, link=None, expected_bytes=None):
+    """Wrap a download body so the download is logged when the response closes"""
+    user = request.user
+    event = AccessEvent(
+        kind='LINK' if link is not None else 'DOWNLOAD',
+        file_id=file_obj.pk,
+        link_id=link.pk if link is not None else None,
+        user_id=user.pk if user.is_authenticated else None,
+        ip=client_ip(request),
+        occurred_at=timezone.now(),
+    )
+    return TrackedStream(chunks, event, expected_bytes)
+
+
+def stats():
+    """Written and dropped totals, and the events this process has queued"""
+    return {**{name.split('.', 1)[1]: count for name, count in metrics.read(METRICS).items()},
+            'queued': buffer.queue.qsize()}
+
+
+def page(queryset, cursor, limit):
+    """Return (rows, next_cursor), newest first by id"""
+    queryset = queryset.order_by('-id')
+    if cursor:
+        values = decode_cursor(cursor)
+        try:
+            queryset = queryset.filter(id__lt=int(values[0]))
+        except (IndexError, TypeError, ValueError):
+            raise InvalidCursor('Invalid cursor')
+    rows = list(queryset.values(*FIELDS)[:limit + 1])
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([rows[-1]['id']])
+    return rows, next_cursor
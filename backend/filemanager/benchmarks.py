@@ -0,0 +1,265 @@
+"""Micro-benchmarks for the crypto helpers in filemanager.utils and the file listings.
+
+Every crypto case is timed in isolation so a download can be broken down
+into key derivation, cipher work and the padding/concatenation copies.
+Run them with ``python manage.py bench_crypto``; the listing cases, which
+compare FileSerializer with listing.file_rows(), with
+``python manage.py bench_listing``.
+"""
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+import json
+import os
+import statistics
+import time
+import tracemalloc
+import types
+import uuid
+from django.conf import settings
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+from core.renderers import FastJSONRenderer
+from . import utils
+
+DEFAULT_SIZES = [4 * 1024, 256 * 1024, 4 * 1024 * 1024]
+CHUNK_SIZE = 64 * 1024
+
+
+def _cbc_encrypt(key, data):
+    """AES-CBC with the same padding scheme as utils.encrypt_file"""
+    iv = os.urandom(16)
+    encryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).encryptor()
+    padding_length = 16 - (len(data) % 16)
+    padded_data = data + bytes([padding_length] * padding_length)
+    return iv + encryptor.update(padded_data) + encryptor.finalize()
+
+
+def _cbc_decrypt(key, blob):
+    decryptor = Cipher(algorithms.AES(key), modes.CBC(blob[:16])).decryptor()
+    decrypted_data = decryptor.update(blob[16:]) + decryptor.finalize()
+    return decrypted_data[:-decrypted_data[-1]]
+
+
+def _cbc_chunked_encrypt(key, data):
+    """AES-CBC fed in CHUNK_SIZE slices, padding only the final block"""
+    iv = os.urandom(16)
+    encryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).encryptor()
+    view = memoryview(data)
+    tail_start = len(data) - (len(data) % 16)
+    parts = [iv]
+    for offset in range(0, tail_start, CHUNK_SIZE):
+        parts.append(encryptor.update(view[offset:min(offset + CHUNK_SIZE, tail_start)]))
+    padding_length = 16 - (len(data) % 16)
+    parts.append(encryptor.update(bytes(view[tail_start:]) + bytes([padding_length] * padding_length)))
+    parts.append(encryptor.finalize())
+    return b''.join(parts)
+
+
+def _cbc_chunked_decrypt(key, blob):
+    decryptor = Cipher(algorithms.AES(key), modes.CBC(blob[:16])).decryptor()
+    view = memoryview(blob)[16:]
+    parts = []
+    for offset in range(0, len(view), CHUNK_SIZE):
+        parts.append(decryptor.update(view[offset:offset + CHUNK_SIZE]))
+    parts.append(decryptor.finalize())
+    data = b''.join(parts)
+    return data[:-data[-1]]
+
+
+def _aead_encrypt(aead_class, key, data):
+    nonce = os.urandom(12)
+    return nonce + aead_class(key).encrypt(nonce, data, None)
+
+
+def _aead_decrypt(aead_class, key, blob):
+    return aead_class(key).decrypt(blob[:12], blob[12:], None)
+
+
+def _gcm_chunked_encrypt(key, data):
+    """AES-GCM frames of CHUNK_SIZE, each sealed with prefix + counter nonce"""
+    aead = AESGCM(key)
+    prefix = os.urandom(8)
+    view = memoryview(data)
+    parts = [prefix]
+    for index, offset in enumerate(range(0, max(len(data), 1), CHUNK_SIZE)):
+        nonce = prefix + index.to_bytes(4, 'big')
+        parts.append(aead.encrypt(nonce, bytes(view[offset:offset + CHUNK_SIZE]), None))
+    return b''.join(parts)
+
+
+def _gcm_chunked_decrypt(key, blob):
+    aead = AESGCM(key)
+    prefix = blob[:8]
+    view = memoryview(blob)[8:]
+    frame_size = CHUNK_SIZE + 16
+    parts = []
+    for index, offset in enumerate(range(0, len(view), frame_size)):
+        nonce = prefix + index.to_bytes(4, 'big')
+        parts.append(aead.decrypt(nonce, bytes(view[offset:offset + frame_size]), None))
+    return b''.join(parts)
+
+
+# mode name -> (encrypt(key, data), decrypt(key, blob)); all take a derived key
+CIPHER_MODES = {
+    'aes-cbc': (_cbc_encrypt, _cbc_decrypt),
+    'aes-cbc-chunked': (_cbc_chunked_encrypt, _cbc_chunked_decrypt),
+    'aes-gcm': (
+        lambda key, data: _aead_encrypt(AESGCM, key, data),
+        lambda key, blob: _aead_decrypt(AESGCM, key, blob),
+    ),
+    'aes-gcm-chunked': (_gcm_chunked_encrypt, _gcm_chunked_decrypt),
+    'chacha20-poly1305': (
+        lambda key, data: _aead_encrypt(ChaCha20Poly1305, key, data),
+        lambda key, blob: _aead_decrypt(ChaCha20Poly1305, key, blob),
+    ),
+}
+
+
+def measure(func, payload_size, repeat=5):
+    """Time func() `repeat` times and trace the peak memory of one extra call.
+
+    Peak traced memory is what the copies of the payload cost. tracemalloc
+    can't count allocations freed again during the call, so none are reported.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    seconds = statistics.median(timings)
+    return {
+        'seconds': seconds,
+        'mb_per_s': (payload_size / (1024 * 1024)) / seconds if seconds and payload_size else None,
+        'peak_bytes': peak,
+    }
+
+
+def run_benchmarks(sizes=None, modes_to_run=None, repeat=5, include_kdf=True):
+    """Run every benchmark case and return a list of result dicts"""
+    sizes = sizes or DEFAULT_SIZES
+    modes_to_run = modes_to_run or list(CIPHER_MODES)
+    password = settings.FILE_ENCRYPTION_KEY
+    key = utils.generate_key(password, os.urandom(16))
+    results = []
+
+    if include_kdf:
+        salt = os.urandom(16)
+        stats = measure(lambda: utils.generate_key(password, salt), 0, repeat=max(1, repeat // 2))
+        results.append({'op': 'kdf', 'mode': 'pbkdf2-sha256', 'size': 0, **stats})
+
+    for size in sizes:
+        data = os.urandom(size)
+
+        # The real helpers, KDF included, so changes to utils.py show up here
+        blob = utils.encrypt_file(data)
+        results.append({'op': 'encrypt', 'mode': 'utils', 'size': size,
+                        **measure(lambda: utils.encrypt_file(data), size, repeat)})
+        results.append({'op': 'decrypt', 'mode': 'utils', 'size': size,
+                        **measure(lambda: utils.decrypt_file(blob), size, repeat)})
+
+        for mode in modes_to_run:
+            encrypt, decrypt = CIPHER_MODES[mode]
+            sealed = encrypt(key, data)
+            if decrypt(key, sealed) != data:
+                raise AssertionError(f'{mode} failed to round-trip {size} bytes')
+            results.append({'op': 'encrypt', 'mode': mode, 'size': size,
+                            **measure(lambda: encrypt(key, data), size, repeat)})
+            results.append({'op': 'decrypt', 'mode': mode, 'size': size,
+                            **measure(lambda: decrypt(key, sealed), size, repeat)})
+
+    return results
+
+
+def _listing_cases(queryset, user):
+    from .serializers import FileSerializer
+    from .listing import file_rows
+    context = {'request': types.SimpleNamespace(user=user)}
+    return {
+        'serializer+json': lambda: JSONRenderer().render(FileSerializer(queryset, many=True, context=context).data),
+        'rows+json': lambda: JSONRenderer().render(file_rows(queryset, user)),
+        'rows+orjson': lambda: FastJSONRenderer().render(file_rows(queryset, user)),
+    }
+
+
+def run_listing_benchmarks(row_counts=(10000,), repeat=3):
+    """Time the list and shared endpoints' serialization over generated files.
+
+    The files are created inside a transaction that is rolled back, so this
+    can run against a real database. Raises AssertionError if the fast path
+    renders different bytes than FileSerializer.
+    """
+    from accounts.models import User
+    from .models import File, FileShare
+    from .views import with_share_permission
+
+    results = []
+    for rows in row_counts:
+        with transaction.atomic():
+            suffix = uuid.uuid4().hex[:8]
+            owner = User.objects.create(email=f'bench-owner-{suffix}@example.com', role='USER')
+            sharee = User.objects.create(email=f'bench-sharee-{suffix}@example.com', role='USER')
+            files = File.objects.bulk_create((
+                File(
+                    uploaded_by=owner,
+                    name=f'report-{index}.pdf',
+                    file=f'blobs/bench/{index}.enc',
+                    original_name=f'report-{index}.pdf',
+                    file_size=index * 37,
+                    content_type='application/pdf',
+                ) for index in range(rows)
+            ), batch_size=1000)
+            # Every other file is shared for download, the rest view-only
+            FileShare.objects.bulk_create((
+                FileShare(file=file, user=sharee, permission='DOWNLOAD' if index % 2 else 'VIEW')
+                for index, file in enumerate(files)
+            ), batch_size=1000)
+
+            endpoints = {
+                'list': (with_share_permission(File.objects.filter(uploaded_by=owner), owner), owner),
+                'shared': (with_share_permission(File.objects.filter(shares__user=sharee), sharee), sharee),
+            }
+            for endpoint, (queryset, user) in endpoints.items():
+                cases = _listing_cases(queryset, user)
+                outputs = {mode: func() for mode, func in cases.items()}
+                for mode, output in outputs.items():
+                    if output != outputs['serializer+json']:
+                        raise AssertionError(f'{endpoint} {mode} output differs from FileSerializer')
+                for mode, func in cases.items():
+                    stats = measure(func, len(outputs[mode]), repeat)
+                    results.append({'op': endpoint, 'mode': mode, 'size': rows, **stats})
+            transaction.set_rollback(True)
+    return results
+
+
+def result_key(result):
+    return f"{result['op']}:{result['mode']}:{result['size']}"
+
+
+def find_regressions(results, baseline, tolerance=0.25):
+    """Return the cases that got slower than baseline by more than tolerance"""
+    regressions = []
+    for result in results:
+        previous = baseline.get(result_key(result))
+        if not previous:
+            continue
+        if result['seconds'] > previous['seconds'] * (1 + tolerance):
+            regressions.append((result, previous))
+    return regressions
+
+
+def load_baseline(path):
+    with open(path) as f:
+        return {result_key(result): result for result in json.load(f)}
+
+
+def save_baseline(path, results):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
@@ -0,0 +1,134 @@
+"""Storing and reading server-encrypted file contents."""
+import hashlib
+import io
+import itertools
+import logging
+import uuid
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db.models import F
+from .models import Chunk, File, VersionChunk
+from .utils import CHUNK_SIZE, decrypt_blocks, decrypt_file, decrypt_stream, derive_key, read_chunks
+
+logger = logging.getLogger(__name__)
+
+
+class BlobCorrupted(Exception):
+    pass
+
+
+def blob_checksum(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def store_blob(file_obj, encrypted_data):
+    """Attach an encrypted blob to an unsaved File: in the row if small, else in the storage"""
+    if len(encrypted_data) <= getattr(settings, 'INLINE_BLOB_MAX_BYTES', 16 * 1024):
+        file_obj.inline_blob = encrypted_data
+    else:
+        file_obj.file.save(f"{uuid.uuid4().hex}.enc", ContentFile(encrypted_data), save=False)
+
+
+def discard_blob(file_obj):
+    """Remove the stored blob of a File whose row was never saved"""
+    if file_obj.file:
+        file_obj.file.delete(save=False)
+
+
+def _blob_fields(instance, field):
+    # Metadata describing a blob has to be reloaded together with its path
+    if isinstance(instance, (File, Chunk)):
+        return [field, 'checksum', 'key_id']
+    return [field, 'key_id']
+
+
+def open_blob(instance, field='file'):
+    """Open the encrypted blob behind a File (or another model's FileField).
+
+    Small File blobs are read from the row (see store_blob). Others are
+    opened through the storage rather than the FieldFile so concurrent
+    readers of the same File each get their own handle. If the blob has
+    been moved since the row was loaded (see filemanager.layout) the path
+    is reloaded and the open retried once.
+    """
+    fieldfile = getattr(instance, field)
+    if not fieldfile and isinstance(instance, File) and instance.inline_blob is not None:
+        return io.BytesIO(bytes(instance.inline_blob))
+    try:
+        return fieldfile.storage.open(fieldfile.name, 'rb')
+    except FileNotFoundError:
+        instance.refresh_from_db(fields=_blob_fields(instance, field))
+        fieldfile = getattr(instance, field)
+        return fieldfile.storage.open(fieldfile.name, 'rb')
+
+
+def _check(instance, digest):
+    expected = getattr(instance, 'checksum', '')
+    if expected and digest != expected:
+        logger.error(f"Checksum mismatch for {instance.__class__.__name__} {instance.pk}")
+        raise BlobCorrupted(f'Stored blob of {instance.pk} is corrupted')
+
+
+def read_blob(instance, field='file'):
+    """Read a whole encrypted blob into memory, verifying its checksum"""
+    with open_blob(instance, field) as f:
+        data = f.read()
+    _check(instance, blob_checksum(data))
+    return data
+
+
+def iter_verified(instance, chunk_size=CHUNK_SIZE):
+    """Yield a File's encrypted blob in chunks, raising BlobCorrupted at the end on mismatch"""
+    hasher = hashlib.sha256()
+    with open_blob(instance) as f:
+        for chunk in read_chunks(f, chunk_size):
+            hasher.update(chunk)
+            yield chunk
+    _check(instance, hasher.hexdigest())
+
+
+def iter_decrypted(file_obj, chunk_size=CHUNK_SIZE, offset=0):
+    """Yield a File's decrypted contents chunk by chunk, optionally from offset"""
+    if file_obj.version:
+        yield from iter_version(file_obj.pk, file_obj.version, chunk_size, offset)
+        return
+    if offset:
+        yield from _iter_decrypted_from(file_obj, offset, chunk_size)
+        return
+    chunks = iter_verified(file_obj, chunk_size)
+    # Opening the blob may reload the row, so read key_id only after that
+    first = next(chunks, b'')
+    yield from decrypt_stream(itertools.chain([first], chunks), file_obj.key_id)
+
+
+def _iter_decrypted_from(file_obj, offset, chunk_size):
+    # In CBC the previous ciphertext block is the IV of the next, so reading
+    # can start at any block without decrypting what comes before it. The
+    # checksum covers the whole blob and can't be checked from the middle.
+    with open_blob(file_obj) as f:
+        header = f.read(32)
+        if len(header) < 32:
+            raise ValueError("Encrypted data is truncated")
+        salt, iv = header[:16], header[16:]
+        block, skip = divmod(offset, 16)
+        if block:
+            f.seek(32 + 16 * (block - 1))
+            iv = f.read(16)
+        key = derive_key(file_obj.key_id, salt)
+        for chunk in decrypt_blocks(key, iv, read_chunks(f, chunk_size)):
+            if skip:
+                chunk, skip = chunk[skip:], max(0, skip - len(chunk))
+            if chunk:
+                yield chunk
+
+
+def iter_version(file_id, number, chunk_size=CHUNK_SIZE, offset=0):
+    """Yield the decrypted contents of a FileVersion by walking its manifest"""
+    entries = VersionChunk.objects.filter(version__file_id=file_id, version__number=number)
+    if offset:
+        # Start at the chunk that contains offset
+        entries = entries.alias(end=F('offset') + F('chunk__size')).filter(end__gt=offset)
+    for entry in entries.select_related('chunk').order_by('position').iterator(chunk_size=100):
+        data = decrypt_file(read_blob(entry.chunk, 'blob'), entry.chunk.key_id)
+        for start in range(max(offset - entry.offset, 0), len(data), chunk_size):
+            yield data[start:start + chunk_size]
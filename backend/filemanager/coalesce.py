@@ -0,0 +1,133 @@
+"""Single-flight downloads: one decrypt stream per file, shared by every reader.
+
+When many requests download the same File at once (a share link sent to a
+mailing list), the first one starts a SharedStream whose producer thread
+reads and decrypts the blob once into a small ring buffer; every other
+request joining while the first chunk is still buffered reads from that
+buffer instead of deriving the key and decrypting again.
+
+The producer runs at most COALESCE_LEAD_CHUNKS ahead of the fastest reader
+and never waits for slow ones. A reader that falls further behind than the
+ring (COALESCE_BUFFER_CHUNKS) is detached and continues on a private stream
+that starts at its current offset, so one slow client can't stall the rest.
+Coalescing is per process; each worker process shares its own streams.
+"""
+from django.conf import settings
+from django.db import close_old_connections
+from collections import deque
+import copy
+import itertools
+import threading
+from .blobs import iter_decrypted
+
+# Counters for tests and monitoring
+stats = {'streams': 0, 'subscribers': 0, 'detached': 0}
+
+_streams = {}
+_lock = threading.Lock()
+
+
+class SharedStream:
+    def __init__(self, key, file_obj, capacity, lead):
+        self.key = key
+        self.file_obj = file_obj
+        self.capacity = capacity
+        self.lead = lead
+        self.cond = threading.Condition()
+        self.buffer = deque()
+        self.base = 0  # sequence number of buffer[0]
+        self.head = 0  # sequence number of the next chunk to produce
+        self.positions = {}  # reader id -> next sequence number it will read
+        self.done = False
+        self.error = None
+        self._ids = itertools.count()
+
+    def join(self):
+        """Register a reader starting at the first chunk; None once that has left the ring"""
+        with self.cond:
+            if self.base or self.done:
+                return None
+            reader_id = next(self._ids)
+            self.positions[reader_id] = 0
+            return reader_id
+
+    def start(self):
+        threading.Thread(target=self._produce, daemon=True, name='coalesce').start()
+
+    def _produce(self):
+        try:
+            for chunk in iter_decrypted(self.file_obj):
+                with self.cond:
+                    while self.positions and self.head - max(self.positions.values()) >= self.lead:
+                        self.cond.wait()
+                    if not self.positions:
+                        # Every reader finished or disconnected
+                        break
+                    self.buffer.append(chunk)
+                    self.head += 1
+                    if len(self.buffer) > self.capacity:
+                        self.buffer.popleft()
+                        self.base += 1
+                    self.cond.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            with self.cond:
+                self.done = True
+                self.cond.notify_all()
+            with _lock:
+                if _streams.get(self.key) is self:
+                    del _streams[self.key]
+            close_old_connections()
+
+    def read(self, reader_id, fallback):
+        """Yield the stream for one reader; fallback(offset) takes over if it is detached"""
+        seq = 0
+        offset = 0
+        try:
+            while True:
+                with self.cond:
+                    while seq >= self.head and not self.done:
+                        self.cond.wait()
+                    if seq < self.base:
+                        break
+                    if seq >= self.head:
+                        if self.error is not None:
+                            raise self.error
+                        return
+                    chunk = self.buffer[seq - self.base]
+                    seq += 1
+                    self.positions[reader_id] = seq
+                    self.cond.notify_all()
+                yield chunk
+                offset += len(chunk)
+        finally:
+            with self.cond:
+                self.positions.pop(reader_id, None)
+                self.cond.notify_all()
+
+        stats['detached'] += 1
+        yield from fallback(offset)
+
+
+def stream_file(file_obj):
+    """Iterate a File's decrypted contents, sharing the work with concurrent readers"""
+    key = (file_obj.pk, file_obj.version, file_obj.file.name, file_obj.key_id)
+    capacity = getattr(settings, 'COALESCE_BUFFER_CHUNKS', 64)
+    lead = getattr(settings, 'COALESCE_LEAD_CHUNKS', 8)
+
+    with _lock:
+        shared = _streams.get(key)
+        reader_id = shared.join() if shared else None
+        started = reader_id is None
+        if started:
+            # Nobody to join, or the running stream is too far along
+            shared = SharedStream(key, copy.copy(file_obj), capacity, lead)
+            reader_id = shared.join()
+            _streams[key] = shared
+            stats['streams'] += 1
+        stats['subscribers'] += 1
+    if started:
+        shared.start()
+
+    return shared.read(reader_id, lambda offset: iter_decrypted(file_obj, offset=offset))
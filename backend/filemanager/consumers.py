@@ -0,0 +1,27 @@
+from asgiref.sync import async_to_sync
+from channels.generic.websocket import JsonWebsocketConsumer
+from .events import group_name
+
+
+class FileEventsConsumer(JsonWebsocketConsumer):
+    """Streams file events (uploads, shares, deletions, upload progress) to one user"""
+
+    def connect(self):
+        user = self.scope.get('user')
+        if user is None or not user.is_authenticated:
+            self.close(code=4401)
+            return
+        self.group = group_name(user.pk)
+        async_to_sync(self.channel_layer.group_add)(self.group, self.channel_name)
+        self.accept()
+
+    def disconnect(self, code):
+        if hasattr(self, 'group'):
+            async_to_sync(self.channel_layer.group_discard)(self.group, self.channel_name)
+
+    def receive_json(self, content, **kwargs):
+        # The socket is push-only
+        pass
+
+    def file_event(self, message):
+        self.send_json(message['event'])
@@ -0,0 +1,48 @@
+"""Pushing file events to users' WebSocket connections.
+
+Every connected client joins the group of its user (see consumers.py); the
+helpers here send to those groups through the channel layer, so the file
+list can be kept up to date without polling.
+"""
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def group_name(user_id):
+    return f'files.user.{user_id}'
+
+
+def file_payload(file_obj):
+    return {
+        'id': str(file_obj.id),
+        'original_name': file_obj.original_name,
+        'file_size': file_obj.file_size,
+        'content_type': file_obj.content_type,
+        'uploaded_at': file_obj.uploaded_at.isoformat() if file_obj.uploaded_at else None,
+        'uploaded_by': file_obj.uploaded_by_id,
+    }
+
+
+def push(user_ids, event):
+    """Send event to every socket of the given users right away"""
+    layer = get_channel_layer()
+    if layer is None:
+        return
+    message = {'type': 'file.event', 'event': event}
+    for user_id in set(user_ids):
+        try:
+            async_to_sync(layer.group_send)(group_name(user_id), message)
+        except Exception as e:
+            # Live updates are best effort; the REST endpoints stay authoritative
+            logger.warning(f"Failed to push {event['type']} to user {user_id}: {str(e)}")
+
+
+def send_event(user_ids, event_type, **data):
+    """Push an event once the current transaction commits"""
+    user_ids = list(user_ids)
+    event = {'type': event_type, **data}
+    transaction.on_commit(lambda: push(user_ids, event))
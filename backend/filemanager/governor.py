@@ -0,0 +1,166 @@
+"""Bandwidth and concurrency limits for downloads.
+
+Every download is a Transfer governed by up to three scopes: the
+downloading user (by role), the share link (by its creator's role) and,
+for anonymous requests, the client IP. A scope may cap the number of
+concurrent transfers and the bytes per second they share.
+
+Concurrency slots are counters in the shared cache, so the cap holds
+across worker processes. Bandwidth is a token bucket per scope kept in
+process memory: pacing every chunk through the cache would cost a round
+trip per 64 KiB, so with several workers each one enforces the rate on its
+own share of the transfers.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from collections import OrderedDict
+import threading
+import time
+from core.cache import incr_with_ttl
+
+# Safety net for slots leaked by a worker that died mid-transfer
+SLOT_TTL = 60 * 60
+MAX_BUCKETS = 10000
+
+
+class TransferLimited(Exception):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Bytes-per-second bucket holding up to one second of burst"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        """Take amount tokens and return how long to sleep to stay under the rate"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+
+_buckets = OrderedDict()
+_buckets_lock = threading.Lock()
+
+
+def get_bucket(scope, ident, rate):
+    key = (scope, ident, rate)
+    with _buckets_lock:
+        bucket = _buckets.get(key)
+        if bucket is None:
+            bucket = _buckets[key] = TokenBucket(rate)
+            if len(_buckets) > MAX_BUCKETS:
+                _buckets.popitem(last=False)
+        else:
+            _buckets.move_to_end(key)
+        return bucket
+
+
+def _slot_key(scope, ident):
+    return f'download_slots:{scope}:{ident}'
+
+
+class Transfer:
+    def __init__(self, limits):
+        # [(scope, ident, {'rate': ..., 'concurrent': ...}), ...]
+        self.limits = [(scope, ident, limit) for scope, ident, limit in limits if limit]
+        self.held = []
+        self.buckets = [
+            get_bucket(scope, ident, limit['rate'])
+            for scope, ident, limit in self.limits if limit.get('rate')
+        ]
+
+    def _try_acquire(self):
+        for scope, ident, limit in self.limits:
+            concurrent = limit.get('concurrent')
+            if not concurrent:
+                continue
+            key = _slot_key(scope, ident)
+            if incr_with_ttl(key, SLOT_TTL) > concurrent:
+                cache.decr(key)
+                self.release()
+                return scope
+            self.held.append(key)
+        return None
+
+    def acquire(self):
+        """Take a slot in every scope, waiting up to DOWNLOAD_QUEUE_SECONDS"""
+        deadline = time.monotonic() + getattr(settings, 'DOWNLOAD_QUEUE_SECONDS', 0)
+        while True:
+            scope = self._try_acquire()
+            if scope is None:
+                return
+            if time.monotonic() >= deadline:
+                raise TransferLimited(
+                    f'Too many concurrent downloads for this {scope}',
+                    getattr(settings, 'DOWNLOAD_RETRY_AFTER', 5),
+                )
+            time.sleep(0.25)
+
+    def release(self):
+        for key in self.held:
+            try:
+                cache.decr(key)
+            except ValueError:
+                # Slot counter expired (SLOT_TTL) while we held it
+                pass
+        self.held = []
+
+    def throttle(self, chunks):
+        return GovernedStream(self, chunks)
+
+
+class GovernedStream:
+    """Response body that paces chunks through a Transfer's buckets.
+
+    A class rather than a generator so that close(), which Django calls
+    when the response is done, frees the slots even if iteration never
+    started.
+    """
+
+    def __init__(self, transfer, chunks):
+        self.transfer = transfer
+        self.chunks = chunks
+
+    def __iter__(self):
+        buckets = self.transfer.buckets
+        for chunk in self.chunks:
+            delay = max((bucket.consume(len(chunk)) for bucket in buckets), default=0)
+            if delay:
+                time.sleep(delay)
+            yield chunk
+
+    def close(self):
+        self.transfer.release()
+        close = getattr(self.chunks, 'close', None)
+        if close:
+            close()
+
+
+def limits_for(request, link=None):
+    """The governed scopes of one download request"""
+    limits = []
+    user = request.user
+    if user.is_authenticated:
+        limits.append(('user', user.pk, getattr(settings, 'DOWNLOAD_USER_LIMITS', {}).get(user.role)))
+    else:
+        limits.append(('ip', request.META.get('REMOTE_ADDR'), getattr(settings, 'DOWNLOAD_IP_LIMITS', None)))
+    if link is not None:
+        limits.append(('link', link.pk, getattr(settings, 'DOWNLOAD_LINK_LIMITS', {}).get(link.creator_role)))
+    return limits
+
+
+def start_transfer(request, link=None):
+    """Acquire the slots for a download; raises TransferLimited when over a limit"""
+    transfer = Transfer(limits_for(request, link))
+    transfer.acquire()
+    return transfer
@@ -0,0 +1,73 @@
+"""Plumbing shared by the maintenance commands that walk every blob.
+
+migrate_blob_layout, scrub_blobs and friends all page through File ids,
+hand each one to a small thread pool and have to stay under a rate so the
+service keeps its I/O while they run.
+"""
+from django.db import close_old_connections
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import threading
+import time
+
+
+class RateLimiter:
+    """Spaces work out to at most `rate` units per second across threads.
+
+    A unit is whatever the caller passes to wait(): one file, or one byte
+    when used as an I/O budget.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_at = 0
+        self.lock = threading.Lock()
+
+    def wait(self, amount=1):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_at - now
+            self.next_at = max(now, self.next_at) + self.interval * amount
+        if delay > 0:
+            time.sleep(delay)
+
+
+def iter_pks(queryset, batch_size=500):
+    """Yield the pks of queryset in pk order, one keyset batch at a time"""
+    last_pk = None
+    while True:
+        batch = queryset.order_by('pk')
+        if last_pk is not None:
+            batch = batch.filter(pk__gt=last_pk)
+        pks = list(batch.values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return
+        last_pk = pks[-1]
+        yield from pks
+
+
+def run_pool(func, items, workers=4, name='job'):
+    """Call func(item) for every item on a pool of `workers` threads.
+
+    Submission is bounded so memory stays flat however many items there
+    are. With workers=1 everything runs on the calling thread.
+    """
+    if workers <= 1:
+        for item in items:
+            func(item)
+        return
+
+    def run(item):
+        try:
+            func(item)
+        finally:
+            close_old_connections()
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name) as executor:
+        pending = set()
+        for item in items:
+            pending.add(executor.submit(run, item))
+            if len(pending) >= workers * 4:
+                _, pending = wait(pending, return_when=FIRST_COMPLETED)
+        wait(pending)
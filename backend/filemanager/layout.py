@@ -0,0 +1,114 @@
+"""Moving blobs from the per-email layout to the sharded one.
+
+New uploads go to ``blobs/ab/cd/<name>`` (see models.blob_path). Older blobs
+sit under ``encrypted_files/<email>/`` until ``migrate_blob_layout`` moves
+them. Each move copies the blob, points the row at the copy with a
+conditional UPDATE and only then deletes the original, so a reader always
+finds one of the two paths (open_blob reloads the row if its path vanished)
+and an interrupted run can simply be started again.
+"""
+import itertools
+import logging
+import os
+import threading
+import time
+from .jobs import RateLimiter, iter_pks, run_pool
+from .models import BLOB_ROOT, File, FilePreview, blob_path, preview_path
+
+logger = logging.getLogger(__name__)
+
+
+def is_sharded(name):
+    return name.startswith(f'{BLOB_ROOT}/')
+
+
+def copy_blob(storage, old_name, new_name):
+    """Copy old_name to new_name, reusing a complete copy left by an earlier run"""
+    if storage.exists(new_name):
+        if storage.size(new_name) == storage.size(old_name):
+            return
+        storage.delete(new_name)
+    with storage.open(old_name, 'rb') as src:
+        saved_name = storage.save(new_name, src)
+    if saved_name != new_name:
+        storage.delete(saved_name)
+        raise OSError(f'Storage renamed {new_name} to {saved_name}')
+
+
+def _move_preview(file_obj):
+    try:
+        preview = FilePreview.objects.get(file_id=file_obj.pk)
+    except FilePreview.DoesNotExist:
+        return
+    old_name = preview.blob.name
+    if not old_name or is_sharded(old_name):
+        return
+    preview.file = file_obj
+    new_name = preview_path(preview, os.path.basename(old_name))
+    storage = preview.blob.storage
+    copy_blob(storage, old_name, new_name)
+    if FilePreview.objects.filter(pk=preview.pk, blob=old_name).update(blob=new_name):
+        storage.delete(old_name)
+    else:
+        storage.delete(new_name)
+
+
+def migrate_file(file_id, dry_run=False):
+    """Move one File's blob (and its preview) to the sharded layout.
+
+    Returns True if the file was (or, with dry_run, would be) moved.
+    """
+    try:
+        file_obj = File.objects.get(pk=file_id)
+    except File.DoesNotExist:
+        return False
+    old_name = file_obj.file.name
+    if is_sharded(old_name):
+        return False
+    if dry_run:
+        return True
+
+    new_name = blob_path(file_obj, os.path.basename(old_name))
+    storage = file_obj.file.storage
+    copy_blob(storage, old_name, new_name)
+
+    # Only repoint rows that still reference the old blob
+    if not File.objects.filter(pk=file_id, file=old_name).update(file=new_name):
+        storage.delete(new_name)
+        return False
+    storage.delete(old_name)
+
+    file_obj.file.name = new_name
+    _move_preview(file_obj)
+    return True
+
+
+def legacy_file_ids(batch_size=500):
+    """Yield ids of Files still on the old layout, in pk batches"""
+    return iter_pks(File.objects.exclude(file__startswith=f'{BLOB_ROOT}/').exclude(file=''), batch_size)
+
+
+def migrate_all(workers=4, rate=0, batch_size=500, dry_run=False, limit=None):
+    """Move every legacy blob; returns {'moved', 'skipped', 'failed', 'seconds'}"""
+    limiter = RateLimiter(rate)
+    stats = {'moved': 0, 'skipped': 0, 'failed': 0}
+    stats_lock = threading.Lock()
+    start = time.monotonic()
+
+    def work(file_id):
+        limiter.wait()
+        try:
+            result = 'moved' if migrate_file(file_id, dry_run=dry_run) else 'skipped'
+        except Exception as e:
+            logger.error(f"Failed to move blob of file {file_id}: {str(e)}")
+            result = 'failed'
+        with stats_lock:
+            stats[result] += 1
+
+    file_ids = legacy_file_ids(batch_size)
+    if limit:
+        file_ids = itertools.islice(file_ids, limit)
+    run_pool(work, file_ids, workers=workers, name='blob-layout')
+
+    stats['seconds'] = round(time.monotonic() - start, 3)
+    return stats
@@ -0,0 +1,64 @@
+"""Expired share links: purging them, and turning away repeat requests for them.
+
+Links live at most a day but their rows were never removed. The purger
+deletes links that expired more than SHARE_LINK_RETENTION_DAYS ago, so
+the access log can still resolve recent link ids, in batches read off the
+expires_at index. The storage statistics are adjusted once per batch.
+
+Public link ids that turned out expired or missing are remembered per
+process. An expiry can't be extended and ids aren't reused, so repeated
+requests for a dead link are answered without a query.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from collections import OrderedDict
+from datetime import timedelta
+import threading
+import time
+from .models import RevokedLink, ShareableLink
+from . import stats
+
+
+def purge_expired(retention_days=None, batch_size=1000, pause=0, dry_run=False):
+    """Delete links expired more than retention_days ago; returns the number removed"""
+    if retention_days is None:
+        retention_days = getattr(settings, 'SHARE_LINK_RETENTION_DAYS', 30)
+    now = timezone.now()
+    expired = ShareableLink.objects.filter(expires_at__lt=now - timedelta(days=retention_days))
+    if dry_run:
+        return expired.count()
+    removed = 0
+    while ids := list(expired.order_by('expires_at').values_list('pk', flat=True)[:batch_size]):
+        with transaction.atomic(), stats.batched():
+            removed += ShareableLink.objects.filter(pk__in=ids).delete()[1].get(ShareableLink._meta.label, 0)
+        if pause:
+            time.sleep(pause)
+    # Revocations only matter until the link would have expired
+    RevokedLink.objects.filter(expires_at__lte=now).delete()
+    return removed
+
+
+class RejectedLinks:
+    """Least recently used link ids known to be expired or missing, with the error to answer"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, link_id):
+        with self.lock:
+            rejection = self.entries.get(link_id)
+            if rejection:
+                self.entries.move_to_end(link_id)
+            return rejection
+
+    def add(self, link_id, status_code, error):
+        with self.lock:
+            self.entries[link_id] = (status_code, error)
+            self.entries.move_to_end(link_id)
+            while len(self.entries) > getattr(settings, 'REJECTED_LINK_CACHE_SIZE', 10000):
+                self.entries.popitem(last=False)
+
+
+rejected = RejectedLinks()
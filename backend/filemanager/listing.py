@@ -0,0 +1,80 @@
+"""File listings built without model instances.
+
+The list and shared endpoints return every file a user can see, so the
+per-row cost of FileSerializer (three SerializerMethodFields and a related
+lookup through DRF's field machinery) dominates for large accounts. Here
+the permission flags are computed by the database next to the share
+permission annotation, rows come back as tuples from values_list(), and
+each becomes the same dict FileSerializer would have produced.
+
+Both endpoints are cached per user (see core/responsecache.py); invalidate()
+retires those caches when a file changes.
+"""
+from django.conf import settings
+from django.db.models import BooleanField, Case, F, Q, Value, When
+from django.utils import timezone
+from rest_framework import serializers
+from rest_framework.settings import api_settings
+from core import responsecache
+from .models import FileShare
+
+
+def _flag(condition):
+    # CASE rather than the bare condition: share_permission is NULL for
+    # unshared files, and NULL = 'DOWNLOAD' must come back as False
+    return Case(When(condition, then=Value(True)), default=Value(False), output_field=BooleanField())
+
+
+def _datetime_field():
+    # FileSerializer's uploaded_at field, with the format and time zone it
+    # would look up for every row resolved once
+    current = timezone.get_current_timezone() if settings.USE_TZ else None
+    return serializers.DateTimeField(format=api_settings.DATETIME_FORMAT, default_timezone=current)
+
+
+def file_rows(queryset, user):
+    """FileSerializer(queryset, many=True).data for a with_share_permission() queryset"""
+    is_owner = Q(uploaded_by_id=user.pk)
+    if user.role == 'ADMIN':
+        can_download = can_manage = Value(True, output_field=BooleanField())
+    else:
+        can_download = _flag(is_owner | Q(share_permission='DOWNLOAD'))
+        can_manage = _flag(is_owner)
+    rows = queryset.annotate(
+        owner_email=F('uploaded_by__email'),
+        row_is_owner=_flag(is_owner),
+        row_can_download=can_download,
+        row_can_manage=can_manage,
+    ).values_list(
+        'id', 'name', 'original_name', 'file_size', 'uploaded_at', 'owner_email',
+        'row_is_owner', 'row_can_download', 'row_can_manage', 'version',
+    )
+    datetime = _datetime_field().to_representation
+    # Keys in FileSerializer.Meta.fields order, so the JSON is byte-identical
+    return [
+        {
+            'id': str(file_id),
+            'name': name,
+            'original_name': original_name,
+            'file_size': file_size,
+            'uploaded_at': datetime(uploaded_at),
+            'owner_email': owner_email,
+            'is_owner': is_owner,
+            'can_download': can_download,
+            'can_manage': can_manage,
+            'version': version,
+        }
+        for (file_id, name, original_name, file_size, uploaded_at, owner_email,
+             is_owner, can_download, can_manage, version) in rows
+    ]
+
+
+def invalidate(owner_id, file_id=None):
+    """Retire the cached lists showing a file: its owner's, admins' and, given file_id, its sharees'"""
+    if not responsecache.enabled():
+        return
+    names = [responsecache.user_token(owner_id), responsecache.FILES]
+    if file_id is not None:
+        sharees = FileShare.objects.filter(file_id=file_id).values_list('user_id', flat=True)
+        names += [responsecache.user_token(user_id) for user_id in sharees]
+    responsecache.invalidate(names)
@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand, CommandError
+from filemanager import benchmarks
+
+
+class Command(BaseCommand):
+    help = 'Benchmark key derivation, encryption and decryption across sizes and cipher modes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=str, default='',
+                            help='Comma separated payload sizes in bytes')
+        parser.add_argument('--modes', type=str, default='',
+                            help=f"Comma separated modes ({', '.join(benchmarks.CIPHER_MODES)})")
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--baseline', type=str,
+                            help='Fail if any case is slower than this saved baseline')
+        parser.add_argument('--tolerance', type=float, default=0.25,
+                            help='Allowed slowdown against the baseline (0.25 = 25%%)')
+        parser.add_argument('--save', type=str, help='Write the results as a new baseline')
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',') if size]
+        modes = [mode for mode in options['modes'].split(',') if mode]
+        unknown = set(modes) - set(benchmarks.CIPHER_MODES)
+        if unknown:
+            raise CommandError(f"Unknown modes: {', '.join(sorted(unknown))}")
+
+        results = benchmarks.run_benchmarks(sizes=sizes, modes_to_run=modes, repeat=options['repeat'])
+
+        self.stdout.write(f"{'op':<8} {'mode':<18} {'size':>10} {'ms':>10} {'MB/s':>10} {'peak KiB':>10}")
+        for result in results:
+            mb_per_s = f"{result['mb_per_s']:.1f}" if result['mb_per_s'] else '-'
+            self.stdout.write(
+                f"{result['op']:<8} {result['mode']:<18} {result['size']:>10} "
+                f"{result['seconds'] * 1000:>10.2f} {mb_per_s:>10} "
+                f"{result['peak_bytes'] / 1024:>10.1f}"
+            )
+
+        if options['save']:
+            benchmarks.save_baseline(options['save'], results)
+            self.stdout.write(f"Baseline written to {options['save']}")
+
+        if options['baseline']:
+            baseline = benchmarks.load_baseline(options['baseline'])
+            regressions = benchmarks.find_regressions(results, baseline, options['tolerance'])
+            for result, previous in regressions:
+                self.stderr.write(
+                    f"Regression in {benchmarks.result_key(result)}: "
+                    f"{previous['seconds'] * 1000:.2f}ms -> {result['seconds'] * 1000:.2f}ms"
+                )
+            if regressions:
+                raise CommandError(f'{len(regressions)} benchmark case(s) regressed')
+            self.stdout.write(self.style.SUCCESS('No regressions against baseline'))
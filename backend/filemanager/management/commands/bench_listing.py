@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from filemanager import benchmarks
+
+
+class Command(BaseCommand):
+    help = 'Benchmark serializing the file list and shared endpoints at a given number of rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=str, default='10000,100000',
+                            help='Comma separated numbers of files to list')
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        row_counts = [int(rows) for rows in options['rows'].split(',') if rows]
+        results = benchmarks.run_listing_benchmarks(row_counts, repeat=options['repeat'])
+
+        self.stdout.write(f"{'endpoint':<8} {'mode':<16} {'rows':>8} {'ms':>10} {'rows/s':>10} {'peak MiB':>10}")
+        for result in results:
+            self.stdout.write(
+                f"{result['op']:<8} {result['mode']:<16} {result['size']:>8} "
+                f"{result['seconds'] * 1000:>10.1f} {result['size'] / result['seconds']:>10.0f} "
+                f"{result['peak_bytes'] / (1024 * 1024):>10.1f}"
+            )
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from filemanager import layout
+
+
+class Command(BaseCommand):
+    help = 'Move blobs from encrypted_files/<email>/ to the sharded blobs/ layout'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--rate', type=float, default=0, help='Max files per second (0 = unlimited)')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--limit', type=int, default=None, help='Stop after this many files')
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        stats = layout.migrate_all(
+            workers=options['workers'],
+            rate=options['rate'],
+            batch_size=options['batch_size'],
+            dry_run=options['dry_run'],
+            limit=options['limit'],
+        )
+        verb = 'Would move' if options['dry_run'] else 'Moved'
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {stats['moved']} blobs, skipped {stats['skipped']}, "
+            f"failed {stats['failed']} in {stats['seconds']}s"
+        ))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from filemanager import versions
+import time
+
+
+class Command(BaseCommand):
+    help = 'Remove version chunks that no file version refers to any more'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be removed')
+        parser.add_argument('--min-age', type=int, default=3600,
+                            help='Keep chunks stored within this many seconds (uploads in progress)')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--every', type=int, default=0,
+                            help='Keep running and prune every this many seconds')
+
+    def handle(self, *args, **options):
+        while True:
+            stats = versions.prune_chunks(
+                min_age=options['min_age'], dry_run=options['dry_run'], batch_size=options['batch_size']
+            )
+            verb = 'Would remove' if options['dry_run'] else 'Removed'
+            self.stdout.write(self.style.SUCCESS(f"{verb} {stats['removed']} chunks ({stats['bytes']} bytes)"))
+            if not options['every']:
+                return
+            time.sleep(options['every'])
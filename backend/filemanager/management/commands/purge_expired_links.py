@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from filemanager import links
+import time
+
+
+class Command(BaseCommand):
+    help = 'Delete share links that expired more than SHARE_LINK_RETENTION_DAYS ago'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report how many would be removed')
+        parser.add_argument('--retention-days', type=int, default=None,
+                            help='Keep links for this many days after they expire (default SHARE_LINK_RETENTION_DAYS)')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--pause', type=float, default=0, help='Seconds to wait between batches')
+        parser.add_argument('--every', type=int, default=0,
+                            help='Keep running and purge every this many seconds')
+
+    def handle(self, *args, **options):
+        while True:
+            removed = links.purge_expired(
+                retention_days=options['retention_days'], batch_size=options['batch_size'],
+                pause=options['pause'], dry_run=options['dry_run']
+            )
+            verb = 'Would remove' if options['dry_run'] else 'Removed'
+            self.stdout.write(self.style.SUCCESS(f"{verb} {removed} expired share links"))
+            if not options['every']:
+                return
+            time.sleep(options['every'])
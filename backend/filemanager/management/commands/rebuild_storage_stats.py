@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from filemanager import stats
+
+
+class Command(BaseCommand):
+    help = 'Recompute the per-user and overall storage statistics from the file, share and link tables'
+
+    def handle(self, *args, **options):
+        totals = stats.rebuild()
+        self.stdout.write(self.style.SUCCESS(
+            f"{totals['files']} files ({totals['bytes']} bytes), {totals['shares']} shares, {totals['links']} links"
+        ))
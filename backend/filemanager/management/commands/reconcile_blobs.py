@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from filemanager import reconcile
+
+
+class Command(BaseCommand):
+    help = 'Remove blobs no row points at and rows whose blob is missing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be removed')
+        parser.add_argument('--min-age', type=int, default=3600,
+                            help='Ignore blobs modified within this many seconds')
+        parser.add_argument('--quiet', action='store_true', help='Print only the summary')
+
+    def handle(self, *args, **options):
+        def report(kind, name):
+            if not options['quiet']:
+                self.stdout.write(f'{kind}: {name}')
+
+        stats = reconcile.reconcile(dry_run=options['dry_run'], min_age=options['min_age'], report=report)
+        self.stdout.write(self.style.SUCCESS(
+            f"Scanned {stats['blobs_scanned']} blobs and {stats['rows_scanned']} rows in "
+            f"{stats['seconds']}s ({stats['entries_per_s']}/s): {stats['orphans']} orphans "
+            f"({stats['orphan_bytes']} bytes), {stats['dangling']} dangling rows, "
+            f"{stats['removed']} removed, {stats['skipped_recent']} too recent"
+        ))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from filemanager import quotas
+
+
+class Command(BaseCommand):
+    help = 'Recompute per-user storage usage from the File table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        corrected = quotas.reconcile_usage(batch_size=options['batch_size'])
+        for user_id, recorded, actual in corrected:
+            self.stdout.write(f'User {user_id}: {recorded} -> {actual} bytes')
+        self.stdout.write(self.style.SUCCESS(f'Corrected {len(corrected)} users'))
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+from filemanager import rotation
+from filemanager.utils import current_key_id, get_master_key
+
+
+class Command(BaseCommand):
+    help = 'Re-encrypt every blob under the current master key (FILE_ENCRYPTION_KEY_ID)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--io-budget', type=float, default=20,
+                            help='Max MB/s read across all workers (0 = unlimited)')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        target = current_key_id()
+        in_use = rotation.keys_in_use()
+        try:
+            for key_id in [target, *in_use]:
+                get_master_key(key_id)
+        except ValueError as e:
+            raise CommandError(f'{e}; every key still in use must stay in FILE_ENCRYPTION_KEYS')
+
+        def progress(stats):
+            self.stdout.write(f"... {stats['rotated']} rotated, {stats['skipped']} skipped, {stats['failed']} failed")
+
+        stats = rotation.rotate(
+            target,
+            workers=options['workers'],
+            bytes_per_second=options['io_budget'] * 1024 * 1024,
+            batch_size=options['batch_size'],
+            progress=progress,
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Re-encrypted {stats['rotated']} files and chunks under key '{target}', skipped {stats['skipped']}, "
+            f"failed {stats['failed']} in {stats['seconds']}s"
+        ))
+
+        remaining = {key_id: count for key_id, count in rotation.keys_in_use().items() if key_id != target}
+        if remaining:
+            self.stdout.write(self.style.WARNING(f'Still in use: {remaining}; run again before retiring them'))
+        else:
+            self.stdout.write(self.style.SUCCESS('No blobs use older keys; they can be removed'))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from datetime import timedelta
+from filemanager import scrub
+
+
+class Command(BaseCommand):
+    help = 'Re-verify the checksums of stored blobs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age-days', type=float, default=30,
+                            help='Verify blobs not verified within this many days')
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--io-budget', type=float, default=20,
+                            help='Max MB/s read across all workers (0 = unlimited)')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        stats = scrub.scrub(
+            max_age=timedelta(days=options['max_age_days']),
+            workers=options['workers'],
+            bytes_per_second=options['io_budget'] * 1024 * 1024,
+            batch_size=options['batch_size'],
+        )
+        for file_id in stats['bad_file_ids']:
+            self.stdout.write(self.style.ERROR(f'Bad blob: file {file_id}'))
+        self.stdout.write(self.style.SUCCESS(
+            f"Verified {stats['ok']}, backfilled {stats['backfilled']}, corrupt {stats['corrupt']}, "
+            f"missing {stats['missing']}, failed {stats['failed']} in {stats['seconds']}s"
+        ))
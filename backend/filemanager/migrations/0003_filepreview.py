@@ -0,0 +1,27 @@
+# Generated by Django 5.1.4 on 2026-10-19 17:17
+
+import django.db.models.deletion
+import filemanager.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('filemanager', '0002_shareablelink'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FilePreview',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('blob', models.FileField(blank=True, upload_to=filemanager.models.preview_path)),
+                ('content_type', models.CharField(blank=True, max_length=100)),
+                ('status', models.CharField(choices=[('PENDING', 'Pending'), ('READY', 'Ready'), ('UNSUPPORTED', 'Unsupported'), ('FAILED', 'Failed')], default='PENDING', max_length=12)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('generated_at', models.DateTimeField(blank=True, null=True)),
+                ('file', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='preview', to='filemanager.file')),
+            ],
+        ),
+    ]
@@ -0,0 +1,69 @@
+from django.db import migrations
+
+# SQLite: an FTS5 table keyed by a 64-bit hash of File.id and filled by the
+# signal handlers in filemanager/signals.py. It is not tied to
+# filemanager_file's rowid, which SQLite migrations don't preserve when they
+# rebuild the table.
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE filemanager_file_fts USING fts5(
+        file_id UNINDEXED,
+        original_name,
+        content_type,
+        tokenize='unicode61',
+        prefix='2 3'
+    )
+    """,
+]
+
+SQLITE_REVERSE = [
+    "DROP TABLE IF EXISTS filemanager_file_fts",
+]
+
+# PostgreSQL: an expression index matching the to_tsvector() used by
+# filemanager.search, maintained by the database itself
+POSTGRES_FORWARD = [
+    """
+    CREATE INDEX filemanager_file_search_idx ON filemanager_file
+    USING GIN (to_tsvector('simple', original_name || ' ' || content_type))
+    """,
+]
+
+POSTGRES_REVERSE = [
+    "DROP INDEX IF EXISTS filemanager_file_search_idx",
+]
+
+
+def run(statements_by_vendor):
+    def apply(apps, schema_editor):
+        for statement in statements_by_vendor.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(statement)
+    return apply
+
+
+def index_existing_files(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    from filemanager.search import search_rowid
+    File = apps.get_model('filemanager', 'File')
+    rows = File.objects.values_list('id', 'original_name', 'content_type').iterator()
+    with schema_editor.connection.cursor() as cursor:
+        cursor.executemany(
+            "INSERT INTO filemanager_file_fts(rowid, file_id, original_name, content_type) VALUES (%s, %s, %s, %s)",
+            ((search_rowid(file_id), file_id.hex, name, content_type) for file_id, name, content_type in rows)
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('filemanager', '0003_filepreview'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run({'sqlite': SQLITE_FORWARD, 'postgresql': POSTGRES_FORWARD}),
+            run({'sqlite': SQLITE_REVERSE, 'postgresql': POSTGRES_REVERSE}),
+        ),
+        migrations.RunPython(index_existing_files, migrations.RunPython.noop),
+    ]
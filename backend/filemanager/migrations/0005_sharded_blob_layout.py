@@ -0,0 +1,19 @@
+# Generated by Django 5.1.4 on 2026-10-19 17:32
+
+import filemanager.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('filemanager', '0004_file_search_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='file',
+            name='file',
+            field=models.FileField(upload_to=filemanager.models.blob_path),
+        ),
+    ]
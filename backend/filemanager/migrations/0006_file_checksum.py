@@ -0,0 +1,23 @@
+# Generated by Django 5.1.4 on 2026-10-19 17:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('filemanager', '0005_sharded_blob_layout'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='checksum',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='file',
+            name='last_verified_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
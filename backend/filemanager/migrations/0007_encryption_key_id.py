@@ -0,0 +1,23 @@
+# Generated by Django 5.1.4 on 2026-10-19 17:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('filemanager', '0006_file_checksum'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='key_id',
+            field=models.CharField(db_index=True, default='default', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='filepreview',
+            name='key_id',
+            field=models.CharField(default='default', max_length=32),
+        ),
+    ]
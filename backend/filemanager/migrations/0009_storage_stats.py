@@ -0,0 +1,63 @@
+# Generated by Django 5.1.4 on 2026-10-19 18:49
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def fill_rollups(apps, schema_editor):
+    from filemanager.stats import backfill_daily, rebuild
+    rebuild(apps.get_model)
+    backfill_daily(apps.get_model)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0007_user_role_email_index'),
+        ('filemanager', '0008_file_versions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StorageTotals',
+            fields=[
+                ('shard', models.PositiveSmallIntegerField(primary_key=True, serialize=False)),
+                ('files', models.BigIntegerField(default=0)),
+                ('bytes', models.BigIntegerField(default=0)),
+                ('shares', models.BigIntegerField(default=0)),
+                ('links', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DailyStorageStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('shard', models.PositiveSmallIntegerField()),
+                ('uploads', models.BigIntegerField(default=0)),
+                ('uploaded_bytes', models.BigIntegerField(default=0)),
+                ('deletions', models.BigIntegerField(default=0)),
+                ('deleted_bytes', models.BigIntegerField(default=0)),
+                ('shares', models.BigIntegerField(default=0)),
+                ('links', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('day', 'shard')},
+            },
+        ),
+        migrations.CreateModel(
+            name='UserStorageStats',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='storage_stats', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('files', models.BigIntegerField(default=0)),
+                ('bytes', models.BigIntegerField(default=0)),
+                ('shares', models.BigIntegerField(default=0)),
+                ('links', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['-bytes'], name='user_storage_bytes_idx')],
+            },
+        ),
+        migrations.RunPython(fill_rollups, migrations.RunPython.noop),
+    ]
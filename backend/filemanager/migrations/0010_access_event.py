@@ -0,0 +1,31 @@
+# Generated by Django 5.1.4 on 2026-10-19 18:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('filemanager', '0009_storage_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccessEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('DOWNLOAD', 'Download'), ('LINK', 'Shareable link download')], max_length=10)),
+                ('file_id', models.UUIDField()),
+                ('link_id', models.UUIDField(blank=True, null=True)),
+                ('user_id', models.BigIntegerField(blank=True, null=True)),
+                ('ip', models.GenericIPAddressField(blank=True, null=True)),
+                ('bytes', models.BigIntegerField(default=0)),
+                ('duration_ms', models.PositiveIntegerField(default=0)),
+                ('completed', models.BooleanField(default=False)),
+                ('occurred_at', models.DateTimeField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['file_id', '-id'], name='access_file_idx'), models.Index(fields=['user_id', '-id'], name='access_user_idx'), models.Index(fields=['link_id', '-id'], name='access_link_idx'), models.Index(fields=['occurred_at'], name='access_time_idx')],
+            },
+        ),
+    ]
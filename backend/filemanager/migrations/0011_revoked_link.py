@@ -0,0 +1,20 @@
+# Generated by Django 5.1.4 on 2026-10-19 19:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('filemanager', '0010_access_event'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RevokedLink',
+            fields=[
+                ('link_id', models.UUIDField(primary_key=True, serialize=False)),
+                ('expires_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
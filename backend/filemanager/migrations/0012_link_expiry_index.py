@@ -0,0 +1,19 @@
+# Generated by Django 5.1.4 on 2026-10-19 19:12
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('filemanager', '0011_revoked_link'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='shareablelink',
+            index=models.Index(fields=['expires_at'], name='link_expires_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-19 19:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('filemanager', '0012_link_expiry_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='inline_blob',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
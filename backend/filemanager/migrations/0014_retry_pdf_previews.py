@@ -0,0 +1,21 @@
+from django.db import migrations
+
+
+def forget_pdf_previews(apps, schema_editor):
+    # PDFs were marked unsupported while pypdfium2 was missing from
+    # requirements.txt; without a row the next request schedules them again
+    FilePreview = apps.get_model('filemanager', 'FilePreview')
+    FilePreview.objects.filter(
+        status='UNSUPPORTED', file__content_type='application/pdf', file__is_client_encrypted=False
+    ).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('filemanager', '0013_inline_blob'),
+    ]
+
+    operations = [
+        migrations.RunPython(forget_pdf_previews, migrations.RunPython.noop),
+    ]
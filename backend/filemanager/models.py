@@ -1,15 +1,25 @@
 from django.db import models
 from django.conf import settings
+import hashlib
 import os
 import uuid
 
+BLOB_ROOT = 'blobs'
+
 def user_directory_path(instance, filename):
+    # Legacy layout, still referenced by migrations and migrate_blob_layout
     return f'encrypted_files/{instance.uploaded_by.email}/{filename}'
 
+def blob_path(instance, filename):
+    # Fan out over 256 * 256 directories so no directory grows without bound,
+    # and keep the owner's email out of the path so it can change
+    digest = hashlib.sha256(filename.encode()).hexdigest()
+    return f'{BLOB_ROOT}/{digest[:2]}/{digest[2:4]}/{filename}'
+
 class File(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     name = models.CharField(max_length=255)
-    file = models.FileField(upload_to=user_directory_path)
+    file = models.FileField(upload_to=blob_path)
     uploaded_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     uploaded_at = models.DateTimeField(auto_now_add=True)
     file_size = models.BigIntegerField()
@@ -18,6 +28,17 @@ class File(models.Model):
     client_encryption_key = models.TextField(null=True, blank=True)
     client_encryption_iv = models.TextField(null=True, blank=True)
     is_client_encrypted = models.BooleanField(default=False)
+    # SHA-256 of the stored (encrypted) blob; blank for files uploaded before checksums
+    checksum = models.CharField(max_length=64, blank=True, default='')
+    last_verified_at = models.DateTimeField(null=True, blank=True)
+    # Id of the master key the blob is encrypted with (see FILE_ENCRYPTION_KEYS)
+    key_id = models.CharField(max_length=32, default='default', db_index=True)
+    # Number of the current FileVersion; 0 means the contents are the single
+    # blob in `file`, otherwise `file` is empty and the version's chunks hold them
+    version = models.PositiveIntegerField(default=0)
+    # Small blobs (up to INLINE_BLOB_MAX_BYTES) are stored here instead of in
+    # `file`, so reading them costs the row's query and no file open
+    inline_blob = models.BinaryField(null=True, blank=True, editable=False)
     
     class Meta:
         ordering = ['-uploaded_at']
@@ -55,4 +76,157 @@ class ShareableLink(models.Model):
     expires_at = models.DateTimeField()
     
     class Meta:
-        ordering = ['-created_at'] 
\ No newline at end of file
+        ordering = ['-created_at']
+        indexes = [
+            # The purger reads expired links in expiry order
+            models.Index(fields=['expires_at'], name='link_expires_idx'),
+        ]
+
+    @property
+    def creator_role(self):
+        return self.created_by.role
+
+
+class RevokedLink(models.Model):
+    """A share link deleted before it expired; signed links check this list (see signedlinks.py)"""
+    link_id = models.UUIDField(primary_key=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+def preview_path(instance, filename):
+    # Renditions live next to the blob they were generated from
+    if not instance.file.file:
+        # Versioned files have no single blob
+        return blob_path(instance, filename)
+    return os.path.join(os.path.dirname(instance.file.file.name), filename)
+
+class FilePreview(models.Model):
+    STATUS_CHOICES = [
+        ('PENDING', 'Pending'),
+        ('READY', 'Ready'),
+        ('UNSUPPORTED', 'Unsupported'),
+        ('FAILED', 'Failed'),
+    ]
+
+    file = models.OneToOneField(File, on_delete=models.CASCADE, related_name='preview')
+    blob = models.FileField(upload_to=preview_path, blank=True)
+    content_type = models.CharField(max_length=100, blank=True)
+    status = models.CharField(max_length=12, choices=STATUS_CHOICES, default='PENDING')
+    created_at = models.DateTimeField(auto_now_add=True)
+    generated_at = models.DateTimeField(null=True, blank=True)
+    key_id = models.CharField(max_length=32, default='default')
+
+    def __str__(self):
+        return f'Preview of {self.file_id}'
+
+class Chunk(models.Model):
+    """One content-defined chunk of a user's files, encrypted once.
+
+    Chunks are scoped to their owner so identical data uploaded by two users
+    is never shared (which would tell one that the other holds it).
+    """
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='chunks')
+    # SHA-256 of the plaintext
+    digest = models.CharField(max_length=64)
+    size = models.PositiveIntegerField()
+    blob = models.FileField(upload_to=blob_path)
+    # SHA-256 of the stored (encrypted) blob
+    checksum = models.CharField(max_length=64)
+    key_id = models.CharField(max_length=32, default='default', db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('owner', 'digest')
+
+    def __str__(self):
+        return self.digest
+
+class FileVersion(models.Model):
+    file = models.ForeignKey(File, on_delete=models.CASCADE, related_name='versions')
+    number = models.PositiveIntegerField()
+    size = models.BigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('file', 'number')
+        ordering = ['-number']
+
+    def __str__(self):
+        return f'{self.file_id} v{self.number}'
+
+class VersionChunk(models.Model):
+    """One entry of a version's manifest"""
+    version = models.ForeignKey(FileVersion, on_delete=models.CASCADE, related_name='entries')
+    position = models.PositiveIntegerField()
+    # Plaintext offset of the chunk within the version
+    offset = models.BigIntegerField()
+    # Chunks outlive versions; prune_chunks removes the unreferenced ones
+    chunk = models.ForeignKey(Chunk, on_delete=models.PROTECT, related_name='entries')
+
+    class Meta:
+        unique_together = ('version', 'position')
+        ordering = ['position']
+
+class UserStorageStats(models.Model):
+    """Running totals of one user's storage, kept by filemanager/stats.py"""
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, primary_key=True, related_name='storage_stats'
+    )
+    files = models.BigIntegerField(default=0)
+    bytes = models.BigIntegerField(default=0)
+    # Shares of other users' files with this user
+    shares = models.BigIntegerField(default=0)
+    # Shareable links this user created
+    links = models.BigIntegerField(default=0)
+
+    class Meta:
+        indexes = [models.Index(fields=['-bytes'], name='user_storage_bytes_idx')]
+
+class StorageTotals(models.Model):
+    """Overall totals, split over a few rows so uploads don't all update one row"""
+    shard = models.PositiveSmallIntegerField(primary_key=True)
+    files = models.BigIntegerField(default=0)
+    bytes = models.BigIntegerField(default=0)
+    shares = models.BigIntegerField(default=0)
+    links = models.BigIntegerField(default=0)
+
+class DailyStorageStats(models.Model):
+    """Activity per day, sharded like StorageTotals"""
+    day = models.DateField()
+    shard = models.PositiveSmallIntegerField()
+    uploads = models.BigIntegerField(default=0)
+    uploaded_bytes = models.BigIntegerField(default=0)
+    deletions = models.BigIntegerField(default=0)
+    deleted_bytes = models.BigIntegerField(default=0)
+    shares = models.BigIntegerField(default=0)
+    links = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('day', 'shard')
+
+class AccessEvent(models.Model):
+    """One download, written in batches by filemanager/audit.py"""
+    KIND_CHOICES = [
+        ('DOWNLOAD', 'Download'),
+        ('LINK', 'Shareable link download'),
+    ]
+
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    # Plain ids rather than foreign keys: the record has to outlive the
+    # file, the link and the user
+    file_id = models.UUIDField()
+    link_id = models.UUIDField(null=True, blank=True)
+    user_id = models.BigIntegerField(null=True, blank=True)
+    ip = models.GenericIPAddressField(null=True, blank=True)
+    bytes = models.BigIntegerField(default=0)
+    duration_ms = models.PositiveIntegerField(default=0)
+    # False when the client went away before the whole file was sent
+    completed = models.BooleanField(default=False)
+    occurred_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['file_id', '-id'], name='access_file_idx'),
+            models.Index(fields=['user_id', '-id'], name='access_user_idx'),
+            models.Index(fields=['link_id', '-id'], name='access_link_idx'),
+            models.Index(fields=['occurred_at'], name='access_time_idx'),
+        ]
@@ -0,0 +1,188 @@
+"""Reduced renditions of files for users with VIEW permission.
+
+A preview is generated once in a background thread after upload, encrypted
+with encrypt_file() and stored next to the original blob, so browsing a
+shared folder never needs the originals decrypted.
+"""
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+from concurrent.futures import ThreadPoolExecutor
+import io
+import logging
+import tempfile
+import uuid
+from .blobs import iter_decrypted
+from .models import FilePreview
+from .utils import current_key_id, encrypt_file
+
+logger = logging.getLogger(__name__)
+
+try:
+    from PIL import Image
+except ImportError:  # pragma: no cover - Pillow is in requirements.txt
+    Image = None
+
+try:
+    # Renders the first page of PDFs (in requirements.txt)
+    import pypdfium2
+except ImportError:  # pragma: no cover
+    pypdfium2 = None
+
+TEXT_CONTENT_TYPES = {
+    'application/json',
+    'application/xml',
+    'application/javascript',
+    'application/x-yaml',
+}
+
+_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, 'PREVIEW_WORKERS', 2),
+            thread_name_prefix='preview'
+        )
+    return _executor
+
+
+def _read_prefix(file_obj, limit):
+    data = bytearray()
+    for chunk in iter_decrypted(file_obj):
+        data += chunk
+        if len(data) >= limit:
+            break
+    return bytes(data[:limit])
+
+
+def _spool(file_obj):
+    """Decrypt into a temporary file, or None if larger than PREVIEW_MAX_SOURCE_BYTES"""
+    if file_obj.file_size > getattr(settings, 'PREVIEW_MAX_SOURCE_BYTES', 64 * 1024 * 1024):
+        return None
+    spooled = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    for chunk in iter_decrypted(file_obj):
+        spooled.write(chunk)
+    spooled.seek(0)
+    return spooled
+
+
+def render_image(file_obj):
+    if Image is None:
+        return None
+    size = getattr(settings, 'PREVIEW_IMAGE_SIZE', 256)
+    source = _spool(file_obj)
+    if source is None:
+        return None
+    with source, Image.open(source) as image:
+        # JPEGs are decoded at the smallest scale that still covers the thumbnail
+        image.draft('RGB', (size, size))
+        image.thumbnail((size, size))
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        output = io.BytesIO()
+        image.save(output, format='JPEG', quality=80)
+    return output.getvalue(), 'image/jpeg'
+
+
+def render_pdf(file_obj):
+    if pypdfium2 is None or Image is None:
+        return None
+    size = getattr(settings, 'PREVIEW_IMAGE_SIZE', 256)
+    source = _spool(file_obj)
+    if source is None:
+        return None
+    with source:
+        document = pypdfium2.PdfDocument(source)
+        try:
+            image = document[0].render(scale=1).to_pil()
+        finally:
+            document.close()
+    image.thumbnail((size, size))
+    output = io.BytesIO()
+    image.convert('RGB').save(output, format='JPEG', quality=80)
+    return output.getvalue(), 'image/jpeg'
+
+
+def render_text(file_obj):
+    limit = getattr(settings, 'PREVIEW_TEXT_BYTES', 16 * 1024)
+    text = _read_prefix(file_obj, limit).decode('utf-8', errors='replace')
+    return text.encode('utf-8'), 'text/plain; charset=utf-8'
+
+
+def get_renderer(content_type):
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    if content_type.startswith('image/'):
+        return render_image
+    if content_type == 'application/pdf':
+        return render_pdf
+    if content_type.startswith('text/') or content_type in TEXT_CONTENT_TYPES:
+        return render_text
+    return None
+
+
+def renderer_available(renderer):
+    """Whether the libraries a renderer needs are installed"""
+    if renderer is render_pdf:
+        return pypdfium2 is not None and Image is not None
+    if renderer is render_image:
+        return Image is not None
+    return True
+
+
+def generate_preview(file_id):
+    """Render, encrypt and store the preview of one file"""
+    try:
+        preview = FilePreview.objects.select_related('file').get(file_id=file_id)
+        file_obj = preview.file
+        renderer = get_renderer(file_obj.content_type)
+
+        if renderer and not renderer_available(renderer):
+            # Not UNSUPPORTED: the next request schedules it again, which
+            # renders it once the library is installed
+            preview.delete()
+            return
+
+        # Client-encrypted uploads are opaque to the server
+        rendition = None
+        if renderer and not file_obj.is_client_encrypted:
+            rendition = renderer(file_obj)
+
+        if rendition is None:
+            preview.status = 'UNSUPPORTED'
+        else:
+            data, content_type = rendition
+            key_id = current_key_id()
+            preview.blob.save(f'{uuid.uuid4().hex}.preview.enc', ContentFile(encrypt_file(data, key_id)), save=False)
+            preview.key_id = key_id
+            preview.content_type = content_type
+            preview.status = 'READY'
+        preview.generated_at = timezone.now()
+        preview.save()
+    except FilePreview.DoesNotExist:
+        pass
+    except Exception as e:
+        logger.error(f"Preview generation failed for file {file_id}: {str(e)}")
+        FilePreview.objects.filter(file_id=file_id).update(status='FAILED', generated_at=timezone.now())
+    finally:
+        close_old_connections()
+
+
+def _run_in_background(file_id):
+    get_executor().submit(generate_preview, file_id)
+
+
+def schedule_preview(file_obj):
+    """Queue preview generation once the upload's transaction commits"""
+    renderer = get_renderer(file_obj.content_type)
+    if renderer is None or file_obj.is_client_encrypted:
+        return FilePreview.objects.create(file=file_obj, status='UNSUPPORTED')
+    if not renderer_available(renderer):
+        # Left unsaved so the preview is retried once the library is installed
+        return FilePreview(file=file_obj, status='UNSUPPORTED')
+    preview = FilePreview.objects.create(file=file_obj)
+    transaction.on_commit(lambda: _run_in_background(file_obj.id))
+    return preview
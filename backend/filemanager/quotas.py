@@ -0,0 +1,96 @@
+"""Per-user storage quotas.
+
+User.storage_used is a running total kept in step with the File table by the
+post_save/post_delete handlers in filemanager/signals.py, so checking a
+quota never needs a SUM over the user's files. reconcile_storage_usage
+repairs any drift.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from contextlib import contextmanager
+from accounts.models import User
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+def get_quota(user):
+    """The user's quota in bytes, or None for unlimited"""
+    return quota_for(user.role, user.storage_quota)
+
+
+def quota_for(role, storage_quota):
+    """get_quota() for a row fetched with .values()"""
+    if storage_quota is not None:
+        return storage_quota
+    return getattr(settings, 'STORAGE_QUOTAS', {}).get(role)
+
+
+def add_usage(user_id, delta):
+    User.objects.filter(pk=user_id).update(storage_used=F('storage_used') + delta)
+
+
+def check_request_size(request):
+    """Reject an upload from its Content-Length before the body is parsed.
+
+    The body is the file plus multipart framing, so a small allowance is
+    subtracted; the exact check happens in reserve() once the size is known.
+    """
+    quota = get_quota(request.user)
+    if quota is None:
+        return
+    try:
+        content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return
+    overhead = getattr(settings, 'STORAGE_QUOTA_MULTIPART_OVERHEAD', 64 * 1024)
+    if content_length - overhead > quota - request.user.storage_used:
+        raise QuotaExceeded('Storage quota exceeded')
+
+
+@contextmanager
+def reserve(user, size):
+    """Hold the user's row lock while the new File row is inserted.
+
+    The File post_save handler adds the size in the same transaction, so
+    concurrent uploads by one user can't both squeeze under the quota.
+    """
+    with transaction.atomic():
+        locked = User.objects.select_for_update().only('role', 'storage_used', 'storage_quota').get(pk=user.pk)
+        quota = get_quota(locked)
+        if quota is not None and locked.storage_used + size > quota:
+            raise QuotaExceeded('Storage quota exceeded')
+        yield
+
+
+def reconcile_usage(batch_size=500):
+    """Recompute storage_used from the File table and fix any drift.
+
+    Users are processed in pk batches; each user's row is locked while
+    its total is recomputed so uploads in flight can't be double counted.
+    Returns a list of (user_id, recorded, actual) for corrected users.
+    """
+    from django.db.models import Sum
+    from .models import File
+
+    corrected = []
+    last_pk = None
+    while True:
+        batch = User.objects.order_by('pk')
+        if last_pk is not None:
+            batch = batch.filter(pk__gt=last_pk)
+        user_ids = list(batch.values_list('pk', flat=True)[:batch_size])
+        if not user_ids:
+            break
+        last_pk = user_ids[-1]
+
+        for user_id in user_ids:
+            with transaction.atomic():
+                recorded = User.objects.select_for_update().values_list('storage_used', flat=True).get(pk=user_id)
+                actual = File.objects.filter(uploaded_by_id=user_id).aggregate(total=Sum('file_size'))['total'] or 0
+                if recorded != actual:
+                    User.objects.filter(pk=user_id).update(storage_used=actual)
+                    corrected.append((user_id, recorded, actual))
+    return corrected
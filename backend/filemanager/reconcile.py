@@ -0,0 +1,196 @@
+"""Finding blobs without rows and rows without blobs.
+
+The storage tree and the File/FilePreview/Chunk tables are read as two streams
+sorted by path and merge-joined, so memory stays flat however many blobs
+there are. Each stream is produced by its own thread; the merge only holds
+the head of each. Every candidate is re-checked before anything is removed,
+because uploads, deletes and migrate_blob_layout keep running meanwhile.
+"""
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, connection
+from django.db.models import Q
+from django.db.models.functions import Collate
+import heapq
+import os
+import queue
+import threading
+import time
+from .models import BLOB_ROOT, Chunk, File, FilePreview
+
+# Top-level directories under MEDIA_ROOT that hold blobs
+MANAGED_PREFIXES = (BLOB_ROOT, 'encrypted_files')
+
+_DONE = object()
+
+
+class _Failed:
+    def __init__(self, error):
+        self.error = error
+
+
+def walk_storage(root, prefixes=MANAGED_PREFIXES):
+    """Yield (name, mtime, size) for every blob, sorted by name.
+
+    Directories sort as 'name/' so a depth-first walk comes out in the same
+    order as a plain string sort of the full paths (and of ORDER BY file).
+    Only one directory listing is held at a time.
+    """
+    def walk(relative):
+        try:
+            entries = list(os.scandir(os.path.join(root, relative)))
+        except (FileNotFoundError, NotADirectoryError):
+            return
+        entries.sort(key=lambda entry: entry.name + '/' if entry.is_dir(follow_symlinks=False) else entry.name)
+        for entry in entries:
+            name = f'{relative}/{entry.name}'
+            if entry.is_dir(follow_symlinks=False):
+                yield from walk(name)
+            elif entry.is_file(follow_symlinks=False):
+                stat = entry.stat(follow_symlinks=False)
+                yield name, stat.st_mtime, stat.st_size
+
+    for prefix in sorted(prefixes):
+        yield from walk(prefix)
+
+
+def _ordered(queryset, field):
+    # Postgres sorts by locale unless told otherwise; SQLite compares bytes
+    if connection.vendor == 'postgresql':
+        return queryset.order_by(Collate(field, 'C'))
+    return queryset.order_by(field)
+
+
+def _managed(field, prefixes):
+    condition = Q()
+    for prefix in prefixes:
+        condition |= Q(**{f'{field}__startswith': f'{prefix}/'})
+    return condition
+
+
+def referenced_blobs(prefixes=MANAGED_PREFIXES, chunk_size=2000):
+    """Yield (name, model, pk) for every blob a row points at, sorted by name"""
+    files = _ordered(File.objects.filter(_managed('file', prefixes)), 'file').values_list('file', 'pk')
+    previews = _ordered(FilePreview.objects.filter(_managed('blob', prefixes)), 'blob').values_list('blob', 'pk')
+    chunks = _ordered(Chunk.objects.filter(_managed('blob', prefixes)), 'blob').values_list('blob', 'pk')
+    return heapq.merge(
+        ((name, File, pk) for name, pk in files.iterator(chunk_size=chunk_size)),
+        ((name, FilePreview, pk) for name, pk in previews.iterator(chunk_size=chunk_size)),
+        ((name, Chunk, pk) for name, pk in chunks.iterator(chunk_size=chunk_size)),
+        key=lambda row: row[0],
+    )
+
+
+def in_thread(iterable, maxsize=1000):
+    """Produce iterable in a background thread, consumed through a bounded queue"""
+    items = queue.Queue(maxsize)
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put(item)
+        except Exception as e:
+            items.put(_Failed(e))
+        finally:
+            items.put(_DONE)
+            close_old_connections()
+
+    threading.Thread(target=produce, daemon=True, name='reconcile-producer').start()
+    while True:
+        item = items.get()
+        if item is _DONE:
+            return
+        if isinstance(item, _Failed):
+            raise item.error
+        yield item
+
+
+def merge_join(blobs, rows):
+    """Yield ('orphan', blob) and ('dangling', row) from two name-sorted streams"""
+    blob = next(blobs, None)
+    row = next(rows, None)
+    while blob is not None or row is not None:
+        if row is None or (blob is not None and blob[0] < row[0]):
+            yield 'orphan', blob
+            blob = next(blobs, None)
+        elif blob is None or row[0] < blob[0]:
+            yield 'dangling', row
+            row = next(rows, None)
+        else:
+            name = blob[0]
+            while row is not None and row[0] == name:
+                row = next(rows, None)
+            blob = next(blobs, None)
+
+
+def _is_referenced(name):
+    return (
+        File.objects.filter(file=name).exists()
+        or FilePreview.objects.filter(blob=name).exists()
+        or Chunk.objects.filter(blob=name).exists()
+    )
+
+
+def reconcile(root=None, storage=None, dry_run=False, min_age=3600, parallel=True, report=None):
+    """Report, and unless dry_run remove, orphaned blobs and dangling rows.
+
+    Blobs modified less than min_age seconds ago are left alone: an upload
+    writes its blob before inserting the row. report(kind, name) is called
+    for every confirmed orphan or dangling row.
+    """
+    root = root or settings.MEDIA_ROOT
+    storage = storage or default_storage
+    stats = {
+        'blobs_scanned': 0, 'rows_scanned': 0,
+        'orphans': 0, 'orphan_bytes': 0, 'dangling': 0,
+        'removed': 0, 'skipped_recent': 0,
+    }
+
+    def count(iterable, key):
+        for item in iterable:
+            stats[key] += 1
+            yield item
+
+    blobs = count(walk_storage(root), 'blobs_scanned')
+    rows = count(referenced_blobs(), 'rows_scanned')
+    if parallel:
+        blobs, rows = in_thread(blobs), in_thread(rows)
+
+    start = time.monotonic()
+    cutoff = time.time() - min_age
+    for kind, item in merge_join(blobs, rows):
+        if kind == 'orphan':
+            name, mtime, size = item
+            if mtime > cutoff:
+                stats['skipped_recent'] += 1
+                continue
+            if _is_referenced(name):
+                continue
+            stats['orphans'] += 1
+            stats['orphan_bytes'] += size
+            if report:
+                report('orphan', name)
+            if not dry_run:
+                storage.delete(name)
+                stats['removed'] += 1
+        else:
+            name, model, pk = item
+            # The blob may have been moved or replaced since the row was read
+            field = 'file' if model is File else 'blob'
+            current = model.objects.filter(pk=pk).values_list(field, flat=True).first()
+            if current is None or storage.exists(current):
+                continue
+            stats['dangling'] += 1
+            if report:
+                report('dangling', f'{model.__name__} {pk} -> {name}')
+            # Versions still list a lost chunk, so its row can't simply go
+            if not dry_run and model is not Chunk:
+                # Deleting through the queryset still fires the signals that
+                # keep storage usage and the search index in step
+                model.objects.filter(pk=pk).delete()
+                stats['removed'] += 1
+
+    seconds = time.monotonic() - start
+    stats['seconds'] = round(seconds, 3)
+    stats['entries_per_s'] = round((stats['blobs_scanned'] + stats['rows_scanned']) / seconds) if seconds else None
+    return stats
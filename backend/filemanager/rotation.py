@@ -0,0 +1,152 @@
+"""Re-encrypting blobs under a new master key.
+
+Rotation is online: set FILE_ENCRYPTION_KEY_ID to the new key (keeping the
+old one in FILE_ENCRYPTION_KEYS) so new uploads use it, then run
+``rotate_encryption_key``. Each blob is decrypted with the key its row
+names, re-encrypted under the new key into a fresh blob, and the row is
+switched over with a conditional UPDATE before the old blob is removed.
+Downloads keep working throughout because every row always names a blob
+and the key that blob was written with. The key_id column doubles as the
+checkpoint: an interrupted run picks up the rows still on other keys.
+"""
+from django.core.files.base import ContentFile
+from django.db.models import Count
+from django.utils import timezone
+import logging
+import threading
+import time
+import uuid
+from .blobs import blob_checksum, read_blob
+from .jobs import RateLimiter, iter_pks, run_pool
+from .models import Chunk, File, FilePreview, blob_path
+from .utils import decrypt_file, encrypt_file
+
+logger = logging.getLogger(__name__)
+
+
+def _reencrypt(instance, field, target_key_id, limiter, new_name, **changes):
+    """Rewrite one blob under target_key_id; returns True if the row was switched"""
+    data = read_blob(instance, field)
+    # Read after read_blob, which reloads the row if the blob moved meanwhile
+    fieldfile = getattr(instance, field)
+    old_name, old_key_id = fieldfile.name, instance.key_id
+    if old_key_id == target_key_id:
+        return False
+    if limiter:
+        limiter.wait(len(data))
+
+    encrypted = encrypt_file(decrypt_file(data, old_key_id), target_key_id)
+    storage = fieldfile.storage
+    saved_name = storage.save(new_name(instance), ContentFile(encrypted))
+
+    model = type(instance)
+    if isinstance(instance, (File, Chunk)):
+        changes['checksum'] = blob_checksum(encrypted)
+    if isinstance(instance, File):
+        changes['last_verified_at'] = timezone.now()
+    switched = model.objects.filter(
+        pk=instance.pk, key_id=old_key_id, **{field: old_name}
+    ).update(key_id=target_key_id, **{field: saved_name}, **changes)
+    if not switched:
+        storage.delete(saved_name)
+        return False
+    storage.delete(old_name)
+    return True
+
+
+def _reencrypt_inline(file_obj, target_key_id, limiter):
+    """Rewrite a blob stored in its File row under target_key_id; returns True if the row was switched"""
+    data = read_blob(file_obj)
+    old_key_id = file_obj.key_id
+    if limiter:
+        limiter.wait(len(data))
+    encrypted = encrypt_file(decrypt_file(data, old_key_id), target_key_id)
+    return bool(File.objects.filter(pk=file_obj.pk, key_id=old_key_id, version=0, file='').update(
+        key_id=target_key_id, inline_blob=encrypted, checksum=blob_checksum(encrypted),
+        last_verified_at=timezone.now()
+    ))
+
+
+def rotate_file(file_id, target_key_id, limiter=None):
+    """Re-encrypt one File and its preview; returns True if anything was rewritten"""
+    try:
+        file_obj = File.objects.get(pk=file_id)
+    except File.DoesNotExist:
+        return False
+
+    rotated = False
+    if file_obj.file and file_obj.key_id != target_key_id:
+        rotated = _reencrypt(
+            file_obj, 'file', target_key_id, limiter,
+            lambda instance: blob_path(instance, f'{uuid.uuid4().hex}.enc'),
+        )
+    elif file_obj.inline_blob is not None and file_obj.key_id != target_key_id:
+        rotated = _reencrypt_inline(file_obj, target_key_id, limiter)
+
+    preview = FilePreview.objects.filter(file_id=file_id).exclude(blob='').first()
+    if preview and preview.key_id != target_key_id:
+        preview.file = File.objects.get(pk=file_id)
+        rotated = _reencrypt(
+            preview, 'blob', target_key_id, limiter,
+            lambda instance: instance.blob.field.generate_filename(instance, f'{uuid.uuid4().hex}.preview.enc'),
+        ) or rotated
+    return rotated
+
+
+def rotate_chunk(chunk_id, target_key_id, limiter=None):
+    """Re-encrypt one version chunk; returns True if it was rewritten"""
+    try:
+        chunk = Chunk.objects.get(pk=chunk_id)
+    except Chunk.DoesNotExist:
+        return False
+    return _reencrypt(
+        chunk, 'blob', target_key_id, limiter,
+        lambda instance: blob_path(instance, f'{uuid.uuid4().hex}.chunk'),
+    )
+
+
+def pending_file_ids(target_key_id, batch_size=500):
+    """Ids of Files whose blob or preview is not yet under target_key_id"""
+    stale_previews = FilePreview.objects.exclude(key_id=target_key_id).exclude(blob='').values('file_id')
+    # Versioned files have no blob of their own; their chunks are rotated separately
+    stale_files = File.objects.exclude(key_id=target_key_id).exclude(file='', inline_blob__isnull=True)
+    queryset = stale_files | File.objects.filter(pk__in=stale_previews)
+    return iter_pks(queryset, batch_size)
+
+
+def keys_in_use():
+    """{key_id: number of blobs} — a key can be retired once it is absent here"""
+    usage = {}
+    for queryset in (File.objects.exclude(file='', inline_blob__isnull=True), FilePreview.objects.exclude(blob=''), Chunk.objects.all()):
+        for row in queryset.values('key_id').annotate(count=Count('pk')):
+            usage[row['key_id']] = usage.get(row['key_id'], 0) + row['count']
+    return usage
+
+
+def rotate(target_key_id, workers=4, bytes_per_second=0, batch_size=500, progress=None):
+    """Re-encrypt everything not under target_key_id; returns counts and seconds"""
+    limiter = RateLimiter(bytes_per_second)
+    stats = {'rotated': 0, 'skipped': 0, 'failed': 0}
+    lock = threading.Lock()
+    start = time.monotonic()
+
+    def worker(rotate_one, kind):
+        def work(pk):
+            try:
+                result = 'rotated' if rotate_one(pk, target_key_id, limiter) else 'skipped'
+            except Exception as e:
+                logger.error(f"Failed to re-encrypt {kind} {pk}: {str(e)}")
+                result = 'failed'
+            with lock:
+                stats[result] += 1
+                done = stats['rotated'] + stats['skipped'] + stats['failed']
+            if progress and done % 100 == 0:
+                progress(dict(stats))
+        return work
+
+    run_pool(worker(rotate_file, 'file'), pending_file_ids(target_key_id, batch_size), workers=workers, name='rotate')
+    chunk_ids = iter_pks(Chunk.objects.exclude(key_id=target_key_id), batch_size)
+    run_pool(worker(rotate_chunk, 'chunk'), chunk_ids, workers=workers, name='rotate')
+
+    stats['seconds'] = round(time.monotonic() - start, 3)
+    return stats
@@ -0,0 +1,6 @@
+from django.urls import path
+from .consumers import FileEventsConsumer
+
+websocket_urlpatterns = [
+    path('ws/files/', FileEventsConsumer.as_asgi()),
+]
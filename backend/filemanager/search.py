@@ -0,0 +1,126 @@
+"""Filename search over File.original_name and content_type.
+
+SQLite uses the FTS5 table created in migration 0004, kept in sync by the
+File signal handlers; PostgreSQL uses its GIN expression index. Other
+databases fall back to substring matching.
+"""
+from django.db import connection, models
+from django.db.models.expressions import RawSQL
+from django.utils.dateparse import parse_datetime
+from core.pagination import InvalidCursor, decode_cursor, encode_cursor
+import re
+import uuid
+
+# Same token boundaries as FTS5's unicode61 tokenizer: letters and digits
+TOKEN_RE = re.compile(r'[^\W_]+')
+MAX_TOKENS = 10
+
+INSERT_SQL = (
+    "INSERT INTO filemanager_file_fts(rowid, file_id, original_name, content_type) "
+    "VALUES (%s, %s, %s, %s)"
+)
+
+
+def search_rowid(file_id):
+    """Stable 64-bit FTS rowid for a File id"""
+    return int.from_bytes(file_id.bytes[:8], 'big', signed=True)
+
+
+def _uses_fts():
+    return connection.vendor == 'sqlite'
+
+
+def index_file(file_obj, created=False):
+    if not _uses_fts():
+        return
+    rowid = search_rowid(file_obj.id)
+    with connection.cursor() as cursor:
+        if not created:
+            cursor.execute("DELETE FROM filemanager_file_fts WHERE rowid = %s", [rowid])
+        cursor.execute(
+            INSERT_SQL,
+            [rowid, file_obj.id.hex, file_obj.original_name, file_obj.content_type]
+        )
+
+
+def unindex_file(file_id):
+    if not _uses_fts():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("DELETE FROM filemanager_file_fts WHERE rowid = %s", [search_rowid(file_id)])
+
+
+def rebuild_index(batch_size=1000):
+    """Re-index every File; returns the number of rows indexed"""
+    from .models import File
+    if not _uses_fts():
+        return 0
+    count = 0
+    with connection.cursor() as cursor:
+        cursor.execute("DELETE FROM filemanager_file_fts")
+        rows = File.objects.values_list('id', 'original_name', 'content_type').iterator(chunk_size=batch_size)
+        batch = []
+        for file_id, name, content_type in rows:
+            batch.append((search_rowid(file_id), file_id.hex, name, content_type))
+            if len(batch) >= batch_size:
+                cursor.executemany(INSERT_SQL, batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            cursor.executemany(INSERT_SQL, batch)
+            count += len(batch)
+    return count
+
+
+def search_tokens(query):
+    return TOKEN_RE.findall((query or '').lower())[:MAX_TOKENS]
+
+
+def filter_matching(queryset, query):
+    """Files whose name or content type contain every token, each as a prefix"""
+    tokens = search_tokens(query)
+    if not tokens:
+        return queryset.none()
+
+    if connection.vendor == 'sqlite':
+        match = ' '.join(f'"{token}"*' for token in tokens)
+        return queryset.filter(id__in=RawSQL(
+            "SELECT file_id FROM filemanager_file_fts WHERE filemanager_file_fts MATCH %s", [match]
+        ))
+    if connection.vendor == 'postgresql':
+        tsquery = ' & '.join(f'{token}:*' for token in tokens)
+        return queryset.filter(id__in=RawSQL(
+            "SELECT id FROM filemanager_file WHERE to_tsvector('simple', original_name || ' ' || content_type) "
+            "@@ to_tsquery('simple', %s)", [tsquery]
+        ))
+
+    for token in tokens:
+        queryset = queryset.filter(
+            models.Q(original_name__icontains=token) | models.Q(content_type__icontains=token)
+        )
+    return queryset
+
+
+def paginate(queryset, cursor, limit):
+    """Return (rows, next_cursor) ordered newest first by (uploaded_at, id)"""
+    queryset = queryset.order_by('-uploaded_at', '-id')
+    if cursor:
+        values = decode_cursor(cursor)
+        try:
+            uploaded_at, file_id = parse_datetime(values[0]), uuid.UUID(values[1])
+        except (IndexError, TypeError, ValueError):
+            raise InvalidCursor('Invalid cursor')
+        if uploaded_at is None:
+            raise InvalidCursor('Invalid cursor')
+        queryset = queryset.filter(
+            models.Q(uploaded_at__lt=uploaded_at) |
+            models.Q(uploaded_at=uploaded_at, id__lt=file_id)
+        )
+
+    rows = list(queryset[:limit + 1])
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor([last.uploaded_at.isoformat(), last.id.hex])
+    return rows, next_cursor
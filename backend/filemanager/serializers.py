@@ -1,5 +1,7 @@
+from django.conf import settings
 from rest_framework import serializers
 from .models import File, FileShare, ShareableLink
+from . import signedlinks
 
 class FileShareSerializer(serializers.ModelSerializer):
     class Meta:
@@ -15,11 +17,11 @@ class FileSerializer(serializers.ModelSerializer):
     class Meta:
         model = File
         fields = ['id', 'name', 'original_name', 'file_size', 'uploaded_at', 
-                 'owner_email', 'is_owner', 'can_download', 'can_manage']
+                 'owner_email', 'is_owner', 'can_download', 'can_manage', 'version']
 
     def get_is_owner(self, obj):
         request = self.context.get('request')
-        return request.user == obj.uploaded_by
+        return request.user.id == obj.uploaded_by_id
 
     def get_can_download(self, obj):
         request = self.context.get('request')
@@ -27,18 +29,17 @@ class FileSerializer(serializers.ModelSerializer):
         if request.user.role == 'ADMIN':
             return True
         # Owner can always download
-        if request.user == obj.uploaded_by:
+        if request.user.id == obj.uploaded_by_id:
             return True
-        # Check share permissions for other users
-        try:
-            share = FileShare.objects.get(file=obj, user=request.user)
-            return share.permission == 'DOWNLOAD'
-        except FileShare.DoesNotExist:
-            return False
+        # List querysets annotate the caller's share permission (see
+        # with_share_permission) so this doesn't run a query per row
+        if hasattr(obj, 'share_permission'):
+            return obj.share_permission == 'DOWNLOAD'
+        return FileShare.objects.filter(file=obj, user=request.user, permission='DOWNLOAD').exists()
 
     def get_can_manage(self, obj):
         request = self.context.get('request')
-        return request.user == obj.uploaded_by or request.user.role == 'ADMIN' 
+        return request.user.id == obj.uploaded_by_id or request.user.role == 'ADMIN' 
 
 class ShareableLinkSerializer(serializers.ModelSerializer):
     url = serializers.SerializerMethodField()
@@ -49,4 +50,6 @@ class ShareableLinkSerializer(serializers.ModelSerializer):
         
     def get_url(self, obj):
         request = self.context.get('request')
+        if getattr(settings, 'SIGNED_SHARE_LINKS', True):
+            return request.build_absolute_uri(f'/files/signed/{signedlinks.sign(obj)}/')
         return request.build_absolute_uri(f'/files/download-link/{obj.id}/') 
\ No newline at end of file
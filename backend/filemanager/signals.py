@@ -0,0 +1,140 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .models import Chunk, File, FilePreview, FileShare, ShareableLink
+from core import responsecache
+from . import events, listing, quotas, search, signedlinks, stats
+
+# FileSerializer fields; saves touching none of them leave cached lists valid
+LISTED_FIELDS = {'name', 'original_name', 'file_size', 'version', 'uploaded_by'}
+
+
+@receiver(post_delete, sender=FilePreview)
+def delete_preview_blob(sender, instance, **kwargs):
+    # Previews are removed by cascade when their File goes, which skips
+    # FilePreview.delete(), so the blob is cleaned up here
+    if instance.blob:
+        instance.blob.delete(save=False)
+
+
+@receiver(post_delete, sender=Chunk)
+def delete_chunk_blob(sender, instance, **kwargs):
+    instance.blob.delete(save=False)
+
+
+@receiver(post_save, sender=File)
+def index_file_for_search(sender, instance, created, update_fields=None, **kwargs):
+    if update_fields and not {'original_name', 'content_type'} & set(update_fields):
+        return
+    search.index_file(instance, created=created)
+
+
+@receiver(post_delete, sender=File)
+def unindex_file_for_search(sender, instance, **kwargs):
+    search.unindex_file(instance.id)
+
+
+@receiver(post_save, sender=File)
+def add_storage_usage(sender, instance, created, **kwargs):
+    if created:
+        quotas.add_usage(instance.uploaded_by_id, instance.file_size)
+
+
+@receiver(post_delete, sender=File)
+def release_storage_usage(sender, instance, **kwargs):
+    quotas.add_usage(instance.uploaded_by_id, -instance.file_size)
+
+
+@receiver(post_save, sender=File)
+def announce_new_file(sender, instance, created, **kwargs):
+    if created:
+        events.send_event([instance.uploaded_by_id], 'file.created', file=events.file_payload(instance))
+
+
+@receiver(post_delete, sender=File)
+def announce_deleted_file(sender, instance, **kwargs):
+    events.send_event([instance.uploaded_by_id], 'file.deleted', file_id=str(instance.pk))
+
+
+@receiver(post_save, sender=FileShare)
+def announce_share(sender, instance, created, **kwargs):
+    events.send_event(
+        [instance.user_id],
+        'share.created' if created else 'share.updated',
+        permission=instance.permission,
+        file=events.file_payload(instance.file),
+    )
+
+
+@receiver(post_delete, sender=FileShare)
+def announce_unshare(sender, instance, origin=None, **kwargs):
+    # Shares go first when their file is deleted; tell the recipient the
+    # file is gone rather than that it was unshared
+    if isinstance(origin, File) or getattr(origin, 'model', None) is File:
+        events.send_event([instance.user_id], 'file.deleted', file_id=str(instance.file_id))
+    else:
+        events.send_event([instance.user_id], 'share.deleted', file_id=str(instance.file_id))
+
+
+@receiver(post_save, sender=File)
+def invalidate_lists_on_save(sender, instance, created, update_fields=None, **kwargs):
+    if update_fields and not LISTED_FIELDS & set(update_fields):
+        return
+    # A new file has no shares yet
+    listing.invalidate(instance.uploaded_by_id, None if created else instance.pk)
+
+
+@receiver(post_delete, sender=File)
+def invalidate_lists_on_delete(sender, instance, **kwargs):
+    # The shares were deleted first and have invalidated their recipients
+    listing.invalidate(instance.uploaded_by_id)
+
+
+@receiver(post_save, sender=FileShare)
+@receiver(post_delete, sender=FileShare)
+def invalidate_shared_list(sender, instance, **kwargs):
+    responsecache.invalidate([responsecache.user_token(instance.user_id)])
+
+
+@receiver(post_save, sender=File)
+def count_new_file(sender, instance, created, **kwargs):
+    if created:
+        stats.file_created(instance)
+
+
+@receiver(post_delete, sender=File)
+def count_deleted_file(sender, instance, **kwargs):
+    stats.file_deleted(instance)
+
+
+@receiver(post_save, sender=FileShare)
+def count_new_share(sender, instance, created, **kwargs):
+    if created:
+        stats.share_created(instance)
+
+
+@receiver(post_delete, sender=FileShare)
+def count_deleted_share(sender, instance, **kwargs):
+    stats.share_deleted(instance)
+
+
+@receiver(post_save, sender=ShareableLink)
+def count_new_link(sender, instance, created, **kwargs):
+    if created:
+        stats.link_created(instance)
+
+
+@receiver(post_delete, sender=ShareableLink)
+def count_deleted_link(sender, instance, **kwargs):
+    stats.link_deleted(instance)
+
+
+@receiver(post_delete, sender=ShareableLink)
+def revoke_signed_link(sender, instance, **kwargs):
+    signedlinks.revoke(instance)
+
+
+@receiver(post_save, sender=File)
+@receiver(post_delete, sender=File)
+def evict_signed_link_file(sender, instance, **kwargs):
+    # Other processes pick up the change when their entry times out
+    signedlinks.files.evict(instance.pk)
@@ -0,0 +1,168 @@
+"""Share links that are checked without the database.
+
+A signed link carries the link id, the file id, the expiry, the role of
+the user who created it and the id of the key it was signed with, under an
+HMAC:
+
+    /files/signed/<key id>.<link id>.<file id>.<expires>.<role>.<signature>/
+
+Checking the signature and the expiry needs no query. The file's metadata
+comes from a small per-process cache (SIGNED_LINK_FILE_CACHE_SIZE entries
+for SIGNED_LINK_FILE_CACHE_SECONDS). Links deleted before they expire,
+directly or with their file or user, are recorded in RevokedLink. Each
+process reloads that table every SIGNED_LINK_REVOCATION_REFRESH seconds,
+so a deleted link stops working within that time on every process. The
+table only holds revocations of links that haven't expired, so it stays
+small.
+
+Keys are SHARE_LINK_KEYS ("id:secret"); SHARE_LINK_KEY_ID signs new links.
+The 'default' key is derived from SECRET_KEY. Keep a retired key listed
+until the links signed with it have expired (24 hours at most).
+"""
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare, salted_hmac
+from collections import OrderedDict
+from datetime import datetime, timezone as dt_timezone
+import copy
+import threading
+import time
+import uuid
+from .models import File, RevokedLink
+
+DEFAULT_KEY_ID = 'default'
+KEY_SALT = 'filemanager.signedlinks'
+
+
+class InvalidLink(ValueError):
+    pass
+
+
+class LinkExpired(InvalidLink):
+    pass
+
+
+class SignedLink:
+    """The claims of a verified link, standing in for the ShareableLink row"""
+
+    def __init__(self, link_id, file_id, expires, creator_role):
+        self.pk = link_id
+        self.file_id = file_id
+        self.expires_at = datetime.fromtimestamp(expires, tz=dt_timezone.utc)
+        self.creator_role = creator_role
+
+
+def _secret(key_id):
+    if key_id == DEFAULT_KEY_ID:
+        return settings.SECRET_KEY
+    try:
+        return getattr(settings, 'SHARE_LINK_KEYS', {})[key_id]
+    except KeyError:
+        raise InvalidLink('Invalid link')
+
+
+def _signature(key_id, payload):
+    return salted_hmac(KEY_SALT, payload, secret=_secret(key_id), algorithm='sha256').hexdigest()[:32]
+
+
+def sign(link):
+    """The token for a ShareableLink"""
+    key_id = getattr(settings, 'SHARE_LINK_KEY_ID', DEFAULT_KEY_ID)
+    payload = '.'.join([
+        key_id, link.pk.hex, link.file_id.hex, str(int(link.expires_at.timestamp())), link.creator_role
+    ])
+    return f'{payload}.{_signature(key_id, payload)}'
+
+
+def verify(token):
+    """The SignedLink for token; raises InvalidLink, or LinkExpired, without touching the database"""
+    payload, _, signature = token.rpartition('.')
+    parts = payload.split('.')
+    if len(parts) != 5:
+        raise InvalidLink('Invalid link')
+    if not constant_time_compare(signature, _signature(parts[0], payload)):
+        raise InvalidLink('Invalid link')
+    _, link_id, file_id, expires, role = parts
+    try:
+        link = SignedLink(uuid.UUID(link_id), uuid.UUID(file_id), int(expires), role)
+    except ValueError:
+        raise InvalidLink('Invalid link')
+    if link.expires_at < timezone.now():
+        raise LinkExpired('This link has expired')
+    if revocations.is_revoked(link.pk):
+        raise InvalidLink('Link not found')
+    return link
+
+
+class RevocationList:
+    """Per-process copy of RevokedLink, reloaded every SIGNED_LINK_REVOCATION_REFRESH seconds"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.revoked = frozenset()
+        self.loaded_at = None
+
+    def reload(self):
+        revoked = frozenset(RevokedLink.objects.filter(expires_at__gt=timezone.now()).values_list('link_id', flat=True))
+        self.revoked, self.loaded_at = revoked, time.monotonic()
+
+    def is_revoked(self, link_id):
+        refresh = getattr(settings, 'SIGNED_LINK_REVOCATION_REFRESH', 5)
+        with self.lock:
+            if self.loaded_at is None or time.monotonic() - self.loaded_at >= refresh:
+                self.reload()
+            return link_id in self.revoked
+
+    def expire(self):
+        self.loaded_at = None
+
+
+revocations = RevocationList()
+
+
+def revoke(link):
+    """Record that a link was deleted before it expired"""
+    now = timezone.now()
+    if link.expires_at <= now:
+        return
+    RevokedLink.objects.filter(expires_at__lte=now).delete()
+    RevokedLink.objects.update_or_create(link_id=link.pk, defaults={'expires_at': link.expires_at})
+    # This process sees it at once, the others on their next reload
+    transaction.on_commit(revocations.expire)
+
+
+class FileCache:
+    """Least recently used File rows, each kept for SIGNED_LINK_FILE_CACHE_SECONDS"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, file_id):
+        """A copy of the File; raises File.DoesNotExist"""
+        ttl = getattr(settings, 'SIGNED_LINK_FILE_CACHE_SECONDS', 60)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(file_id)
+            if entry and now - entry[1] < ttl:
+                self.entries.move_to_end(file_id)
+                return copy.copy(entry[0])
+        file_obj = File.objects.get(pk=file_id)
+        with self.lock:
+            self.entries[file_id] = (file_obj, now)
+            self.entries.move_to_end(file_id)
+            while len(self.entries) > getattr(settings, 'SIGNED_LINK_FILE_CACHE_SIZE', 1024):
+                self.entries.popitem(last=False)
+        return copy.copy(file_obj)
+
+    def evict(self, file_id):
+        with self.lock:
+            self.entries.pop(file_id, None)
+
+    def reload(self, file_id):
+        self.evict(file_id)
+        return self.get(file_id)
+
+
+files = FileCache()
@@ -0,0 +1,239 @@
+"""Rollup tables behind the admin storage dashboard.
+
+Every upload, delete, share and link adds its deltas to three tables in
+the same transaction as the change itself:
+
+- UserStorageStats: files, bytes, shares received and links per user
+- StorageTotals: the same counts overall
+- DailyStorageStats: uploads, deletions, shares and links per day
+
+Reading the dashboard never touches File, FileShare or ShareableLink, so
+it costs the same with ten files as with ten million. The totals and the
+daily rows are split into STORAGE_STATS_SHARDS rows, picked by user, so
+concurrent uploads don't queue on one row lock. Readers add up those few
+rows.
+
+``rebuild_storage_stats`` recomputes the per-user rows and the totals from
+the base tables if they ever drift. Daily history only records what
+happened after the tables were created, plus the creations that were
+backfilled when they were.
+"""
+from django.apps import apps as global_apps
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import timedelta
+import threading
+from .models import DailyStorageStats, StorageTotals, UserStorageStats
+
+STATE_FIELDS = ('files', 'bytes', 'shares', 'links')
+DAILY_FIELDS = ('uploads', 'uploaded_bytes', 'deletions', 'deleted_bytes', 'shares', 'links')
+# Databases with INSERT ... ON CONFLICT (SQLite 3.24+, PostgreSQL 9.5+)
+UPSERT_VENDORS = ('sqlite', 'postgresql')
+
+
+def shard_for(user_id):
+    return user_id % getattr(settings, 'STORAGE_STATS_SHARDS', 8)
+
+
+def _upsert(model, lookup, deltas):
+    """INSERT ... ON CONFLICT DO UPDATE adding deltas: one statement whether or not the row exists"""
+    fields = DAILY_FIELDS if model is DailyStorageStats else STATE_FIELDS
+    qn = connection.ops.quote_name
+    table = qn(model._meta.db_table)
+    columns = [*lookup, *fields]
+    params = [*lookup.values(), *(deltas.get(field, 0) for field in fields)]
+    assignments = ', '.join(f'{qn(field)} = {table}.{qn(field)} + excluded.{qn(field)}' for field in deltas)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {table} ({', '.join(qn(column) for column in columns)}) "
+            f"VALUES ({', '.join(['%s'] * len(columns))}) "
+            f"ON CONFLICT ({', '.join(qn(column) for column in lookup)}) DO UPDATE SET {assignments}",
+            params
+        )
+
+
+_batch = threading.local()
+
+
+@contextmanager
+def batched():
+    """Sum the changes recorded in the block and apply them once per row at its end.
+
+    For bulk deletes, whose signals would otherwise update the same rows
+    once per deleted object.
+    """
+    pending = _batch.pending = defaultdict(lambda: defaultdict(int))
+    try:
+        yield
+    finally:
+        _batch.pending = None
+    for (model, lookup, create), deltas in pending.items():
+        _add(model, dict(lookup), deltas, create)
+
+
+def _add(model, lookup, deltas, create=True):
+    """Add deltas to the row matching lookup, creating it if allowed"""
+    deltas = {field: delta for field, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    pending = getattr(_batch, 'pending', None)
+    if pending is not None:
+        row = pending[(model, tuple(lookup.items()), create)]
+        for field, delta in deltas.items():
+            row[field] += delta
+        return
+    if create and connection.vendor in UPSERT_VENDORS:
+        return _upsert(model, lookup, deltas)
+    changes = {field: F(field) + delta for field, delta in deltas.items()}
+    if model.objects.filter(**lookup).update(**changes) or not create:
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**lookup, **deltas)
+    except IntegrityError:
+        # Created by a concurrent transaction since the UPDATE
+        model.objects.filter(**lookup).update(**changes)
+
+
+def record(user_id, state=None, daily=None):
+    """Apply one change by (or to) user_id.
+
+    Increases create the user's row; decreases only update it, since they
+    also run while a deleted user's rows are cascading away.
+    """
+    shard = shard_for(user_id)
+    if state:
+        growing = any(delta > 0 for delta in state.values())
+        _add(UserStorageStats, {'user_id': user_id}, state, create=growing)
+        _add(StorageTotals, {'shard': shard}, state)
+    if daily:
+        day = connection.ops.adapt_datefield_value(timezone.localdate())
+        _add(DailyStorageStats, {'day': day, 'shard': shard}, daily)
+
+
+def file_created(file_obj):
+    record(file_obj.uploaded_by_id,
+           {'files': 1, 'bytes': file_obj.file_size},
+           {'uploads': 1, 'uploaded_bytes': file_obj.file_size})
+
+
+def file_deleted(file_obj):
+    record(file_obj.uploaded_by_id,
+           {'files': -1, 'bytes': -file_obj.file_size},
+           {'deletions': 1, 'deleted_bytes': file_obj.file_size})
+
+
+def file_resized(user_id, delta):
+    record(user_id, {'bytes': delta})
+
+
+def share_created(share):
+    record(share.user_id, {'shares': 1}, {'shares': 1})
+
+
+def share_deleted(share):
+    record(share.user_id, {'shares': -1})
+
+
+def link_created(link):
+    record(link.created_by_id, {'links': 1}, {'links': 1})
+
+
+def link_deleted(link):
+    record(link.created_by_id, {'links': -1})
+
+
+def totals():
+    rows = StorageTotals.objects.aggregate(**{field: Sum(field) for field in STATE_FIELDS})
+    return {field: rows[field] or 0 for field in STATE_FIELDS}
+
+
+def top_users(limit):
+    """The users storing the most bytes, largest first"""
+    rows = UserStorageStats.objects.order_by('-bytes', 'user_id').values(
+        'user_id', 'user__email', *STATE_FIELDS
+    )[:limit]
+    return [
+        {'id': row['user_id'], 'email': row['user__email'], **{field: row[field] for field in STATE_FIELDS}}
+        for row in rows
+    ]
+
+
+def daily(days):
+    """Activity for each of the last `days` days, oldest first, including days without any"""
+    today = timezone.localdate()
+    since = today - timedelta(days=days - 1)
+    by_day = defaultdict(lambda: dict.fromkeys(DAILY_FIELDS, 0))
+    for row in DailyStorageStats.objects.filter(day__gte=since).values('day', *DAILY_FIELDS):
+        counts = by_day[row['day']]
+        for field in DAILY_FIELDS:
+            counts[field] += row[field]
+    return [
+        {'day': day.isoformat(), **by_day[day]}
+        for day in (since + timedelta(days=offset) for offset in range(days))
+    ]
+
+
+def rebuild(get_model=global_apps.get_model):
+    """Recompute the per-user rows and the totals from File, FileShare and ShareableLink.
+
+    Takes get_model so the initial migration can run it on historical
+    models. Returns the new totals.
+    """
+    File = get_model('filemanager', 'File')
+    FileShare = get_model('filemanager', 'FileShare')
+    ShareableLink = get_model('filemanager', 'ShareableLink')
+    UserStats = get_model('filemanager', 'UserStorageStats')
+    Totals = get_model('filemanager', 'StorageTotals')
+
+    per_user = defaultdict(lambda: dict.fromkeys(STATE_FIELDS, 0))
+    for row in File.objects.order_by().values('uploaded_by').annotate(files=Count('pk'), bytes=Sum('file_size')):
+        per_user[row['uploaded_by']].update(files=row['files'], bytes=row['bytes'] or 0)
+    for row in FileShare.objects.order_by().values('user').annotate(shares=Count('pk')):
+        per_user[row['user']]['shares'] = row['shares']
+    for row in ShareableLink.objects.order_by().values('created_by').annotate(links=Count('pk')):
+        per_user[row['created_by']]['links'] = row['links']
+
+    overall = dict.fromkeys(STATE_FIELDS, 0)
+    for counts in per_user.values():
+        for field in STATE_FIELDS:
+            overall[field] += counts[field]
+
+    with transaction.atomic():
+        UserStats.objects.all().delete()
+        UserStats.objects.bulk_create(
+            (UserStats(user_id=user_id, **counts) for user_id, counts in per_user.items()), batch_size=500
+        )
+        Totals.objects.all().delete()
+        Totals.objects.create(shard=0, **overall)
+    return overall
+
+
+def backfill_daily(get_model=global_apps.get_model):
+    """Fill DailyStorageStats with the uploads, shares and links still on record"""
+    File = get_model('filemanager', 'File')
+    FileShare = get_model('filemanager', 'FileShare')
+    ShareableLink = get_model('filemanager', 'ShareableLink')
+    Daily = get_model('filemanager', 'DailyStorageStats')
+
+    by_day = defaultdict(lambda: dict.fromkeys(DAILY_FIELDS, 0))
+    uploads = File.objects.order_by().annotate(day=TruncDate('uploaded_at')).values('day').annotate(
+        uploads=Count('pk'), uploaded_bytes=Sum('file_size')
+    )
+    for row in uploads:
+        by_day[row['day']].update(uploads=row['uploads'], uploaded_bytes=row['uploaded_bytes'] or 0)
+    shares = FileShare.objects.order_by().annotate(day=TruncDate('shared_at')).values('day').annotate(n=Count('pk'))
+    for row in shares:
+        by_day[row['day']]['shares'] = row['n']
+    links = ShareableLink.objects.order_by().annotate(day=TruncDate('created_at')).values('day').annotate(n=Count('pk'))
+    for row in links:
+        by_day[row['day']]['links'] = row['n']
+
+    Daily.objects.bulk_create(
+        (Daily(day=day, shard=0, **counts) for day, counts in by_day.items()), batch_size=500
+    )
@@ -4,12 +4,50 @@ from rest_framework import status
 from rest_framework.test import APIClient
 from django.core.files.uploadedfile import SimpleUploadedFile
 from accounts.models import User
-from .models import File, FileShare, ShareableLink
+from .models import File, FileShare, ShareableLink, blob_path
 from django.utils import timezone
 from datetime import timedelta
-from .utils import encrypt_file  # Import the encryption utility
+from .utils import encrypt_file, decrypt_file  # Import the encryption utility
+from . import benchmarks
+from .zipstream import unique_names
+from .previews import generate_preview, schedule_preview
+from . import previews
+from unittest.mock import patch
+from .blobs import iter_decrypted
+from .models import FilePreview
+from . import audit, chunking, coalesce, governor, links, signedlinks, layout, quotas, reconcile, rotation, scrub, search, stats, versions
+from .models import AccessEvent, Chunk, DailyStorageStats, RevokedLink, FileVersion, UserStorageStats
+from .blobs import BlobCorrupted, blob_checksum, read_blob
+from PIL import Image
+from django.core.management import call_command
+from django.core.cache import cache
+from asgiref.sync import sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from rest_framework_simplejwt.tokens import RefreshToken
+from accounts.websocket import CookieJWTAuthMiddleware
+from .routing import websocket_urlpatterns
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from core.testing import QueryBudgetMixin
+from core import metrics
+from core.renderers import FastJSONRenderer
+from rest_framework.renderers import JSONRenderer
+from types import SimpleNamespace
+from .listing import file_rows
+from .serializers import FileSerializer
+from .views import with_share_permission
 import os
 import base64
+import random
+import io
+import zipfile
+import tempfile
+import shutil
+import uuid
+import copy
+import time
 
 class FileManagementTests(TestCase):
     def setUp(self):
@@ -269,4 +307,1752 @@ class FileManagementTests(TestCase):
                     try:
                         os.rmdir(os.path.join(root, name))
                     except OSError:
-                        pass 
\ No newline at end of file
+                        pass 
+
+class CryptoBenchmarkTests(TestCase):
+    def test_all_modes_round_trip(self):
+        """Test the benchmark harness runs every cipher mode end to end"""
+        results = benchmarks.run_benchmarks(sizes=[1000, 70000], repeat=1, include_kdf=False)
+        modes = {result['mode'] for result in results}
+        self.assertEqual(modes, set(benchmarks.CIPHER_MODES) | {'utils'})
+        for result in results:
+            self.assertGreater(result['seconds'], 0)
+
+    def test_utils_allocation_guard(self):
+        """Test encrypt/decrypt do not copy the payload more than they do today"""
+        size = 1024 * 1024
+        results = benchmarks.run_benchmarks(sizes=[size], modes_to_run=['aes-cbc'], repeat=1, include_kdf=False)
+        for result in results:
+            if result['mode'] == 'utils':
+                self.assertLess(result['peak_bytes'], size * 5, benchmarks.result_key(result))
+
+    def test_find_regressions(self):
+        """Test slowdowns beyond the tolerance are reported"""
+        baseline = {'encrypt:utils:1024': {'seconds': 1.0}, 'decrypt:utils:1024': {'seconds': 1.0}}
+        results = [
+            {'op': 'encrypt', 'mode': 'utils', 'size': 1024, 'seconds': 1.1},
+            {'op': 'decrypt', 'mode': 'utils', 'size': 1024, 'seconds': 2.0},
+        ]
+        regressions = benchmarks.find_regressions(results, baseline, tolerance=0.25)
+        self.assertEqual([result['op'] for result, _ in regressions], ['decrypt'])
+
+
+class FileQueryBudgetTests(QueryBudgetMixin, TestCase):
+    """Pin the query count of every route in filemanager/urls.py"""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.owner = User.objects.create_user(email='owner@example.com', password='ownerpass123')
+        self.owner.role = 'USER'
+        self.owner.save()
+        self.other = User.objects.create_user(email='other@example.com', password='otherpass123')
+        self.files = []
+        for index in range(5):
+            file = File.objects.create(
+                uploaded_by=self.owner,
+                file=SimpleUploadedFile(f'budget{index}.enc', encrypt_file(b'budget content')),
+                original_name=f'budget{index}.txt',
+                file_size=14,
+                content_type='text/plain'
+            )
+            FileShare.objects.create(file=file, user=self.other, permission='DOWNLOAD')
+            self.files.append(file)
+        self.file = self.files[0]
+
+    def test_list_budget(self):
+        self.client.force_authenticate(user=self.owner)
+        with self.assertMaxQueries(1):
+            response = self.client.get(reverse('file-list'))
+        self.assertEqual(len(response.data), 5)
+
+    def test_shared_budget(self):
+        self.client.force_authenticate(user=self.other)
+        with self.assertMaxQueries(1):
+            response = self.client.get(reverse('file-shared'))
+        self.assertEqual(len(response.data), 5)
+
+    def test_retrieve_budget(self):
+        self.client.force_authenticate(user=self.other)
+        with self.assertMaxQueries(1):
+            response = self.client.get(reverse('file-detail', kwargs={'pk': str(self.file.id)}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.data['can_download'])
+
+    def test_destroy_budget(self):
+        self.client.force_authenticate(user=self.owner)
+        # +1: shares are loaded rather than fast-deleted so their recipients
+        # can be told over WebSockets; +1: the cascade to file versions;
+        # +1: File.delete() saves the cleared blob first, which looks up the
+        # recipients whose cached shared lists the save invalidates;
+        # +5: storage rollups for the file (user, totals, day) and its share
+        with self.assertMaxQueries(18):
+            response = self.client.delete(reverse('file-detail', kwargs={'pk': str(self.file.id)}))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+    def test_upload_budget(self):
+        self.client.force_authenticate(user=self.owner)
+        # Quota lock + usage update, inside a savepoint under TestCase,
+        # and one upsert per storage rollup (user, totals, day)
+        with self.assertMaxQueries(10):
+            response = self.client.post(
+                reverse('file-upload'),
+                {'file': SimpleUploadedFile('new.txt', b'new content')},
+                format='multipart'
+            )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_download_budget(self):
+        self.client.force_authenticate(user=self.other)
+        # Includes the governor's slot counter, which lives in the database cache here
+        with self.assertMaxQueries(7):
+            response = self.client.get(reverse('file-download', kwargs={'file_id': str(self.file.id)}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_share_budget(self):
+        third = User.objects.create_user(email='third@example.com', password='thirdpass123')
+        self.client.force_authenticate(user=self.owner)
+        # Includes one upsert per storage rollup (user, totals, day)
+        with self.assertMaxQueries(11):
+            response = self.client.post(
+                reverse('file-share', kwargs={'file_id': str(self.file.id)}),
+                {'email': third.email, 'permission': 'VIEW'},
+                format='json'
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_create_share_link_budget(self):
+        self.client.force_authenticate(user=self.owner)
+        # +3: one upsert per storage rollup (user, totals, day)
+        with self.assertMaxQueries(5):
+            response = self.client.post(
+                reverse('create-share-link', kwargs={'file_id': str(self.file.id)}),
+                {'hours': 2},
+                format='json'
+            )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_storage_stats_budget(self):
+        self.other.role = 'ADMIN'
+        self.other.save()
+        self.client.force_authenticate(user=self.other)
+        # Totals, top users and days, however many files there are
+        with self.assertMaxQueries(3):
+            response = self.client.get(reverse('storage-stats'))
+        self.assertEqual(response.data['totals']['files'], 5)
+
+    def test_bulk_download_budget(self):
+        self.client.force_authenticate(user=self.other)
+        # One query for the files; the rest take and free the governor's slot
+        # counter, which lives in the database cache here
+        with self.assertMaxQueries(11):
+            response = self.client.post(
+                reverse('file-bulk-download'),
+                {'file_ids': [str(file.id) for file in self.files]},
+                format='json'
+            )
+            b''.join(response.streaming_content)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_preview_budget(self):
+        schedule_preview(self.file)
+        generate_preview(self.file.id)
+        self.client.force_authenticate(user=self.other)
+        with self.assertMaxQueries(3):
+            response = self.client.get(reverse('file-preview', kwargs={'file_id': str(self.file.id)}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        FilePreview.objects.get(file=self.file).blob.delete(save=False)
+
+    def test_search_budget(self):
+        self.client.force_authenticate(user=self.other)
+        with self.assertMaxQueries(1):
+            response = self.client.get(reverse('file-search'), {'q': 'budget'})
+        self.assertEqual(len(response.data['results']), 5)
+
+    def test_share_link_download_budget(self):
+        link = ShareableLink.objects.create(
+            file=self.file, created_by=self.owner, expires_at=timezone.now() + timedelta(hours=1)
+        )
+        # Includes the per-link and per-IP slot counters in the database cache
+        with self.assertMaxQueries(11):
+            response = self.client.get(reverse('download-shared-link', kwargs={'link_id': str(link.id)}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    @override_settings(SIGNED_LINK_REVOCATION_REFRESH=3600)
+    def test_signed_link_download_budget(self):
+        link = ShareableLink.objects.create(
+            file=self.file, created_by=self.owner, expires_at=timezone.now() + timedelta(hours=1)
+        )
+        token = signedlinks.sign(link)
+        signedlinks.revocations.reload()
+        signedlinks.files.reload(self.file.id)
+        # Only the slot counters, which are in the database cache here
+        with self.assertMaxQueries(10):
+            response = self.client.get(reverse('download-signed-link', kwargs={'token': token}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class BulkDownloadTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.owner = User.objects.create_user(email='owner@example.com', password='ownerpass123')
+        self.other = User.objects.create_user(email='other@example.com', password='otherpass123')
+        self.contents = {
+            'notes.txt': (b'hello ' * 30000, 'text/plain'),
+            'photo.png': (os.urandom(70000), 'image/png'),
+        }
+        self.files = [
+            File.objects.create(
+                uploaded_by=self.owner,
+                file=SimpleUploadedFile(name, encrypt_file(data)),
+                original_name=name,
+                file_size=len(data),
+                content_type=content_type
+            )
+            for name, (data, content_type) in self.contents.items()
+        ]
+
+    def download(self, file_ids, **extra):
+        return self.client.post(
+            reverse('file-bulk-download'),
+            {'file_ids': [str(file_id) for file_id in file_ids], **extra},
+            format='json'
+        )
+
+    def test_bulk_download_streams_zip(self):
+        """Test the archive holds every decrypted file, storing compressed types"""
+        self.client.force_authenticate(user=self.owner)
+        response = self.download([file.id for file in self.files])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+        for name, (data, _) in self.contents.items():
+            self.assertEqual(archive.read(name), data)
+        self.assertEqual(archive.getinfo('photo.png').compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(archive.getinfo('notes.txt').compress_type, zipfile.ZIP_DEFLATED)
+
+    def test_bulk_download_store_only(self):
+        """Test store_only disables compression for every member"""
+        self.client.force_authenticate(user=self.owner)
+        response = self.download([file.id for file in self.files], store_only=True)
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+        self.assertTrue(all(info.compress_type == zipfile.ZIP_STORED for info in archive.infolist()))
+
+    def test_bulk_download_store_only_false_string(self):
+        """Test store_only sent as the string 'false' keeps compression"""
+        self.client.force_authenticate(user=self.owner)
+        response = self.download([file.id for file in self.files], store_only='false')
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+        self.assertEqual(archive.getinfo('notes.txt').compress_type, zipfile.ZIP_DEFLATED)
+
+    def test_bulk_download_requires_download_permission(self):
+        """Test a VIEW share or an unshared file rejects the whole request"""
+        FileShare.objects.create(file=self.files[0], user=self.other, permission='DOWNLOAD')
+        FileShare.objects.create(file=self.files[1], user=self.other, permission='VIEW')
+        self.client.force_authenticate(user=self.other)
+
+        response = self.download([file.id for file in self.files])
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        response = self.download([self.files[0].id])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_unique_names(self):
+        """Test duplicate file names get numbered in the archive"""
+        self.assertEqual(
+            list(unique_names(['a.txt', 'a.txt', 'b', 'a.txt'])),
+            ['a.txt', 'a (1).txt', 'b', 'a (2).txt']
+        )
+
+
+class FilePreviewTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.owner = User.objects.create_user(email='owner@example.com', password='ownerpass123')
+        self.viewer = User.objects.create_user(email='viewer@example.com', password='viewerpass123')
+
+    def create_file(self, data, name, content_type, **extra):
+        file = File.objects.create(
+            uploaded_by=self.owner,
+            file=SimpleUploadedFile(name, encrypt_file(data)),
+            original_name=name,
+            file_size=len(data),
+            content_type=content_type,
+            **extra
+        )
+        FileShare.objects.create(file=file, user=self.viewer, permission='VIEW')
+        return file
+
+    def get_preview(self, file, **extra):
+        return self.client.get(reverse('file-preview', kwargs={'file_id': str(file.id)}), **extra)
+
+    def test_text_preview_for_view_share(self):
+        """Test a VIEW share gets the first bytes of a text file, cacheable by ETag"""
+        with self.settings(PREVIEW_TEXT_BYTES=10):
+            file = self.create_file(b'0123456789abcdef', 'notes.txt', 'text/plain')
+            schedule_preview(file)
+            self.client.force_authenticate(user=self.viewer)
+            self.assertEqual(self.get_preview(file).status_code, status.HTTP_202_ACCEPTED)
+
+            generate_preview(file.id)
+
+        response = self.get_preview(file)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.content, b'0123456789')
+        self.assertIn('max-age', response['Cache-Control'])
+
+        response = self.get_preview(file, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_image_thumbnail(self):
+        """Test images are reduced to a JPEG thumbnail stored encrypted"""
+        buffer = io.BytesIO()
+        Image.new('RGB', (1024, 512), 'red').save(buffer, format='PNG')
+        file = self.create_file(buffer.getvalue(), 'big.png', 'image/png')
+        schedule_preview(file)
+        generate_preview(file.id)
+
+        preview = FilePreview.objects.get(file=file)
+        self.assertEqual(preview.status, 'READY')
+        with preview.blob.open('rb') as f:
+            self.assertNotIn(b'JFIF', f.read())
+
+        self.client.force_authenticate(user=self.viewer)
+        response = self.get_preview(file)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        with Image.open(io.BytesIO(response.content)) as thumbnail:
+            self.assertEqual(thumbnail.size, (256, 128))
+
+    def test_client_encrypted_file_has_no_preview(self):
+        """Test files the server cannot read are marked unsupported"""
+        file = self.create_file(
+            b'ciphertext', 'secret.txt', 'text/plain',
+            is_client_encrypted=True, client_encryption_key='k', client_encryption_iv='iv'
+        )
+        schedule_preview(file)
+        self.client.force_authenticate(user=self.viewer)
+        self.assertEqual(self.get_preview(file).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_pdf_retried_once_renderer_installed(self):
+        """Test a PDF is not marked unsupported while pypdfium2 is missing"""
+        file = self.create_file(b'%PDF-1.4', 'report.pdf', 'application/pdf')
+        self.client.force_authenticate(user=self.viewer)
+        with patch.object(previews, 'pypdfium2', None):
+            self.assertEqual(self.get_preview(file).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertFalse(FilePreview.objects.filter(file=file).exists())
+
+        with patch.object(previews, 'renderer_available', return_value=True):
+            self.assertEqual(self.get_preview(file).status_code, status.HTTP_202_ACCEPTED)
+
+    def test_oversized_image_not_rendered(self):
+        """Test originals over PREVIEW_MAX_SOURCE_BYTES get no preview"""
+        buffer = io.BytesIO()
+        Image.new('RGB', (64, 64), 'red').save(buffer, format='PNG')
+        file = self.create_file(buffer.getvalue(), 'small.png', 'image/png')
+        schedule_preview(file)
+        with self.settings(PREVIEW_MAX_SOURCE_BYTES=len(buffer.getvalue()) - 1):
+            generate_preview(file.id)
+        self.assertEqual(FilePreview.objects.get(file=file).status, 'UNSUPPORTED')
+
+    def test_preview_requires_share(self):
+        """Test users without any share cannot see previews"""
+        file = self.create_file(b'hello', 'notes.txt', 'text/plain')
+        stranger = User.objects.create_user(email='stranger@example.com', password='strangerpass123')
+        self.client.force_authenticate(user=stranger)
+        self.assertEqual(self.get_preview(file).status_code, status.HTTP_403_FORBIDDEN)
+
+    def tearDown(self):
+        for preview in FilePreview.objects.all():
+            if preview.blob:
+                preview.blob.delete(save=False)
+
+
+class FileSearchTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.owner = User.objects.create_user(email='owner@example.com', password='ownerpass123')
+        self.owner.role = 'USER'
+        self.owner.save()
+        self.other = User.objects.create_user(email='other@example.com', password='otherpass123')
+        self.report = self.create_file(self.owner, 'Quarterly_Report-2024.pdf', 'application/pdf')
+        self.notes = self.create_file(self.owner, 'meeting notes.txt', 'text/plain')
+        self.private = self.create_file(self.other, 'report draft.docx', 'application/msword')
+
+    def create_file(self, user, name, content_type):
+        return File.objects.create(
+            uploaded_by=user,
+            file=SimpleUploadedFile(name, b'content'),
+            original_name=name,
+            file_size=7,
+            content_type=content_type
+        )
+
+    def search(self, query, **params):
+        response = self.client.get(reverse('file-search'), {'q': query, **params})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def ids(self, data):
+        return {row['id'] for row in data['results']}
+
+    def test_prefix_and_token_matching(self):
+        """Test names match on whole tokens and on token prefixes"""
+        self.client.force_authenticate(user=self.owner)
+        self.assertEqual(self.ids(self.search('report')), {str(self.report.id)})
+        self.assertEqual(self.ids(self.search('quart 2024')), {str(self.report.id)})
+        self.assertEqual(self.ids(self.search('text')), {str(self.notes.id)})
+        self.assertEqual(self.ids(self.search('meeting report')), set())
+
+    def test_search_scoped_to_accessible_files(self):
+        """Test other users' files only appear once shared"""
+        self.client.force_authenticate(user=self.other)
+        self.assertEqual(self.ids(self.search('report')), {str(self.private.id)})
+        FileShare.objects.create(file=self.report, user=self.other, permission='VIEW')
+        self.assertEqual(self.ids(self.search('report')), {str(self.private.id), str(self.report.id)})
+
+    def test_index_follows_rename_and_delete(self):
+        """Test the index is updated on save and delete"""
+        self.client.force_authenticate(user=self.owner)
+        self.notes.original_name = 'budget.xlsx'
+        self.notes.save()
+        self.assertEqual(self.ids(self.search('budget')), {str(self.notes.id)})
+        self.assertEqual(self.ids(self.search('meeting')), set())
+
+        self.report.delete()
+        self.assertEqual(self.ids(self.search('report')), set())
+
+    def test_keyset_pages(self):
+        """Test results come back in pages linked by cursors"""
+        for index in range(5):
+            self.create_file(self.owner, f'page{index}.txt', 'text/plain')
+        self.client.force_authenticate(user=self.owner)
+
+        seen = []
+        data = self.search('page', limit=2)
+        while True:
+            seen.extend(row['original_name'] for row in data['results'])
+            if not data['next']:
+                break
+            data = self.search('page', limit=2, cursor=data['next'])
+        self.assertEqual(seen, [f'page{index}.txt' for index in reversed(range(5))])
+
+        response = self.client.get(reverse('file-search'), {'q': 'page', 'cursor': 'garbage'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_rebuild_index(self):
+        """Test rebuilding re-indexes every file"""
+        self.assertEqual(search.rebuild_index(), 3)
+        self.client.force_authenticate(user=self.owner)
+        self.assertEqual(self.ids(self.search('notes')), {str(self.notes.id)})
+
+
+@override_settings(STORAGE_QUOTAS={'ADMIN': None, 'USER': 100 * 1024, 'GUEST': 1024})
+class StorageQuotaTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='quota@example.com', password='quotapass123')
+        self.user.role = 'USER'
+        self.user.save()
+        self.client.force_authenticate(user=self.user)
+
+    def upload(self, size, name='data.bin'):
+        return self.client.post(
+            reverse('file-upload'),
+            {'file': SimpleUploadedFile(name, os.urandom(size))},
+            format='multipart'
+        )
+
+    def test_usage_tracks_uploads_and_deletes(self):
+        """Test storage_used follows uploads and deletes"""
+        response = self.upload(2000)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.upload(3000)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.storage_used, 5000)
+
+        File.objects.get(id=response.data['id']).delete()
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.storage_used, 3000)
+
+    def test_upload_over_quota_rejected(self):
+        """Test uploads that would exceed the quota get 413 and leave no blob"""
+        self.assertEqual(self.upload(60 * 1024).status_code, status.HTTP_201_CREATED)
+        blobs_before = set(os.listdir(os.path.dirname(File.objects.get().file.path)))
+
+        response = self.upload(50 * 1024)
+        self.assertEqual(response.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        self.assertEqual(File.objects.count(), 1)
+        self.assertEqual(set(os.listdir(os.path.dirname(File.objects.get().file.path))), blobs_before)
+
+    @override_settings(STORAGE_QUOTA_MULTIPART_OVERHEAD=0)
+    def test_content_length_precheck(self):
+        """Test an oversized body is refused from its Content-Length"""
+        response = self.upload(200 * 1024)
+        self.assertEqual(response.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        self.assertFalse(File.objects.exists())
+
+    def test_user_override_and_unlimited_admin(self):
+        """Test a per-user quota overrides the role default"""
+        self.assertEqual(quotas.get_quota(self.user), 100 * 1024)
+        self.user.storage_quota = 500
+        self.assertEqual(quotas.get_quota(self.user), 500)
+        self.user.storage_quota = None
+        self.user.role = 'ADMIN'
+        self.assertIsNone(quotas.get_quota(self.user))
+
+    def test_reconcile_fixes_drift(self):
+        """Test reconcile_storage_usage recomputes usage from the File table"""
+        self.upload(1234)
+        User.objects.filter(pk=self.user.pk).update(storage_used=99)
+        call_command('reconcile_storage_usage', stdout=io.StringIO())
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.storage_used, 1234)
+
+
+@override_settings(INLINE_BLOB_MAX_BYTES=0)
+class BlobLayoutTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='layout@example.com', password='layoutpass123')
+        self.user.role = 'USER'
+        self.user.save()
+        self.client.force_authenticate(user=self.user)
+
+    def create_legacy_file(self, content=b'legacy content'):
+        file_obj = File(
+            uploaded_by=self.user,
+            original_name='legacy.txt',
+            file_size=len(content),
+            content_type='text/plain'
+        )
+        legacy_name = f'encrypted_files/{self.user.email}/legacy.enc'
+        file_obj.file.name = file_obj.file.storage.save(legacy_name, io.BytesIO(encrypt_file(content)))
+        file_obj.save()
+        self.addCleanup(lambda: file_obj.file.storage.delete(file_obj.file.name))
+        return file_obj
+
+    def test_new_uploads_are_sharded(self):
+        """Test new blobs land in blobs/ab/cd/ and not under the email"""
+        response = self.client.post(
+            reverse('file-upload'),
+            {'file': SimpleUploadedFile('new.txt', b'new content')},
+            format='multipart'
+        )
+        name = File.objects.get(id=response.data['id']).file.name
+        self.assertRegex(name, r'^blobs/[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{32}\.enc$')
+        self.assertNotIn(self.user.email, name)
+
+    def test_migrate_moves_blob_and_is_resumable(self):
+        """Test the command moves legacy blobs and a second run is a no-op"""
+        file_obj = self.create_legacy_file()
+        legacy_name = file_obj.file.name
+
+        stats = layout.migrate_all(workers=1)
+        self.assertEqual(stats['moved'], 1)
+        file_obj.refresh_from_db()
+        self.assertTrue(layout.is_sharded(file_obj.file.name))
+        self.assertFalse(file_obj.file.storage.exists(legacy_name))
+        self.assertEqual(read_blob(file_obj), read_blob(File.objects.get(pk=file_obj.pk)))
+
+        self.assertEqual(layout.migrate_all(workers=1)['moved'], 0)
+
+    def test_dry_run_moves_nothing(self):
+        """Test --dry-run only counts"""
+        file_obj = self.create_legacy_file()
+        output = io.StringIO()
+        call_command('migrate_blob_layout', '--dry-run', '--workers', '1', stdout=output)
+        self.assertIn('Would move 1', output.getvalue())
+        file_obj.refresh_from_db()
+        self.assertFalse(layout.is_sharded(file_obj.file.name))
+
+    def test_stale_reader_follows_moved_blob(self):
+        """Test a download that loaded the old path still succeeds after a move"""
+        file_obj = self.create_legacy_file(b'still readable')
+        stale = File.objects.get(pk=file_obj.pk)
+        layout.migrate_file(file_obj.pk)
+        self.assertEqual(decrypt_file(read_blob(stale)), b'still readable')
+
+    def test_resume_reuses_partial_copy(self):
+        """Test a copy left by an interrupted run is reused, not duplicated"""
+        file_obj = self.create_legacy_file()
+        storage = file_obj.file.storage
+        target = blob_path(file_obj, 'legacy.enc')
+        storage.save(target, io.BytesIO(b'partial'))
+        layout.migrate_file(file_obj.pk)
+        file_obj.refresh_from_db()
+        self.assertEqual(file_obj.file.name, target)
+        self.assertEqual(decrypt_file(read_blob(file_obj)), b'legacy content')
+
+
+class BlobReconcileTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = User.objects.create_user(email='reconcile@example.com', password='reconcilepass123')
+        self.kept = self.create_file('kept.txt')
+        self.dangling = self.create_file('dangling.txt')
+        os.remove(self.dangling.file.path)
+        self.orphan_path = self.write_blob('blobs/aa/bb/orphan.enc', age=7200)
+        self.recent_path = self.write_blob('blobs/aa/bb/recent.enc', age=0)
+
+    def create_file(self, name):
+        return File.objects.create(
+            uploaded_by=self.user,
+            file=SimpleUploadedFile(name, b'content'),
+            original_name=name,
+            file_size=7,
+            content_type='text/plain'
+        )
+
+    def write_blob(self, name, age):
+        path = os.path.join(self.media_root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b'orphaned')
+        mtime = timezone.now().timestamp() - age
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_walk_order_matches_string_order(self):
+        """Test the storage walk comes out sorted like ORDER BY file"""
+        self.write_blob('blobs/aa/b.enc', age=0)
+        self.write_blob('blobs/aa.enc', age=0)
+        names = [name for name, _, _ in reconcile.walk_storage(self.media_root)]
+        self.assertEqual(names, sorted(names))
+
+    def test_dry_run_reports_without_removing(self):
+        """Test dry-run finds the orphan and the dangling row but keeps both"""
+        found = []
+        stats = reconcile.reconcile(dry_run=True, parallel=False, report=lambda kind, name: found.append(kind))
+        self.assertEqual(sorted(found), ['dangling', 'orphan'])
+        self.assertEqual(stats['skipped_recent'], 1)
+        self.assertEqual(stats['removed'], 0)
+        self.assertTrue(os.path.exists(self.orphan_path))
+        self.assertTrue(File.objects.filter(pk=self.dangling.pk).exists())
+
+    def test_removes_orphans_and_dangling_rows(self):
+        """Test a real run removes old orphans and dangling rows only"""
+        stats = reconcile.reconcile(parallel=False)
+        self.assertEqual(stats['removed'], 2)
+        self.assertFalse(os.path.exists(self.orphan_path))
+        self.assertTrue(os.path.exists(self.recent_path))
+        self.assertFalse(File.objects.filter(pk=self.dangling.pk).exists())
+        self.assertTrue(os.path.exists(self.kept.file.path))
+
+
+@override_settings(INLINE_BLOB_MAX_BYTES=0)
+class BlobIntegrityTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='integrity@example.com', password='integritypass123')
+        self.client.force_authenticate(user=self.user)
+        response = self.client.post(
+            reverse('file-upload'),
+            {'file': SimpleUploadedFile('data.txt', b'important data')},
+            format='multipart'
+        )
+        self.file = File.objects.get(id=response.data['id'])
+        self.addCleanup(lambda: self.file.file.storage.delete(self.file.file.name))
+
+    def corrupt(self):
+        with open(self.file.file.path, 'r+b') as f:
+            f.seek(40)
+            byte = f.read(1)
+            f.seek(40)
+            f.write(bytes([byte[0] ^ 1]))
+
+    def download(self):
+        return self.client.get(reverse('file-download', kwargs={'file_id': str(self.file.id)}))
+
+    def test_checksum_recorded_on_upload(self):
+        """Test uploads store the SHA-256 of the encrypted blob"""
+        with open(self.file.file.path, 'rb') as f:
+            self.assertEqual(self.file.checksum, blob_checksum(f.read()))
+
+    def test_download_detects_corruption(self):
+        """Test a flipped bit fails the download instead of returning garbage"""
+        self.assertEqual(self.download().status_code, status.HTTP_200_OK)
+        self.corrupt()
+        self.assertEqual(self.download().status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        with self.assertRaises(BlobCorrupted):
+            list(iter_decrypted(self.file))
+
+    def test_scrub_verifies_and_flags(self):
+        """Test the scrubber records verification and reports corrupt blobs"""
+        stats = scrub.scrub(max_age=timedelta(days=1), workers=1)
+        self.assertEqual(stats['ok'], 1)
+        self.file.refresh_from_db()
+        verified_at = self.file.last_verified_at
+        self.assertIsNotNone(verified_at)
+
+        # Recently verified files are not due again
+        self.assertEqual(scrub.scrub(max_age=timedelta(days=1), workers=1)['ok'], 0)
+
+        self.corrupt()
+        stats = scrub.scrub(max_age=timedelta(0), workers=1)
+        self.assertEqual(stats['bad_file_ids'], [self.file.id])
+        self.file.refresh_from_db()
+        self.assertEqual(self.file.last_verified_at, verified_at)
+
+    def test_scrub_backfills_legacy_checksum(self):
+        """Test files uploaded before checksums get one on their first scrub"""
+        File.objects.filter(pk=self.file.pk).update(checksum='')
+        stats = scrub.scrub(max_age=timedelta(days=1), workers=1)
+        self.assertEqual(stats['backfilled'], 1)
+        self.file.refresh_from_db()
+        with open(self.file.file.path, 'rb') as f:
+            self.assertEqual(self.file.checksum, blob_checksum(f.read()))
+
+
+@override_settings(FILE_ENCRYPTION_KEYS={'v2': 'second-master-key'}, INLINE_BLOB_MAX_BYTES=0)
+class KeyRotationTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='rotate@example.com', password='rotatepass123')
+        self.client.force_authenticate(user=self.user)
+        self.file = self.upload(b'rotate me')
+
+    def upload(self, content):
+        response = self.client.post(
+            reverse('file-upload'),
+            {'file': SimpleUploadedFile('secret.txt', content)},
+            format='multipart'
+        )
+        file_obj = File.objects.get(id=response.data['id'])
+        self.addCleanup(lambda: File.objects.filter(pk=file_obj.pk).exists() and File.objects.get(pk=file_obj.pk).file.delete(save=False))
+        return file_obj
+
+    def download(self, file_obj):
+        return self.client.get(reverse('file-download', kwargs={'file_id': str(file_obj.id)}))
+
+    def test_blobs_record_their_key(self):
+        """Test uploads record the current key id and stay readable after it changes"""
+        self.assertEqual(self.file.key_id, 'default')
+        with self.settings(FILE_ENCRYPTION_KEY_ID='v2'):
+            newer = self.upload(b'new key')
+            self.assertEqual(newer.key_id, 'v2')
+            self.assertEqual(b''.join(self.download(self.file).streaming_content), b'rotate me')
+            self.assertEqual(b''.join(self.download(newer).streaming_content), b'new key')
+
+    def test_rotation_reencrypts_and_is_resumable(self):
+        """Test rotation moves every blob to the new key and a rerun does nothing"""
+        old_name = self.file.file.name
+        generate_preview(self.file.id)
+        with self.settings(FILE_ENCRYPTION_KEY_ID='v2'):
+            stats = rotation.rotate('v2', workers=1)
+            self.assertEqual(stats['rotated'], 1)
+            self.file.refresh_from_db()
+            self.assertEqual(self.file.key_id, 'v2')
+            self.assertEqual(FilePreview.objects.get(file=self.file).key_id, 'v2')
+            self.assertFalse(self.file.file.storage.exists(old_name))
+            self.assertEqual(rotation.keys_in_use(), {'v2': 2})
+            self.assertEqual(b''.join(self.download(self.file).streaming_content), b'rotate me')
+            self.assertEqual(rotation.rotate('v2', workers=1)['rotated'], 0)
+        FilePreview.objects.get(file=self.file).blob.delete(save=False)
+
+    def test_stale_reader_follows_rotated_blob(self):
+        """Test a row loaded before rotation still decrypts afterwards"""
+        stale = File.objects.get(pk=self.file.pk)
+        rotation.rotate_file(self.file.pk, 'v2')
+        self.assertEqual(b''.join(iter_decrypted(stale)), b'rotate me')
+        self.assertEqual(stale.key_id, 'v2')
+
+
+@override_settings(COALESCE_BUFFER_CHUNKS=2, COALESCE_LEAD_CHUNKS=1)
+class DownloadCoalescingTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='coalesce@example.com', password='coalescepass123')
+        self.content = os.urandom(10 * 64 * 1024 + 123)
+        self.file = File(
+            uploaded_by=self.user,
+            original_name='big.bin',
+            file_size=len(self.content),
+            content_type='application/octet-stream'
+        )
+        self.file.file.save('big.enc', SimpleUploadedFile('big.enc', encrypt_file(self.content)), save=False)
+        self.file.save()
+        self.addCleanup(lambda: self.file.file.delete(save=False))
+
+    def test_ranged_decrypt_matches(self):
+        """Test decrypting from an offset returns the same bytes as the full stream"""
+        for offset in (16, 100, 64 * 1024, len(self.content) - 5):
+            self.assertEqual(b''.join(iter_decrypted(self.file, offset=offset)), self.content[offset:])
+
+    def test_concurrent_readers_share_one_stream(self):
+        """Test readers that join together are served by a single decrypt"""
+        streams_before = coalesce.stats['streams']
+        readers = [coalesce.stream_file(self.file) for _ in range(3)]
+        self.assertEqual(coalesce.stats['streams'], streams_before + 1)
+        outputs = [bytearray() for _ in readers]
+        # Interleave consumption like concurrent responses would
+        active = list(zip(readers, outputs))
+        while active:
+            for reader, output in list(active):
+                chunk = next(reader, None)
+                if chunk is None:
+                    active.remove((reader, output))
+                else:
+                    output += chunk
+        for output in outputs:
+            self.assertEqual(bytes(output), self.content)
+
+    def test_slow_reader_is_detached(self):
+        """Test a reader that falls behind continues on its own stream"""
+        detached_before = coalesce.stats['detached']
+        fast = coalesce.stream_file(self.file)
+        slow = coalesce.stream_file(self.file)
+        slow_output = bytearray(next(slow))
+        self.assertEqual(b''.join(fast), self.content)
+        slow_output += b''.join(slow)
+        self.assertEqual(bytes(slow_output), self.content)
+        self.assertEqual(coalesce.stats['detached'], detached_before + 1)
+
+    def test_share_link_streams_file(self):
+        """Test public link downloads go through the shared stream"""
+        link = ShareableLink.objects.create(
+            file=self.file,
+            created_by=self.user,
+            expires_at=timezone.now() + timedelta(hours=1)
+        )
+        response = self.client.get(reverse('download-shared-link', kwargs={'link_id': str(link.id)}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertEqual(response['Content-Length'], str(len(self.content)))
+
+
+class DownloadGovernorTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.owner = User.objects.create_user(email='governor@example.com', password='governorpass123')
+        self.owner.role = 'USER'
+        self.owner.save()
+        self.file = File.objects.create(
+            uploaded_by=self.owner,
+            file=SimpleUploadedFile('data.enc', encrypt_file(b'x' * 1000)),
+            original_name='data.txt',
+            file_size=1000,
+            content_type='text/plain'
+        )
+        self.addCleanup(lambda: self.file.file.delete(save=False))
+        self.link = ShareableLink.objects.create(
+            file=self.file, created_by=self.owner, expires_at=timezone.now() + timedelta(hours=1)
+        )
+
+    def get_link(self):
+        return self.client.get(reverse('download-shared-link', kwargs={'link_id': str(self.link.id)}))
+
+    @override_settings(DOWNLOAD_LINK_LIMITS={'USER': {'concurrent': 1}}, DOWNLOAD_RETRY_AFTER=7)
+    def test_link_concurrency_limit(self):
+        """Test a second concurrent download of a link gets 429 with Retry-After"""
+        first = self.get_link()
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        second = self.get_link()
+        self.assertEqual(second.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(second['Retry-After'], '7')
+
+        # Finishing the first download frees its slot
+        b''.join(first.streaming_content)
+        first.close()
+        self.assertEqual(self.get_link().status_code, status.HTTP_200_OK)
+
+    @override_settings(DOWNLOAD_USER_LIMITS={'USER': {'concurrent': 1}})
+    def test_user_concurrency_limit(self):
+        """Test per-user limits apply by the downloader's role"""
+        self.client.force_authenticate(user=self.owner)
+        url = reverse('file-download', kwargs={'file_id': str(self.file.id)})
+        first = self.client.get(url)
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        first.close()
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+
+    @override_settings(DOWNLOAD_USER_LIMITS={'USER': {'concurrent': 1}}, DOWNLOAD_RETRY_AFTER=7)
+    def test_bulk_download_takes_a_slot(self):
+        """Test a bulk download counts against the user's concurrent downloads"""
+        self.client.force_authenticate(user=self.owner)
+        bulk = lambda: self.client.post(reverse('file-bulk-download'), {'file_ids': [str(self.file.id)]}, format='json')
+        first = bulk()
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        second = bulk()
+        self.assertEqual(second.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(second['Retry-After'], '7')
+        url = reverse('file-download', kwargs={'file_id': str(self.file.id)})
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+        # Finishing the archive frees its slot
+        b''.join(first.streaming_content)
+        first.close()
+        self.assertEqual(bulk().status_code, status.HTTP_200_OK)
+
+    def test_token_bucket_paces_bytes(self):
+        """Test the bucket allows a one second burst and then asks for sleeps"""
+        bucket = governor.TokenBucket(rate=1000)
+        self.assertEqual(bucket.consume(1000), 0)
+        self.assertAlmostEqual(bucket.consume(500), 0.5, places=1)
+
+
+class FileEventsTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.owner = User.objects.create_user(email='events@example.com', password='eventspass123')
+        self.other = User.objects.create_user(email='watcher@example.com', password='watcherpass123')
+
+    async def connect(self, user=None):
+        headers = []
+        if user is not None:
+            # for_user() records the refresh token in the outstanding table
+            token = await sync_to_async(lambda: str(RefreshToken.for_user(user).access_token))()
+            headers.append((b'cookie', f'access_token={token}'.encode()))
+        communicator = WebsocketCommunicator(
+            CookieJWTAuthMiddleware(URLRouter(websocket_urlpatterns)), '/ws/files/', headers=headers
+        )
+        connected, _ = await communicator.connect()
+        return communicator, connected
+
+    def upload(self, url, content):
+        self.client.force_authenticate(user=self.owner)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(url, {'file': SimpleUploadedFile('live.bin', content)}, format='multipart')
+        return File.objects.get(id=response.data['id'])
+
+    def share(self, file_obj):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                reverse('file-share', kwargs={'file_id': str(file_obj.id)}),
+                {'email': self.other.email, 'permission': 'VIEW'}
+            )
+
+    def delete(self, file_obj):
+        with self.captureOnCommitCallbacks(execute=True):
+            file_obj.delete()
+
+    async def test_anonymous_socket_rejected(self):
+        """Test sockets need the access_token cookie"""
+        communicator, connected = await self.connect()
+        self.assertFalse(connected)
+
+    async def test_upload_share_and_delete_are_pushed(self):
+        """Test owners and share recipients get file events"""
+        owner_socket, connected = await self.connect(self.owner)
+        self.assertTrue(connected)
+        other_socket, _ = await self.connect(self.other)
+
+        file_obj = await sync_to_async(self.upload)(reverse('file-upload'), b'live data')
+        event = await owner_socket.receive_json_from(timeout=2)
+        self.assertEqual((event['type'], event['file']['id']), ('file.created', str(file_obj.id)))
+
+        await sync_to_async(self.share)(file_obj)
+        event = await other_socket.receive_json_from(timeout=2)
+        self.assertEqual((event['type'], event['permission']), ('share.created', 'VIEW'))
+
+        deleted = {'type': 'file.deleted', 'file_id': str(file_obj.id)}
+        await sync_to_async(self.delete)(file_obj)
+        self.assertEqual(await owner_socket.receive_json_from(timeout=2), deleted)
+        self.assertEqual(await other_socket.receive_json_from(timeout=2), deleted)
+
+        await owner_socket.disconnect()
+        await other_socket.disconnect()
+
+    @override_settings(UPLOAD_PROGRESS_INTERVAL=0)
+    async def test_upload_progress_is_pushed(self):
+        """Test uploads tagged with an upload_id report progress"""
+        socket, _ = await self.connect(self.owner)
+        await sync_to_async(self.upload)(reverse('file-upload') + '?upload_id=abc', os.urandom(200 * 1024))
+
+        event = await socket.receive_json_from(timeout=2)
+        self.assertEqual((event['type'], event['upload_id']), ('upload.progress', 'abc'))
+        while event['type'] == 'upload.progress' and not event['done']:
+            event = await socket.receive_json_from(timeout=2)
+        self.assertTrue(event['done'])
+        self.assertGreaterEqual(event['received'], 200 * 1024)
+        await socket.disconnect()
+
+
+@override_settings(FILE_CHUNK_SIZES={'min': 64, 'avg': 256, 'max': 1024})
+class FileVersionTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='versions@example.com', password='versionspass123')
+        self.client.force_authenticate(user=self.user)
+        # Fixed data keeps the chunk counts below stable
+        self.original = random.Random(41).randbytes(20 * 1024)
+        self.edited = self.original[:10000] + b'an edit in the middle' + self.original[10000:]
+        response = self.client.post(
+            reverse('file-upload'),
+            {'file': SimpleUploadedFile('report.bin', self.original)},
+            format='multipart'
+        )
+        self.file = File.objects.get(id=response.data['id'])
+
+    def split(self, data):
+        return list(chunking.iter_chunks(io.BytesIO(data)))
+
+    def download(self, number=None):
+        if number is None:
+            url = reverse('file-download', kwargs={'file_id': str(self.file.id)})
+        else:
+            url = reverse('file-version-download', kwargs={'file_id': str(self.file.id), 'number': number})
+        return b''.join(self.client.get(url).streaming_content)
+
+    def test_chunk_boundaries_follow_content(self):
+        """Test an insertion only changes the chunks around it"""
+        before, after = self.split(self.original), self.split(self.edited)
+        self.assertEqual(b''.join(after), self.edited)
+        self.assertTrue(all(len(chunk) <= 1024 for chunk in after))
+        unchanged = set(before) & set(after)
+        self.assertGreaterEqual(len(unchanged), len(before) - 3)
+
+    def test_reupload_stores_only_changed_chunks(self):
+        """Test a new version keeps the old one and stores only new chunks"""
+        old_blob = self.file.file.name
+        response = self.client.post(
+            reverse('file-versions', kwargs={'file_id': str(self.file.id)}),
+            {'file': SimpleUploadedFile('report.bin', self.edited)},
+            format='multipart'
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['number'], 2)
+
+        self.file.refresh_from_db()
+        self.assertEqual((self.file.version, self.file.file_size, self.file.file.name), (2, len(self.edited), ''))
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, old_blob)))
+        self.assertEqual(Chunk.objects.count(), len(set(self.split(self.original)) | set(self.split(self.edited))))
+        self.assertLess(Chunk.objects.count(), len(self.split(self.original)) + 4)
+
+        self.assertEqual(self.download(), self.edited)
+        self.assertEqual(self.download(1), self.original)
+        self.assertEqual(b''.join(iter_decrypted(self.file, offset=5000)), self.edited[5000:])
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.storage_used, len(self.edited))
+
+        listing = self.client.get(reverse('file-versions', kwargs={'file_id': str(self.file.id)})).data
+        self.assertEqual([row['number'] for row in listing['versions']], [2, 1])
+        self.assertEqual(listing['current'], 2)
+
+    def test_client_sends_only_missing_chunks(self):
+        """Test the chunk protocol: ask what is missing, upload it, commit the manifest"""
+        def commit(data, base_version):
+            chunks = self.split(data)
+            digests = [versions.chunk_digest(chunk) for chunk in chunks]
+            missing = self.client.post(reverse('chunk-missing'), {'digests': digests}, format='json').data['missing']
+            for chunk in chunks:
+                digest = versions.chunk_digest(chunk)
+                if digest in missing:
+                    missing.remove(digest)
+                    response = self.client.put(
+                        reverse('chunk-upload', kwargs={'digest': digest}), chunk,
+                        content_type='application/octet-stream'
+                    )
+                    self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            return self.client.post(
+                reverse('file-versions', kwargs={'file_id': str(self.file.id)}),
+                {'chunks': digests, 'base_version': base_version}, format='json'
+            )
+
+        self.assertEqual(commit(self.original, 0).data['number'], 2)
+        stored = Chunk.objects.count()
+        self.assertEqual(commit(self.edited, 2).status_code, status.HTTP_201_CREATED)
+        self.assertLessEqual(Chunk.objects.count() - stored, 4)
+        self.assertEqual(self.download(), self.edited)
+        self.assertEqual(commit(self.original, 2).status_code, status.HTTP_409_CONFLICT)
+
+    def test_manifest_with_unknown_chunks_is_rejected(self):
+        """Test committing chunks that were never uploaded fails and names them"""
+        digest = versions.chunk_digest(b'never uploaded')
+        response = self.client.post(
+            reverse('file-versions', kwargs={'file_id': str(self.file.id)}),
+            {'chunks': [digest]}, format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['missing'], [digest])
+
+        response = self.client.put(
+            reverse('chunk-upload', kwargs={'digest': digest}), b'something else',
+            content_type='application/octet-stream'
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_pending_chunks_are_limited(self):
+        """Test uploaded chunks count against the quota and the pending cap until committed"""
+        def put(data):
+            return self.client.put(
+                reverse('chunk-upload', kwargs={'digest': versions.chunk_digest(data)}), data,
+                content_type='application/octet-stream'
+            )
+
+        first, second = b'a' * 800, b'b' * 800
+        self.user.refresh_from_db()
+        self.user.storage_quota = self.user.storage_used + 1200
+        self.user.save()
+        self.assertEqual(put(first).status_code, status.HTTP_201_CREATED)
+        self.assertEqual(put(second).status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        # A chunk the user already holds costs nothing more
+        self.assertEqual(put(first).status_code, status.HTTP_201_CREATED)
+        self.assertEqual(versions.pending_bytes(self.user.id), 800)
+
+        self.user.storage_quota = None
+        self.user.save()
+        with self.settings(PENDING_CHUNKS_MAX_BYTES=1200):
+            self.assertEqual(put(second).status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        self.assertEqual(put(second).status_code, status.HTTP_201_CREATED)
+
+    @override_settings(FILE_VERSIONS_KEPT=1)
+    def test_prune_removes_chunks_of_dropped_versions(self):
+        """Test chunks only old versions used are removed once those versions go"""
+        url = reverse('file-versions', kwargs={'file_id': str(self.file.id)})
+        self.client.post(url, {'file': SimpleUploadedFile('report.bin', os.urandom(4096))}, format='multipart')
+        self.assertEqual(list(FileVersion.objects.filter(file=self.file).values_list('number', flat=True)), [2])
+
+        call_command('prune_chunks', '--min-age', '0', stdout=io.StringIO())
+        self.assertEqual(Chunk.objects.filter(entries__isnull=True).count(), 0)
+        self.assertEqual(
+            sum(len(files) for _, _, files in os.walk(os.path.join(self.media_root, 'blobs'))),
+            Chunk.objects.count()
+        )
+        self.assertEqual(len(self.download()), 4096)
+
+
+
+class FileListingTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.owner = User.objects.create_user(email='owner@example.com', password='ownerpass123')
+        self.owner.role = 'USER'
+        self.owner.save()
+        self.sharee = User.objects.create_user(email='sharee@example.com', password='shareepass123')
+        self.sharee.role = 'USER'
+        self.sharee.save()
+        self.admin = User.objects.create_user(email='admin@example.com', password='adminpass123')
+        self.admin.role = 'ADMIN'
+        self.admin.save()
+        for index, permission in enumerate(['DOWNLOAD', 'VIEW', None]):
+            file = File.objects.create(
+                uploaded_by=self.owner,
+                name=f'r\u00e9sum\u00e9 {index} \u2028',
+                file=f'blobs/listing/{index}.enc',
+                original_name=f'r\u00e9sum\u00e9-{index}.txt',
+                file_size=index * 1000,
+                content_type='text/plain',
+                version=index,
+            )
+            if permission:
+                FileShare.objects.create(file=file, user=self.sharee, permission=permission)
+
+    def assertMatchesSerializer(self, queryset, user):
+        queryset = with_share_permission(queryset, user)
+        context = {'request': SimpleNamespace(user=user)}
+        expected = JSONRenderer().render(FileSerializer(queryset, many=True, context=context).data)
+        self.assertEqual(FastJSONRenderer().render(file_rows(queryset, user)), expected)
+        return expected
+
+    def test_rows_match_serializer(self):
+        """Test file_rows renders byte-identical JSON to FileSerializer for owners, sharees and admins"""
+        self.assertMatchesSerializer(File.objects.filter(uploaded_by=self.owner), self.owner)
+        self.assertMatchesSerializer(File.objects.filter(shares__user=self.sharee), self.sharee)
+        self.assertMatchesSerializer(File.objects.exclude(uploaded_by=self.admin), self.admin)
+        self.assertMatchesSerializer(File.objects.all(), self.sharee)
+
+    def test_endpoints_use_rows(self):
+        """Test the list and shared endpoints return the serializer's output"""
+        self.client.force_authenticate(user=self.sharee)
+        response = self.client.get(reverse('file-shared'))
+        expected = self.assertMatchesSerializer(File.objects.filter(shares__user=self.sharee), self.sharee)
+        self.assertEqual(response.content, expected)
+        self.assertEqual([row['can_download'] for row in response.json()], [False, True])
+
+        self.client.force_authenticate(user=self.owner)
+        response = self.client.get(reverse('file-list'))
+        self.assertEqual(response.content, self.assertMatchesSerializer(File.objects.filter(uploaded_by=self.owner), self.owner))
+
+    def test_listing_benchmark(self):
+        """Test the listing benchmark checks every mode against FileSerializer"""
+        results = benchmarks.run_listing_benchmarks([20], repeat=1)
+        self.assertEqual({(result['op'], result['mode']) for result in results}, {
+            (op, mode) for op in ('list', 'shared') for mode in ('serializer+json', 'rows+json', 'rows+orjson')
+        })
+        self.assertFalse(File.objects.filter(file__startswith='blobs/bench/').exists())
+
+
+@override_settings(RESPONSE_CACHE_TIMEOUT=300, METRICS_FLUSH_SECONDS=0)
+class ResponseCacheTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.owner = User.objects.create_user(email='owner@example.com', password='ownerpass123')
+        self.owner.role = 'USER'
+        self.owner.save()
+        self.sharee = User.objects.create_user(email='sharee@example.com', password='shareepass123')
+        self.sharee.role = 'USER'
+        self.sharee.save()
+        self.file = self.create_file('first.txt')
+
+    def create_file(self, name):
+        with self.captureOnCommitCallbacks(execute=True):
+            return File.objects.create(
+                uploaded_by=self.owner,
+                file=f'blobs/cache/{name}.enc',
+                original_name=name,
+                file_size=10,
+                content_type='text/plain',
+            )
+
+    def get(self, user, name, **headers):
+        self.client.force_authenticate(user=user)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse(name), **headers)
+        listed = any('FROM "filemanager_file"' in query['sql'] for query in context.captured_queries)
+        return response, listed
+
+    @override_settings(RESPONSE_CACHE_TIMEOUT=0)
+    def test_no_invalidation_when_disabled(self):
+        """Test uploads and file changes neither look up sharees nor write tokens with the cache off"""
+        FileShare.objects.create(file=self.file, user=self.sharee, permission='VIEW')
+        self.client.force_authenticate(user=self.owner)
+        with CaptureQueriesContext(connection) as context, self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse('file-upload'),
+                {'file': SimpleUploadedFile('new.txt', b'new content')},
+                format='multipart'
+            )
+            self.file.original_name = 'renamed.txt'
+            self.file.save()
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        sqls = [query['sql'] for query in context.captured_queries]
+        self.assertFalse([sql for sql in sqls if 'filemanager_fileshare' in sql or 'response_cache' in sql])
+
+    def test_list_is_cached_and_revalidated(self):
+        """Test a repeated list is served from the cache and an unchanged ETag gets 304"""
+        first, listed = self.get(self.owner, 'file-list')
+        self.assertTrue(listed)
+        second, listed = self.get(self.owner, 'file-list')
+        self.assertFalse(listed)
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(second['ETag'], first['ETag'])
+        self.assertEqual(second['Cache-Control'], 'private, no-cache')
+
+        response, listed = self.get(self.owner, 'file-list', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertFalse(listed)
+        self.assertEqual(response.content, b'')
+
+        # Other users never see this user's entry
+        response, listed = self.get(self.sharee, 'file-list')
+        self.assertTrue(listed)
+        self.assertEqual(response.json(), [])
+
+    def test_file_changes_invalidate(self):
+        """Test new and deleted files retire the owner's cached list"""
+        first, _ = self.get(self.owner, 'file-list')
+        second_file = self.create_file('second.txt')
+        response, listed = self.get(self.owner, 'file-list', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(listed)
+        self.assertEqual(len(response.json()), 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second_file.delete()
+        response, _ = self.get(self.owner, 'file-list')
+        self.assertEqual([row['original_name'] for row in response.json()], ['first.txt'])
+
+    def test_share_changes_invalidate(self):
+        """Test sharing, changing and removing a share retire the recipient's cached shared list"""
+        response, _ = self.get(self.sharee, 'file-shared')
+        self.assertEqual(response.json(), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            share = FileShare.objects.create(file=self.file, user=self.sharee, permission='VIEW')
+        response, _ = self.get(self.sharee, 'file-shared')
+        self.assertEqual([row['can_download'] for row in response.json()], [False])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            share.permission = 'DOWNLOAD'
+            share.save()
+        response, _ = self.get(self.sharee, 'file-shared')
+        self.assertEqual([row['can_download'] for row in response.json()], [True])
+
+        # Renaming the shared file reaches the recipient too
+        with self.captureOnCommitCallbacks(execute=True):
+            self.file.original_name = 'renamed.txt'
+            self.file.save()
+        response, _ = self.get(self.sharee, 'file-shared')
+        self.assertEqual([row['original_name'] for row in response.json()], ['renamed.txt'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            share.delete()
+        response, _ = self.get(self.sharee, 'file-shared')
+        self.assertEqual(response.json(), [])
+
+    def test_role_changes_invalidate(self):
+        """Test role changes, one at a time or in bulk, retire cached check-auth and shared responses"""
+        response, _ = self.get(self.sharee, 'check-auth')
+        self.assertEqual(response.json()['user']['role'], 'USER')
+        response, _ = self.get(self.sharee, 'file-shared')
+        self.assertEqual(response.json(), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.sharee.role = 'ADMIN'
+            self.sharee.save()
+        response, _ = self.get(self.sharee, 'check-auth')
+        self.assertEqual(response.json()['user']['role'], 'ADMIN')
+        # Admins see every other user's files
+        response, _ = self.get(self.sharee, 'file-shared')
+        self.assertEqual(len(response.json()), 1)
+        self.create_file('second.txt')
+        response, _ = self.get(self.sharee, 'file-shared')
+        self.assertEqual(len(response.json()), 2)
+
+        self.client.force_authenticate(user=self.sharee)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse('user-bulk-role'), {'ids': [self.owner.id], 'role': 'GUEST'}, format='json'
+            )
+        self.assertEqual(response.data['updated'], 1)
+        self.owner.refresh_from_db()
+        response, _ = self.get(self.owner, 'check-auth')
+        self.assertEqual(response.json()['user']['role'], 'GUEST')
+
+    def test_disabled(self):
+        """Test RESPONSE_CACHE_TIMEOUT=0 lists every time without an ETag"""
+        with self.settings(RESPONSE_CACHE_TIMEOUT=0):
+            self.get(self.owner, 'file-list')
+            response, listed = self.get(self.owner, 'file-list')
+        self.assertTrue(listed)
+        self.assertNotIn('ETag', response)
+
+    def test_metrics(self):
+        """Test the metrics endpoint reports the hit ratio to admins only"""
+        self.get(self.owner, 'file-list')
+        self.get(self.owner, 'file-list')
+        first, _ = self.get(self.owner, 'file-list')
+        self.get(self.owner, 'file-list', HTTP_IF_NONE_MATCH=first['ETag'])
+
+        response, _ = self.get(self.owner, 'metrics')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.owner.role = 'ADMIN'
+        self.owner.save()
+        response, _ = self.get(self.owner, 'metrics')
+        self.assertEqual(response.data['response_cache']['files'], {
+            'hit': 2, 'miss': 1, 'not_modified': 1, 'hit_ratio': 0.75,
+        })
+        self.assertIsNone(response.data['response_cache']['auth']['hit_ratio'])
+
+
+class StorageStatsTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.admin = User.objects.create_user(email='admin@example.com', password='adminpass123')
+        self.owner = User.objects.create_user(email='owner@example.com', password='ownerpass123')
+        self.owner.role = 'USER'
+        self.owner.save()
+        self.sharee = User.objects.create_user(email='sharee@example.com', password='shareepass123')
+
+    def create_file(self, user, size):
+        return File.objects.create(
+            uploaded_by=user,
+            file=f'blobs/stats/{uuid.uuid4().hex}.enc',
+            original_name='stats.txt',
+            file_size=size,
+            content_type='text/plain',
+        )
+
+    def snapshot(self):
+        users = {row['id']: row for row in stats.top_users(100)}
+        return stats.totals(), users
+
+    def test_rollups_follow_changes(self):
+        """Test uploads, deletes, shares and links keep the rollups equal to a full recount"""
+        first = self.create_file(self.owner, 1000)
+        second = self.create_file(self.owner, 250)
+        self.create_file(self.sharee, 5)
+        share = FileShare.objects.create(file=first, user=self.sharee, permission='VIEW')
+        FileShare.objects.create(file=second, user=self.sharee, permission='VIEW')
+        ShareableLink.objects.create(file=first, created_by=self.owner, expires_at=timezone.now() + timedelta(hours=1))
+        share.delete()
+        second.delete()
+
+        totals, users = self.snapshot()
+        self.assertEqual(totals, {'files': 2, 'bytes': 1005, 'shares': 0, 'links': 1})
+        self.assertEqual(
+            {key: users[self.owner.id][key] for key in ('files', 'bytes', 'shares', 'links')},
+            {'files': 1, 'bytes': 1000, 'shares': 0, 'links': 1}
+        )
+        self.assertEqual(stats.rebuild(), totals)
+        self.assertEqual(self.snapshot(), (totals, users))
+
+        today = stats.daily(1)[0]
+        self.assertEqual(today['day'], timezone.localdate().isoformat())
+        self.assertEqual(
+            {key: today[key] for key in stats.DAILY_FIELDS},
+            {'uploads': 3, 'uploaded_bytes': 1255, 'deletions': 1, 'deleted_bytes': 250, 'shares': 2, 'links': 1}
+        )
+
+    def test_backfill_daily(self):
+        """Test the daily history is seeded from the uploads, shares and links on record"""
+        file = self.create_file(self.owner, 40)
+        self.create_file(self.owner, 2)
+        FileShare.objects.create(file=file, user=self.sharee, permission='VIEW')
+        DailyStorageStats.objects.all().delete()
+        stats.backfill_daily()
+        today = stats.daily(1)[0]
+        self.assertEqual((today['uploads'], today['uploaded_bytes'], today['shares']), (2, 42, 1))
+
+    def test_deleting_a_user(self):
+        """Test a user's files, shares and links leave the totals with them"""
+        file = self.create_file(self.sharee, 10)
+        self.create_file(self.owner, 20)
+        FileShare.objects.create(file=file, user=self.owner, permission='VIEW')
+        ShareableLink.objects.create(file=file, created_by=self.sharee, expires_at=timezone.now() + timedelta(hours=1))
+        self.sharee.delete()
+
+        self.assertEqual(stats.totals(), {'files': 1, 'bytes': 20, 'shares': 0, 'links': 0})
+        self.assertFalse(UserStorageStats.objects.filter(user_id=self.sharee.id).exists())
+        self.assertEqual(stats.rebuild(), stats.totals())
+
+    def test_sharded_totals(self):
+        """Test totals add up over every shard"""
+        with self.settings(STORAGE_STATS_SHARDS=2):
+            self.create_file(self.owner, 7)
+            self.create_file(self.sharee, 11)
+        self.assertEqual(stats.totals()['bytes'], 18)
+
+    def test_endpoint(self):
+        """Test admins get totals, the largest users and zero-filled daily activity"""
+        self.create_file(self.owner, 300)
+        self.create_file(self.sharee, 100)
+
+        self.client.force_authenticate(user=self.owner)
+        response = self.client.get(reverse('storage-stats'))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        self.client.force_authenticate(user=self.admin)
+        response = self.client.get(reverse('storage-stats'), {'limit': 1, 'days': 7})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['totals']['bytes'], 400)
+        self.assertEqual([user['email'] for user in response.data['users']], ['owner@example.com'])
+        self.assertEqual(len(response.data['days']), 7)
+        self.assertEqual([day['uploads'] for day in response.data['days']], [0] * 6 + [2])
+
+
+class AccessLogTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.admin = User.objects.create_user(email='admin@example.com', password='adminpass123')
+        self.owner = User.objects.create_user(email='owner@example.com', password='ownerpass123')
+        self.owner.role = 'USER'
+        self.owner.save()
+        self.other = User.objects.create_user(email='other@example.com', password='otherpass123')
+        self.content = os.urandom(3 * 64 * 1024 + 7)
+        self.file = File(
+            uploaded_by=self.owner,
+            original_name='audited.bin',
+            file_size=len(self.content),
+            content_type='application/octet-stream'
+        )
+        self.file.file.save('audited.enc', SimpleUploadedFile('audited.enc', encrypt_file(self.content)), save=False)
+        self.file.save()
+        self.addCleanup(lambda: self.file.file.delete(save=False))
+        # Downloads in other tests leave events queued
+        audit.buffer.drain()
+
+    def download(self, user=None):
+        self.client.force_authenticate(user=user or self.owner)
+        response = self.client.get(reverse('file-download', kwargs={'file_id': str(self.file.id)}))
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+
+    def test_downloads_are_recorded(self):
+        """Test direct and public link downloads are written once flushed"""
+        self.download()
+        link = ShareableLink.objects.create(
+            file=self.file, created_by=self.owner, expires_at=timezone.now() + timedelta(hours=1)
+        )
+        self.client.force_authenticate(user=None)
+        response = self.client.get(reverse('download-shared-link', kwargs={'link_id': str(link.id)}), REMOTE_ADDR='10.0.0.9')
+        b''.join(response.streaming_content)
+
+        self.assertFalse(AccessEvent.objects.exists())
+        with self.assertNumQueries(1):
+            self.assertEqual(audit.flush(), 2)
+        direct, public = AccessEvent.objects.order_by('id')
+        self.assertEqual((direct.kind, direct.user_id, direct.link_id), ('DOWNLOAD', self.owner.id, None))
+        self.assertEqual((public.kind, public.user_id, public.link_id, public.ip), ('LINK', None, link.id, '10.0.0.9'))
+        for event in (direct, public):
+            self.assertEqual((event.file_id, event.bytes, event.completed), (self.file.id, len(self.content), True))
+
+    def test_abandoned_download(self):
+        """Test a download closed early is recorded as incomplete with the bytes sent"""
+        self.client.force_authenticate(user=self.owner)
+        response = self.client.get(reverse('file-download', kwargs={'file_id': str(self.file.id)}))
+        first = next(iter(response.streaming_content))
+        response.close()
+        audit.flush()
+        event = AccessEvent.objects.get()
+        self.assertEqual((event.bytes, event.completed), (len(first), False))
+
+    @override_settings(AUDIT_QUEUE_SIZE=1, METRICS_FLUSH_SECONDS=0)
+    def test_full_queue_drops(self):
+        """Test events beyond the queue size are dropped and counted"""
+        metrics.reset(audit.METRICS)
+        buffer = audit.AuditBuffer()
+        event = lambda: AccessEvent(kind='DOWNLOAD', file_id=self.file.id, occurred_at=timezone.now())
+        self.assertTrue(buffer.put(event()))
+        self.assertFalse(buffer.put(event()))
+        with self.settings(AUDIT_OVERFLOW='block', AUDIT_BLOCK_SECONDS=0.01):
+            self.assertFalse(buffer.put(event()))
+        self.assertEqual(buffer.flush(), 1)
+        self.assertEqual(metrics.read(audit.METRICS), {'audit.written': 1, 'audit.dropped': 2})
+
+    def test_query(self):
+        """Test the log is filtered, paged and limited to the owner's files for non-admins"""
+        FileShare.objects.create(file=self.file, user=self.other, permission='DOWNLOAD')
+        self.download()
+        self.download(self.other)
+        audit.flush()
+        url = reverse('access-log')
+
+        self.client.force_authenticate(user=self.other)
+        self.assertEqual(self.client.get(url).data['results'], [])
+
+        self.client.force_authenticate(user=self.owner)
+        response = self.client.get(url, {'limit': 1})
+        self.assertEqual([row['user_id'] for row in response.data['results']], [self.other.id])
+        response = self.client.get(url, {'limit': 1, 'cursor': response.data['next']})
+        self.assertEqual([row['user_id'] for row in response.data['results']], [self.owner.id])
+        self.assertIsNone(response.data['next'])
+
+        self.client.force_authenticate(user=self.admin)
+        response = self.client.get(url, {'user': self.owner.id, 'file': str(self.file.id), 'kind': 'download'})
+        self.assertEqual(len(response.data['results']), 1)
+        since = (timezone.now() + timedelta(minutes=1)).isoformat()
+        self.assertEqual(self.client.get(url, {'since': since}).data['results'], [])
+        self.assertEqual(self.client.get(url, {'file': 'nope'}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(url, {'cursor': '!'}).status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@override_settings(SIGNED_LINK_REVOCATION_REFRESH=3600)
+class SignedLinkTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.owner = User.objects.create_user(email='owner@example.com', password='ownerpass123')
+        self.content = b'signed link contents'
+        self.file = File(
+            uploaded_by=self.owner,
+            original_name='signed.txt',
+            file_size=len(self.content),
+            content_type='text/plain'
+        )
+        self.file.file.save('signed.enc', SimpleUploadedFile('signed.enc', encrypt_file(self.content)), save=False)
+        self.file.save()
+        self.addCleanup(lambda: self.file.file.delete(save=False))
+        signedlinks.revocations.expire()
+        signedlinks.files.evict(self.file.id)
+
+    def create_link(self, hours=1):
+        self.client.force_authenticate(user=self.owner)
+        response = self.client.post(
+            reverse('create-share-link', kwargs={'file_id': str(self.file.id)}), {'hours': hours}, format='json'
+        )
+        self.client.force_authenticate(user=None)
+        return response.data['url'].split('/files/signed/')[1].rstrip('/')
+
+    def download(self, token):
+        return self.client.get(reverse('download-signed-link', kwargs={'token': token}))
+
+    def test_download_without_link_or_file_queries(self):
+        """Test a signed link is checked and its file found without querying either table"""
+        token = self.create_link()
+        response = self.download(token)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.download(token)
+            self.assertEqual(b''.join(response.streaming_content), self.content)
+        tables = ('filemanager_shareablelink', 'filemanager_file"', 'accounts_user', 'filemanager_revokedlink')
+        self.assertFalse([query['sql'] for query in queries if any(table in query['sql'] for table in tables)])
+
+    def test_tampered_and_expired_links(self):
+        """Test a changed token is refused and an expired one reported as expired"""
+        token = self.create_link()
+        key_id, link_id, file_id, expires, role, signature = token.split('.')
+        forged = '.'.join([key_id, link_id, file_id, str(int(expires) + 3600), role, signature])
+        self.assertEqual(self.download(forged).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.download('garbage').status_code, status.HTTP_404_NOT_FOUND)
+
+        expired = ShareableLink(file=self.file, created_by=self.owner, expires_at=timezone.now() - timedelta(minutes=1))
+        response = self.download(signedlinks.sign(expired))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['error'], 'This link has expired')
+
+    def test_deleted_link_is_revoked(self):
+        """Test deleting a link, directly or with its file, stops its signed URL"""
+        token = self.create_link()
+        self.assertEqual(self.download(token).status_code, status.HTTP_200_OK)
+        with self.captureOnCommitCallbacks(execute=True):
+            ShareableLink.objects.filter(file=self.file).delete()
+        self.assertEqual(self.download(token).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(RevokedLink.objects.count(), 1)
+
+    def test_signing_keys(self):
+        """Test links verify under any listed key and stop when their key is removed"""
+        with self.settings(SHARE_LINK_KEYS={'v2': 'second secret'}, SHARE_LINK_KEY_ID='v2'):
+            token = self.create_link()
+            self.assertTrue(token.startswith('v2.'))
+            self.assertEqual(self.download(token).status_code, status.HTTP_200_OK)
+        self.assertEqual(self.download(token).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_stale_file_metadata_is_reloaded(self):
+        """Test a cached file whose blob has moved is fetched again"""
+        token = self.create_link()
+        stale = copy.copy(self.file)
+        stale.file = 'blobs/moved/away.enc'
+        signedlinks.files.entries[self.file.id] = (stale, time.monotonic())
+        response = self.download(token)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+
+
+class ExpiredLinkTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.owner = User.objects.create_user(email='owner@example.com', password='ownerpass123')
+        self.other = User.objects.create_user(email='other@example.com', password='otherpass123')
+        self.file = File.objects.create(
+            uploaded_by=self.owner,
+            file=f'blobs/links/{uuid.uuid4().hex}.enc',
+            original_name='links.txt',
+            file_size=10,
+            content_type='text/plain',
+        )
+
+    def create_link(self, user, expires_in):
+        return ShareableLink.objects.create(file=self.file, created_by=user, expires_at=timezone.now() + expires_in)
+
+    def test_purge_keeps_retention_and_stats(self):
+        """Test only links past the retention window go, in batches, with the link counts kept right"""
+        for user in (self.owner, self.owner, self.other):
+            self.create_link(user, -timedelta(days=40))
+        recent = self.create_link(self.owner, -timedelta(days=1))
+        live = self.create_link(self.other, timedelta(hours=1))
+        RevokedLink.objects.create(link_id=uuid.uuid4(), expires_at=timezone.now() - timedelta(hours=1))
+
+        self.assertEqual(links.purge_expired(retention_days=30, dry_run=True), 3)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(links.purge_expired(retention_days=30, batch_size=2), 3)
+        # Two batches; the statistics are written per batch, not per link
+        self.assertLessEqual(len(queries), 16)
+        self.assertEqual(set(ShareableLink.objects.values_list('pk', flat=True)), {recent.pk, live.pk})
+        self.assertFalse(RevokedLink.objects.exists())
+        self.assertEqual(stats.totals()['links'], 2)
+        self.assertEqual(stats.rebuild(), stats.totals())
+
+    def test_dead_links_are_rejected_from_memory(self):
+        """Test a second request for an expired or unknown link makes no query"""
+        expired = self.create_link(self.owner, -timedelta(minutes=5))
+        for link_id, code in ((expired.id, status.HTTP_400_BAD_REQUEST), (uuid.uuid4(), status.HTTP_404_NOT_FOUND)):
+            url = reverse('download-shared-link', kwargs={'link_id': str(link_id)})
+            self.assertEqual(self.client.get(url).status_code, code)
+            with self.assertNumQueries(0):
+                self.assertEqual(self.client.get(url).status_code, code)
+
+    def test_stats_batching(self):
+        """Test changes recorded in a batch are summed into one write per row"""
+        with CaptureQueriesContext(connection) as queries:
+            with stats.batched():
+                for _ in range(5):
+                    stats.file_resized(self.owner.id, 3)
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(UserStorageStats.objects.get(user=self.owner).bytes, 25)
+
+
+@override_settings(FILE_ENCRYPTION_KEYS={'v2': 'second-master-key'})
+class InlineBlobTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='inline@example.com', password='inlinepass123')
+        self.client.force_authenticate(user=self.user)
+        self.content = b'a small note'
+        self.file = self.upload(self.content)
+
+    def upload(self, content):
+        response = self.client.post(
+            reverse('file-upload'),
+            {'file': SimpleUploadedFile('note.txt', content)},
+            format='multipart'
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return File.objects.get(id=response.data['id'])
+
+    def download(self, file_obj):
+        response = self.client.get(reverse('file-download', kwargs={'file_id': str(file_obj.id)}))
+        return b''.join(response.streaming_content)
+
+    def test_small_upload_is_stored_in_the_row(self):
+        """Test a small file has no blob in the storage and downloads from its row"""
+        self.assertEqual(self.file.file.name, '')
+        self.assertEqual(blob_checksum(bytes(self.file.inline_blob)), self.file.checksum)
+        self.assertEqual(os.listdir(self.media_root), [])
+        self.assertEqual(self.download(self.file), self.content)
+
+        link = ShareableLink.objects.create(
+            file=self.file, created_by=self.user, expires_at=timezone.now() + timedelta(hours=1)
+        )
+        response = self.client.get(reverse('download-shared-link', kwargs={'link_id': str(link.id)}))
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+
+        response = self.client.post(reverse('file-bulk-download'), {'file_ids': [str(self.file.id)]}, format='json')
+        with zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content))) as archive:
+            self.assertEqual(archive.read('note.txt'), self.content)
+
+    @override_settings(INLINE_BLOB_MAX_BYTES=64)
+    def test_large_upload_goes_to_storage(self):
+        """Test a blob over INLINE_BLOB_MAX_BYTES is written to the storage"""
+        content = os.urandom(1024)
+        file_obj = self.upload(content)
+        self.assertIsNone(file_obj.inline_blob)
+        self.assertTrue(file_obj.file.storage.exists(file_obj.file.name))
+        self.assertEqual(self.download(file_obj), content)
+
+    def test_rotation_and_scrub(self):
+        """Test an inline blob is re-encrypted in place and verified by the scrubber"""
+        self.assertEqual(rotation.keys_in_use(), {'default': 1})
+        self.assertTrue(rotation.rotate_file(self.file.pk, 'v2'))
+        self.file.refresh_from_db()
+        self.assertEqual(self.file.key_id, 'v2')
+        self.assertEqual(self.file.file.name, '')
+        self.assertEqual(blob_checksum(bytes(self.file.inline_blob)), self.file.checksum)
+        self.assertEqual(rotation.keys_in_use(), {'v2': 1})
+        self.assertEqual(self.download(self.file), self.content)
+
+        File.objects.filter(pk=self.file.pk).update(last_verified_at=None)
+        self.assertEqual(scrub.verify_file(self.file.pk), 'ok')
+        self.assertIsNotNone(File.objects.get(pk=self.file.pk).last_verified_at)
+
+    def test_new_version_replaces_inline_blob(self):
+        """Test versioning splits the inline blob into version 1 and clears it"""
+        edited = b'a small note, edited'
+        response = self.client.post(
+            reverse('file-versions', kwargs={'file_id': str(self.file.id)}),
+            {'file': SimpleUploadedFile('note.txt', edited)},
+            format='multipart'
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.file.refresh_from_db()
+        self.assertIsNone(self.file.inline_blob)
+        self.assertEqual(self.download(self.file), edited)
+        url = reverse('file-version-download', kwargs={'file_id': str(self.file.id), 'number': 1})
+        self.assertEqual(b''.join(self.client.get(url).streaming_content), self.content)
@@ -0,0 +1,54 @@
+"""Upload handler that reports progress over the user's WebSocket."""
+from django.conf import settings
+from django.core.files.uploadhandler import FileUploadHandler
+import time
+from . import events
+
+
+class UploadProgressHandler(FileUploadHandler):
+    """Passes data through untouched, pushing upload.progress events.
+
+    Installed ahead of Django's own handlers when the client names its
+    upload with ?upload_id= (or X-Upload-ID), and rate limited to one event
+    per UPLOAD_PROGRESS_INTERVAL seconds.
+    """
+
+    def __init__(self, request, upload_id):
+        super().__init__(request)
+        self.upload_id = upload_id[:64]
+        self.user_id = request.user.pk
+        self.received = 0
+        self.total = None
+        self.last_sent = 0
+        self.interval = getattr(settings, 'UPLOAD_PROGRESS_INTERVAL', 0.5)
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        self.total = content_length
+        return None
+
+    def report(self, done=False):
+        self.last_sent = time.monotonic()
+        events.push([self.user_id], {
+            'type': 'upload.progress',
+            'upload_id': self.upload_id,
+            'received': self.received,
+            'total': self.total,
+            'done': done,
+        })
+
+    def receive_data_chunk(self, raw_data, start):
+        self.received += len(raw_data)
+        if time.monotonic() - self.last_sent >= self.interval:
+            self.report()
+        return raw_data
+
+    def file_complete(self, file_size):
+        self.report(done=True)
+        return None
+
+
+def track_progress(request):
+    """Install the progress handler if the client asked for progress events"""
+    upload_id = request.query_params.get('upload_id') or request.META.get('HTTP_X_UPLOAD_ID')
+    if upload_id and request.user.is_authenticated:
+        request.upload_handlers.insert(0, UploadProgressHandler(request, upload_id))
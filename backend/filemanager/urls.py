@@ -1,15 +1,28 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import FileViewSet, FileUploadView, FileDownloadView, FileShareView, ShareableLinkView
+from .views import (
+    FileViewSet, FileUploadView, FileDownloadView, FileShareView, ShareableLinkView, BulkDownloadView, FilePreviewView,
+    FileVersionView, FileVersionDownloadView, MissingChunksView, ChunkUploadView, StorageStatsView,
+    AccessLogView, SignedLinkView,
+)
 
 router = DefaultRouter()
 router.register(r'', FileViewSet, basename='file')
 
 urlpatterns = [
     path('upload/', FileUploadView.as_view(), name='file-upload'),
+    path('bulk-download/', BulkDownloadView.as_view(), name='file-bulk-download'),
     path('download-link/<uuid:link_id>/', ShareableLinkView.as_view(), name='download-shared-link'),
+    path('signed/<str:token>/', SignedLinkView.as_view(), name='download-signed-link'),
     path('share-link/<uuid:file_id>/', ShareableLinkView.as_view(), name='create-share-link'),
     path('<uuid:file_id>/download/', FileDownloadView.as_view(), name='file-download'),
     path('<uuid:file_id>/share/', FileShareView.as_view(), name='file-share'),
+    path('<uuid:file_id>/preview/', FilePreviewView.as_view(), name='file-preview'),
+    path('<uuid:file_id>/versions/', FileVersionView.as_view(), name='file-versions'),
+    path('<uuid:file_id>/versions/<int:number>/download/', FileVersionDownloadView.as_view(), name='file-version-download'),
+    path('chunks/missing/', MissingChunksView.as_view(), name='chunk-missing'),
+    path('chunks/<str:digest>/', ChunkUploadView.as_view(), name='chunk-upload'),
+    path('stats/', StorageStatsView.as_view(), name='storage-stats'),
+    path('access-log/', AccessLogView.as_view(), name='access-log'),
     path('', include(router.urls)),
 ] 
\ No newline at end of file
@@ -2,12 +2,30 @@ from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 import base64
+import functools
+import itertools
 import os
 from django.conf import settings
 import logging
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_KEY_ID = 'default'
+
+def current_key_id():
+    """Id of the master key new blobs are encrypted with"""
+    return getattr(settings, 'FILE_ENCRYPTION_KEY_ID', DEFAULT_KEY_ID)
+
+def get_master_key(key_id=None):
+    """Master key (password) for key_id; None means the current key"""
+    key_id = key_id or current_key_id()
+    if key_id == DEFAULT_KEY_ID:
+        return settings.FILE_ENCRYPTION_KEY
+    try:
+        return getattr(settings, 'FILE_ENCRYPTION_KEYS', {})[key_id]
+    except KeyError:
+        raise ValueError(f"Unknown encryption key id '{key_id}'")
+
 def generate_key(password, salt):
     """Generate an AES key from password and salt using PBKDF2"""
     kdf = PBKDF2HMAC(
@@ -19,11 +37,28 @@ def generate_key(password, salt):
     key = kdf.derive(password.encode())
     return key
 
-def encrypt_file(data):
-    # Generate a random salt
-    salt = os.urandom(16)
-    # Generate encryption key
-    key = generate_key(settings.FILE_ENCRYPTION_KEY, salt)
+@functools.lru_cache(maxsize=1024)
+def _derive_cached(password, salt):
+    return generate_key(password, salt)
+
+def derive_key(key_id, salt):
+    """generate_key() for reading an existing blob, cached by salt.
+
+    PBKDF2 dominates the cost of reading a small blob and a blob's salt never
+    changes, so repeated downloads of the same file reuse its derived key.
+    """
+    return _derive_cached(get_master_key(key_id), bytes(salt))
+
+def encrypt_file(data, key_id=None, salt=None):
+    if salt is None:
+        # Generate a random salt
+        salt = os.urandom(16)
+        # Generate encryption key
+        key = generate_key(get_master_key(key_id), salt)
+    else:
+        # Callers encrypting many blobs in one go share a salt (each blob
+        # still gets its own IV) so PBKDF2 runs once rather than per blob
+        key = derive_key(key_id, salt)
     # Generate random IV
     iv = os.urandom(16)
     
@@ -40,14 +75,14 @@ def encrypt_file(data):
     
     return salt + iv + encrypted_data
 
-def decrypt_file(encrypted_data):
+def decrypt_file(encrypted_data, key_id=None):
     # Extract salt, iv and encrypted content
     salt = encrypted_data[:16]
     iv = encrypted_data[16:32]
     encrypted_content = encrypted_data[32:]
     
     # Generate decryption key
-    key = generate_key(settings.FILE_ENCRYPTION_KEY, salt)
+    key = derive_key(key_id, salt)
     
     # Create AES cipher
     cipher = Cipher(algorithms.AES(key), modes.CBC(iv))
@@ -60,4 +95,46 @@ def decrypt_file(encrypted_data):
     padding_length = decrypted_data[-1]
     decrypted_data = decrypted_data[:-padding_length]
     
-    return decrypted_data 
\ No newline at end of file
+    return decrypted_data 
+
+CHUNK_SIZE = 64 * 1024
+
+def read_chunks(fileobj, chunk_size=CHUNK_SIZE):
+    """Yield a file object's contents chunk_size bytes at a time"""
+    return iter(lambda: fileobj.read(chunk_size), b'')
+
+def decrypt_stream(chunks, key_id=None):
+    """Decrypt an encrypt_file() blob supplied as an iterable of byte chunks"""
+    header = b''
+    chunks = iter(chunks)
+    for chunk in chunks:
+        header += chunk
+        if len(header) >= 32:
+            break
+    if len(header) < 32:
+        raise ValueError("Encrypted data is truncated")
+
+    salt, iv, first = header[:16], header[16:32], header[32:]
+    key = derive_key(key_id, salt)
+    yield from decrypt_blocks(key, iv, itertools.chain([first], chunks))
+
+def decrypt_blocks(key, iv, chunks):
+    """Decrypt CBC ciphertext chunks that run to the end of a blob.
+
+    Yields plaintext as soon as it is available; only the last block is
+    held back until the end so its padding can be stripped.
+    """
+    decryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).decryptor()
+
+    pending = b''
+    for chunk in chunks:
+        pending += decryptor.update(chunk)
+        if len(pending) > 16:
+            yield pending[:-16]
+            pending = pending[-16:]
+    pending += decryptor.finalize()
+    if not pending:
+        raise ValueError("Encrypted data is truncated")
+
+    padding_length = pending[-1]
+    yield pending[:-padding_length]
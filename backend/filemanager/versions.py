@@ -0,0 +1,260 @@
+"""File versions built from content-defined chunks.
+
+A version is a manifest (VersionChunk rows) of chunks, each stored and
+encrypted once per owner. Uploading a new version of a file, whether as a
+whole body the server splits (see chunking.py) or as a list of chunks the
+client has already split, only stores the chunks the owner doesn't have yet,
+so re-uploading an edited file costs about as much as the edit.
+
+A file starts out as one blob (File.version == 0). Its first new version
+splits that blob into version 1, stores the upload as version 2 and drops
+the blob; from then on blobs.iter_decrypted() reads the current manifest.
+Chunks no version refers to any more are removed by ``prune_chunks``.
+"""
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import IntegrityError, transaction
+from django.db.models import Sum
+from django.utils import timezone
+from datetime import timedelta
+import hashlib
+import itertools
+import logging
+import os
+import uuid
+from .blobs import blob_checksum, iter_decrypted
+from .chunking import iter_chunks
+from .jobs import iter_pks
+from .models import Chunk, File, FilePreview, FileVersion, VersionChunk
+from .previews import schedule_preview
+from .utils import current_key_id, encrypt_file
+from . import events, listing, quotas, stats
+from accounts.models import User
+
+logger = logging.getLogger(__name__)
+
+DIGEST_LENGTH = 64
+
+
+class MissingChunks(Exception):
+    def __init__(self, digests):
+        super().__init__('Some chunks have not been uploaded')
+        self.digests = digests
+
+
+class VersionConflict(Exception):
+    pass
+
+
+def chunk_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def is_digest(value):
+    return isinstance(value, str) and len(value) == DIGEST_LENGTH and all(c in '0123456789abcdef' for c in value)
+
+
+def _batches(items, size=500):
+    # Keeps IN (...) lists under SQLite's variable limit
+    items = iter(items)
+    while batch := list(itertools.islice(items, size)):
+        yield batch
+
+
+def known_chunks(owner_id, digests):
+    """{digest: (chunk pk, size)} for the digests the owner already has"""
+    known = {}
+    for batch in _batches(set(digests)):
+        rows = Chunk.objects.filter(owner_id=owner_id, digest__in=batch).values_list('digest', 'pk', 'size')
+        known.update((digest, (pk, size)) for digest, pk, size in rows)
+    return known
+
+
+def missing_digests(owner_id, digests):
+    """The digests, in order and without repeats, the owner has no chunk for"""
+    known = known_chunks(owner_id, digests)
+    return [digest for digest in dict.fromkeys(digests) if digest not in known]
+
+
+def store_chunk(owner_id, data, digest=None, key_id=None, salt=None):
+    """Encrypt and store one chunk unless the owner already has it; returns (pk, size)"""
+    digest = digest or chunk_digest(data)
+    existing = Chunk.objects.filter(owner_id=owner_id, digest=digest).values_list('pk', 'size').first()
+    if existing:
+        return existing
+
+    key_id = key_id or current_key_id()
+    encrypted = encrypt_file(data, key_id, salt=salt)
+    chunk = Chunk(
+        owner_id=owner_id,
+        digest=digest,
+        size=len(data),
+        checksum=blob_checksum(encrypted),
+        key_id=key_id,
+    )
+    chunk.blob.save(f'{uuid.uuid4().hex}.chunk', ContentFile(encrypted), save=False)
+    try:
+        with transaction.atomic():
+            chunk.save()
+    except IntegrityError:
+        # A concurrent upload stored the same chunk first
+        chunk.blob.delete(save=False)
+        return Chunk.objects.filter(owner_id=owner_id, digest=digest).values_list('pk', 'size').get()
+    return chunk.pk, chunk.size
+
+
+def pending_bytes(owner_id):
+    """Plaintext bytes of the owner's chunks that no version refers to"""
+    return Chunk.objects.filter(owner_id=owner_id, entries__isnull=True).aggregate(total=Sum('size'))['total'] or 0
+
+
+def store_pending_chunk(user, data, digest):
+    """store_chunk() for a chunk uploaded ahead of the manifest that will use it.
+
+    Until a version refers to them, a user's chunks count against their
+    quota and are capped at PENDING_CHUNKS_MAX_BYTES, so chunks that are
+    never committed can't fill the disk before prune_chunks removes them.
+    Raises quotas.QuotaExceeded.
+    """
+    existing = Chunk.objects.filter(owner_id=user.pk, digest=digest).values_list('pk', 'size').first()
+    if existing:
+        return existing
+    with transaction.atomic():
+        # The user's row lock serializes their uploads, as in quotas.reserve()
+        locked = User.objects.select_for_update().only('role', 'storage_used', 'storage_quota').get(pk=user.pk)
+        pending = pending_bytes(user.pk) + len(data)
+        if pending > getattr(settings, 'PENDING_CHUNKS_MAX_BYTES', 1024 ** 3):
+            raise quotas.QuotaExceeded('Too many chunks uploaded without committing a version')
+        quota = quotas.get_quota(locked)
+        if quota is not None and locked.storage_used + pending > quota:
+            raise quotas.QuotaExceeded('Storage quota exceeded')
+        return store_chunk(user.pk, data, digest)
+
+
+def store_stream(owner_id, fileobj):
+    """Split a file object into chunks and store the new ones; returns the manifest digests"""
+    key_id = current_key_id()
+    # One salt for the whole upload, so the key is derived once
+    salt = os.urandom(16)
+    digests = []
+    for data in iter_chunks(fileobj):
+        digest = chunk_digest(data)
+        store_chunk(owner_id, data, digest, key_id, salt)
+        digests.append(digest)
+    return digests
+
+
+class _Chunks:
+    """Iterates a file's decrypted contents as a file object for iter_chunks()"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.pending = b''
+
+    def read(self, size):
+        while len(self.pending) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.pending += chunk
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+
+def _create_version(file_id, number, digests, known):
+    entries = []
+    offset = 0
+    for position, digest in enumerate(digests):
+        pk, size = known[digest]
+        entries.append(VersionChunk(position=position, offset=offset, chunk_id=pk))
+        offset += size
+    version = FileVersion.objects.create(file_id=file_id, number=number, size=offset)
+    for entry in entries:
+        entry.version = version
+    VersionChunk.objects.bulk_create(entries, batch_size=500)
+    return version
+
+
+def commit_version(file_obj, digests, base_version=None):
+    """Make the owner's chunks named by digests the file's next version.
+
+    Raises MissingChunks if any are not stored yet, VersionConflict if
+    base_version is given and the file has moved past it, and
+    QuotaExceeded if the file grows past the owner's quota.
+    """
+    owner_id = file_obj.uploaded_by_id
+    known = known_chunks(owner_id, digests)
+    missing = [digest for digest in dict.fromkeys(digests) if digest not in known]
+    if missing:
+        raise MissingChunks(missing)
+    size = sum(known[digest][1] for digest in digests)
+
+    # A single-blob file is split into version 1 first. That reads the whole
+    # blob, so it happens before any locks are taken.
+    initial = None
+    if file_obj.version == 0:
+        if base_version not in (None, 0):
+            raise VersionConflict('The file has changed since that version')
+        initial = store_stream(owner_id, _Chunks(iter_decrypted(file_obj)))
+        initial_known = known_chunks(owner_id, initial)
+
+    with quotas.reserve(file_obj.uploaded_by, size - file_obj.file_size):
+        current = File.objects.select_for_update().values('version', 'file_size', 'file').get(pk=file_obj.pk)
+        if base_version is not None and current['version'] != base_version:
+            raise VersionConflict('The file has changed since that version')
+        if (current['version'] == 0) != (initial is not None):
+            raise VersionConflict('The file changed while its new version was being stored')
+
+        number = current['version'] + 1
+        if initial is not None:
+            _create_version(file_obj.pk, 1, initial, initial_known)
+            number = 2
+        version = _create_version(file_obj.pk, number, digests, known)
+        File.objects.filter(pk=file_obj.pk).update(
+            version=number, file_size=size, file='', inline_blob=None, checksum='', last_verified_at=None
+        )
+        quotas.add_usage(owner_id, size - current['file_size'])
+        stats.file_resized(owner_id, size - current['file_size'])
+
+        kept = getattr(settings, 'FILE_VERSIONS_KEPT', 10)
+        FileVersion.objects.filter(file_id=file_obj.pk, number__lte=number - kept).delete()
+
+        # The preview shows the old contents; render the new ones
+        FilePreview.objects.filter(file_id=file_obj.pk).delete()
+        old_blob = current['file']
+        file_obj.version, file_obj.file_size, file_obj.file, file_obj.inline_blob = number, size, '', None
+        schedule_preview(file_obj)
+        events.send_event([owner_id], 'file.updated', file=events.file_payload(file_obj))
+        # The UPDATE above bypasses the post_save receivers
+        listing.invalidate(owner_id, file_obj.pk)
+
+    if old_blob:
+        try:
+            file_obj.file.storage.delete(old_blob)
+        except Exception as e:
+            # reconcile_blobs will pick it up as an orphan
+            logger.warning(f"Failed to delete blob {old_blob} of file {file_obj.pk}: {str(e)}")
+    return version
+
+
+def prune_chunks(min_age=3600, dry_run=False, batch_size=500):
+    """Remove chunks no version refers to; returns {'removed', 'bytes'}.
+
+    Chunks younger than min_age are kept: a client uploads the chunks of a
+    new version before it commits the manifest that refers to them.
+    """
+    cutoff = timezone.now() - timedelta(seconds=min_age)
+    unreferenced = Chunk.objects.filter(entries__isnull=True, created_at__lt=cutoff)
+    result = {'removed': 0, 'bytes': 0}
+    for batch in _batches(iter_pks(unreferenced, batch_size), batch_size):
+        # Re-check: a version may have been committed since the batch was read
+        chunks = unreferenced.filter(pk__in=batch)
+        if dry_run:
+            sizes = list(chunks.values_list('size', flat=True))
+            result['removed'] += len(sizes)
+            result['bytes'] += sum(sizes)
+        else:
+            result['bytes'] += sum(chunks.values_list('size', flat=True))
+            # Deleting through the queryset fires post_delete, which removes the blobs
+            result['removed'] += chunks.delete()[1].get(Chunk._meta.label, 0)
+    return result
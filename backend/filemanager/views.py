@@ -4,31 +4,56 @@ from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.decorators import action
 from django.http import HttpResponse
-from .models import File, FileShare, ShareableLink
+from .models import AccessEvent, File, FileShare, ShareableLink, FilePreview, FileVersion
 from .serializers import FileSerializer, FileShareSerializer, ShareableLinkSerializer
-from .utils import encrypt_file, decrypt_file
+from .utils import current_key_id, encrypt_file, decrypt_file
 from django.shortcuts import get_object_or_404
 import os
 import uuid
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from accounts.models import User
-from django.core.files.base import ContentFile
 from django.views.decorators.csrf import csrf_exempt
-from rest_framework.parsers import MultiPartParser, FormParser
+from rest_framework.parsers import JSONParser, MultiPartParser, FormParser
 from rest_framework.views import APIView
 from django.http import FileResponse
 from django.utils.encoding import smart_str
 import io
+import itertools
 import logging
 from django.core.files.storage import default_storage
 import time
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from datetime import timedelta
 from django.views.decorators.http import require_GET
+from django.http import StreamingHttpResponse
+from .blobs import blob_checksum, discard_blob, iter_decrypted, iter_version, read_blob, store_blob
+from .coalesce import stream_file
+from .governor import TransferLimited, start_transfer
+from .uploads import track_progress
+from .zipstream import ZipMember, is_compressed, stream_zip, unique_names
+from .previews import schedule_preview
+from .chunking import chunk_sizes
+from . import audit, links, listing, quotas, search, signedlinks, stats, versions
+from core.renderers import FastJSONRenderer
+from core import responsecache
+from rest_framework.renderers import BrowsableAPIRenderer
+from core.pagination import InvalidCursor, parse_limit
+import json
+
+def with_share_permission(queryset, user):
+    """Fetch owner emails and the user's share permission in the same query"""
+    share_permission = FileShare.objects.filter(
+        file=models.OuterRef('pk'), user=user
+    ).values('permission')[:1]
+    return queryset.select_related('uploaded_by').annotate(
+        share_permission=models.Subquery(share_permission)
+    )
 
 class FileViewSet(viewsets.ModelViewSet):
     serializer_class = FileSerializer
     permission_classes = [IsAuthenticated]
+    renderer_classes = [FastJSONRenderer, BrowsableAPIRenderer]
 
     def get_permissions(self):
         if self.action in ['create', 'list', 'retrieve', 'download', 'destroy']:
@@ -41,46 +66,68 @@ class FileViewSet(viewsets.ModelViewSet):
 
         # For the main file list (File Manager screen), show only owned files
         if action == 'list':
-            return File.objects.filter(uploaded_by=user)
+            return with_share_permission(File.objects.filter(uploaded_by=user), user)
         
         # For other actions, show files user has access to
         if user.role == 'ADMIN':
-            return File.objects.all()
-        return File.objects.filter(
+            return with_share_permission(File.objects.all(), user)
+        return with_share_permission(File.objects.filter(
             models.Q(uploaded_by=user) | 
             models.Q(shares__user=user)
-        ).distinct()
+        ).distinct(), user)
+
+    def list(self, request, *args, **kwargs):
+        # Same output as FileSerializer, without a model instance per row
+        return responsecache.cached_response(
+            request, 'files', [responsecache.user_token(request.user.pk)],
+            lambda: listing.file_rows(self.get_queryset(), request.user),
+        )
 
     def perform_create(self, serializer):
         serializer.save(uploaded_by=self.request.user)
 
     def create(self, request, *args, **kwargs):
+        # Check the quota before the upload body is read
+        try:
+            quotas.check_request_size(request)
+        except quotas.QuotaExceeded as e:
+            return Response({'error': str(e)}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        track_progress(request)
+
         try:
             file_obj = request.FILES['file']
             file_data = file_obj.read()
             
             # Encrypt the file data
-            encrypted_data = encrypt_file(file_data)
-            
-            # Create a new in-memory file with encrypted data
-            encrypted_file = ContentFile(encrypted_data)
+            key_id = current_key_id()
+            encrypted_data = encrypt_file(file_data, key_id)
             
             file = File(
                 uploaded_by=request.user,
                 original_name=file_obj.name,
                 file_size=file_obj.size,
-                content_type=file_obj.content_type
+                content_type=file_obj.content_type,
+                checksum=blob_checksum(encrypted_data),
+                key_id=key_id
             )
             
-            # Save encrypted file
-            file.file.save(f"{uuid.uuid4().hex}.enc", encrypted_file)
-            file.save()
+            # Store the encrypted blob (small ones in the row), then the row in a single INSERT
+            store_blob(file, encrypted_data)
+            try:
+                with quotas.reserve(request.user, file.file_size):
+                    file.save()
+            except quotas.QuotaExceeded:
+                discard_blob(file)
+                raise
+            schedule_preview(file)
             
             return Response({
                 'message': 'File uploaded successfully',
                 'file_id': file.id
             }, status=status.HTTP_201_CREATED)
             
+        except quotas.QuotaExceeded as e:
+            return Response({'error': str(e)}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
         except Exception as e:
             return Response({
                 'error': str(e)
@@ -90,9 +137,10 @@ class FileViewSet(viewsets.ModelViewSet):
         instance = self.get_object()
         # Allow access if user is admin, file owner, or file is shared with them
         if (request.user.role == 'ADMIN' or 
-            instance.uploaded_by == request.user or 
-            request.user in instance.shared_with.all()):
-            return super().retrieve(request, *args, **kwargs)
+            instance.uploaded_by_id == request.user.id or 
+            instance.share_permission is not None):
+            serializer = self.get_serializer(instance)
+            return Response(serializer.data)
         return Response(
             {'error': 'You do not have permission to access this file'},
             status=status.HTTP_403_FORBIDDEN
@@ -111,10 +159,10 @@ class FileViewSet(viewsets.ModelViewSet):
                 )
 
             # Read encrypted file data
-            encrypted_data = file.file.read()
+            encrypted_data = read_blob(file)
             
             # Get decrypted data
-            decrypted_data = decrypt_file(encrypted_data)
+            decrypted_data = decrypt_file(encrypted_data, file.key_id)
             
             # Create response with decrypted content
             response = HttpResponse(
@@ -148,7 +196,8 @@ class FileViewSet(viewsets.ModelViewSet):
     def destroy(self, request, *args, **kwargs):
         try:
             instance = self.get_object()
-            file_path = instance.file.path
+            # Versioned files have no blob of their own
+            file_path = instance.file.path if instance.file else None
             
             # Try to delete file with retries
             max_retries = 3
@@ -157,7 +206,7 @@ class FileViewSet(viewsets.ModelViewSet):
             for attempt in range(max_retries):
                 try:
                     # First try to delete from storage
-                    if os.path.exists(file_path):
+                    if file_path and os.path.exists(file_path):
                         default_storage.delete(instance.file.name)
                     # Then delete the database record
                     instance.delete()
@@ -211,18 +260,44 @@ class FileViewSet(viewsets.ModelViewSet):
         # For admin users, show all files except their own
         if request.user.role == 'ADMIN':
             files = File.objects.exclude(uploaded_by=request.user)
+            depends = [responsecache.user_token(request.user.pk), responsecache.ROLES, responsecache.FILES]
         else:
             # For regular users, show only files shared with them
             files = File.objects.filter(shares__user=request.user)
-        
-        serializer = self.get_serializer(files, many=True, context={'request': request})
-        return Response(serializer.data) 
+            depends = [responsecache.user_token(request.user.pk), responsecache.ROLES]
+        files = with_share_permission(files, request.user)
+        return responsecache.cached_response(
+            request, 'shared', depends, lambda: listing.file_rows(files, request.user)
+        )
+
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        # get_queryset() already scopes to files the caller can access
+        files = search.filter_matching(self.get_queryset(), request.query_params.get('q', ''))
+        try:
+            files, next_cursor = search.paginate(
+                files,
+                request.query_params.get('cursor'),
+                parse_limit(request.query_params.get('limit'))
+            )
+        except InvalidCursor:
+            return Response({'error': 'Invalid cursor'}, status=status.HTTP_400_BAD_REQUEST)
+
+        serializer = self.get_serializer(files, many=True)
+        return Response({'results': serializer.data, 'next': next_cursor})
 
 class FileUploadView(APIView):
     permission_classes = [IsAuthenticated]
     parser_classes = [MultiPartParser, FormParser]
 
     def post(self, request):
+        # Check the quota before the upload body is read
+        try:
+            quotas.check_request_size(request)
+        except quotas.QuotaExceeded as e:
+            return Response({'error': str(e)}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        track_progress(request)
+
         try:
             file_obj = request.FILES['file']
             encryption_key = request.POST.get('encryption_key')
@@ -232,25 +307,36 @@ class FileUploadView(APIView):
             file_data = file_obj.read()
             
             # Apply server-side encryption
-            encrypted_data = encrypt_file(file_data)
-            encrypted_file = ContentFile(encrypted_data)
+            key_id = current_key_id()
+            encrypted_data = encrypt_file(file_data, key_id)
             
             # Create file instance with both client and server encryption info
-            file_instance = File.objects.create(
+            file_instance = File(
                 uploaded_by=request.user,
                 original_name=file_obj.name,
                 file_size=file_obj.size,
                 content_type=file_obj.content_type or 'application/octet-stream',
                 client_encryption_key=encryption_key,
                 client_encryption_iv=encryption_iv,
-                is_client_encrypted=bool(encryption_key and encryption_iv)
+                is_client_encrypted=bool(encryption_key and encryption_iv),
+                checksum=blob_checksum(encrypted_data),
+                key_id=key_id
             )
             
-            # Save the server-encrypted file
-            file_instance.file.save(f"{uuid.uuid4().hex}.enc", encrypted_file)
+            # Store the server-encrypted blob (small ones in the row), then the row in a single INSERT
+            store_blob(file_instance, encrypted_data)
+            try:
+                with quotas.reserve(request.user, file_instance.file_size):
+                    file_instance.save()
+            except quotas.QuotaExceeded:
+                discard_blob(file_instance)
+                raise
+            schedule_preview(file_instance)
             
             serializer = FileSerializer(file_instance, context={'request': request})
             return Response(serializer.data, status=status.HTTP_201_CREATED)
+        except quotas.QuotaExceeded as e:
+            return Response({'error': str(e)}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
@@ -270,7 +356,7 @@ class FileDownloadView(APIView):
             # Check permissions
             has_permission = (
                 request.user.role == 'ADMIN' or 
-                file_obj.uploaded_by == request.user or 
+                file_obj.uploaded_by_id == request.user.id or 
                 FileShare.objects.filter(file=file_obj, user=request.user, permission='DOWNLOAD').exists()
             )
             if not has_permission:
@@ -279,14 +365,27 @@ class FileDownloadView(APIView):
                     status=status.HTTP_403_FORBIDDEN
                 )
 
-            # Read and decrypt server-side encryption
+            # Take this download's slots under the governor before any work
             try:
-                with file_obj.file.open('rb') as f:
-                    encrypted_data = f.read()
-                
-                decrypted_data = decrypt_file(encrypted_data)
+                transfer = start_transfer(request)
+            except TransferLimited as e:
+                return Response(
+                    {"error": str(e)},
+                    status=status.HTTP_429_TOO_MANY_REQUESTS,
+                    headers={'Retry-After': str(e.retry_after)}
+                )
+
+            # Decrypt server-side encryption chunk by chunk, so a paced
+            # download never holds the whole file; the first chunk is taken
+            # here so read errors still return a 500
+            try:
+                chunks = iter_decrypted(file_obj)
+                first = next(chunks, b'')
+                chunks = itertools.chain([first], chunks)
+                content_length = file_obj.file_size
                 
             except Exception as e:
+                transfer.release()
                 return Response(
                     {"error": f"File read/decrypt failed: {str(e)}"},
                     status=status.HTTP_500_INTERNAL_SERVER_ERROR
@@ -294,14 +393,15 @@ class FileDownloadView(APIView):
 
             # Create response with server-decrypted data
             try:
-                response = HttpResponse(
-                    content=decrypted_data,
+                # Stream so the governor can pace the body
+                response = StreamingHttpResponse(
+                    audit.track(transfer.throttle(chunks), request, file_obj, expected_bytes=content_length),
                     content_type='application/octet-stream'
                 )
                 
                 # Set required headers
                 response['Content-Disposition'] = f'attachment; filename="{smart_str(file_obj.original_name)}"'
-                response['Content-Length'] = len(decrypted_data)
+                response['Content-Length'] = content_length
                 response['X-Original-Content-Type'] = file_obj.content_type
                 
                 if file_obj.is_client_encrypted:
@@ -325,6 +425,7 @@ class FileDownloadView(APIView):
                 return response
                 
             except Exception as e:
+                transfer.release()
                 return Response(
                     {"error": f"Failed to create response: {str(e)}"},
                     status=status.HTTP_500_INTERNAL_SERVER_ERROR
@@ -363,7 +464,7 @@ class FileShareView(APIView):
             file = File.objects.get(id=file_id)
             
             # Check if user is the owner
-            if file.uploaded_by != request.user:
+            if file.uploaded_by_id != request.user.id:
                 return Response(
                     {"error": "You don't have permission to share this file"}, 
                     status=status.HTTP_403_FORBIDDEN
@@ -394,7 +495,7 @@ class FileShareView(APIView):
                 )
             
             # Don't share with file owner
-            if user == file.uploaded_by:
+            if user.id == file.uploaded_by_id:
                 return Response(
                     {"error": "Cannot share file with yourself"}, 
                     status=status.HTTP_400_BAD_REQUEST
@@ -415,6 +516,224 @@ class FileShareView(APIView):
                 status=status.HTTP_404_NOT_FOUND
             ) 
 
+class FilePreviewView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, file_id):
+        try:
+            file_obj = File.objects.get(id=file_id)
+        except File.DoesNotExist:
+            return Response({"error": "File not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        # Any share, VIEW included, is enough to see the preview
+        has_permission = (
+            request.user.role == 'ADMIN' or
+            file_obj.uploaded_by_id == request.user.id or
+            FileShare.objects.filter(file=file_obj, user=request.user).exists()
+        )
+        if not has_permission:
+            return Response(
+                {"error": "You don't have permission to view this file"},
+                status=status.HTTP_403_FORBIDDEN
+            )
+
+        try:
+            preview = file_obj.preview
+        except FilePreview.DoesNotExist:
+            # Files uploaded before previews existed get one on first request
+            try:
+                with transaction.atomic():
+                    preview = schedule_preview(file_obj)
+            except IntegrityError:
+                # Another request scheduled it first
+                preview = FilePreview.objects.get(file=file_obj)
+
+        if preview.status == 'PENDING':
+            return Response({"status": "pending"}, status=status.HTTP_202_ACCEPTED)
+        if preview.status != 'READY':
+            return Response({"error": "No preview available"}, status=status.HTTP_404_NOT_FOUND)
+
+        etag = f'"{preview.pk}-{int(preview.generated_at.timestamp())}"'
+        if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+            response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            try:
+                data = read_blob(preview, 'blob')
+                data = decrypt_file(data, preview.key_id)
+            except Exception as e:
+                return Response(
+                    {"error": f"Preview read/decrypt failed: {str(e)}"},
+                    status=status.HTTP_500_INTERNAL_SERVER_ERROR
+                )
+            response = HttpResponse(content=data, content_type=preview.content_type)
+            response['Content-Length'] = len(data)
+
+        response['ETag'] = etag
+        response['Cache-Control'] = f"private, max-age={getattr(settings, 'PREVIEW_CACHE_SECONDS', 86400)}"
+        response['Access-Control-Allow-Origin'] = 'https://localhost:3000'
+        response['Access-Control-Allow-Credentials'] = 'true'
+        return response
+
+class BulkDownloadView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        file_ids = request.data.get('file_ids')
+        # Form posts send strings, and bool('false') is True
+        store_only = str(request.data.get('store_only', False)).lower() in ('1', 'true')
+
+        if not isinstance(file_ids, list) or not file_ids:
+            return Response(
+                {"error": "file_ids must be a non-empty list"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        max_files = getattr(settings, 'BULK_DOWNLOAD_MAX_FILES', 1000)
+        if len(file_ids) > max_files:
+            return Response(
+                {"error": f"At most {max_files} files can be downloaded at once"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        try:
+            file_ids = {uuid.UUID(str(file_id)) for file_id in file_ids}
+        except ValueError:
+            return Response({"error": "Invalid file id"}, status=status.HTTP_400_BAD_REQUEST)
+
+        # One query both loads the files and checks download permission
+        files = File.objects.filter(id__in=file_ids)
+        if request.user.role != 'ADMIN':
+            files = files.filter(
+                models.Q(uploaded_by=request.user) |
+                models.Q(shares__user=request.user, shares__permission='DOWNLOAD')
+            ).distinct()
+        files = list(files)
+        if len(files) != len(file_ids):
+            return Response(
+                {"error": "You don't have permission to download one or more of these files"},
+                status=status.HTTP_403_FORBIDDEN
+            )
+
+        # One archive counts as one download under the governor
+        try:
+            transfer = start_transfer(request)
+        except TransferLimited as e:
+            return Response(
+                {"error": str(e)},
+                status=status.HTTP_429_TOO_MANY_REQUESTS,
+                headers={'Retry-After': str(e.retry_after)}
+            )
+
+        names = list(unique_names(file_obj.original_name for file_obj in files))
+        members = [
+            ZipMember(
+                name=name,
+                size=file_obj.file_size,
+                chunks=lambda file_obj=file_obj: iter_decrypted(file_obj),
+                date_time=file_obj.uploaded_at.timetuple()[:6],
+                store_only=store_only or is_compressed(file_obj.content_type),
+            )
+            for name, file_obj in zip(names, files)
+        ]
+
+        # Client-encrypted members need their keys to be usable, the same
+        # keys the single-file download returns in headers
+        encryption = {
+            name: {'key': file_obj.client_encryption_key, 'iv': file_obj.client_encryption_iv}
+            for name, file_obj in zip(names, files) if file_obj.is_client_encrypted
+        }
+        if encryption:
+            manifest = json.dumps(encryption).encode()
+            members.append(ZipMember(
+                name='encryption-manifest.json',
+                size=len(manifest),
+                chunks=lambda: [manifest],
+                date_time=timezone.now().timetuple()[:6],
+            ))
+
+        # The slots are released when the response is closed
+        response = StreamingHttpResponse(transfer.throttle(stream_zip(members)), content_type='application/zip')
+        response['Content-Disposition'] = 'attachment; filename="files.zip"'
+        response['Access-Control-Allow-Origin'] = 'https://localhost:3000'
+        response['Access-Control-Allow-Credentials'] = 'true'
+        response['Access-Control-Expose-Headers'] = 'Content-Disposition, Content-Type'
+        return response
+
+def serve_link_download(request, link, file_obj, reload_file=None):
+    """Stream a file to a public link's client, under the link's and the client's download slots.
+
+    reload_file, if given, fetches the file again when reading the one
+    passed in fails.
+    """
+    # Take slots for the link and the client under the governor
+    try:
+        transfer = start_transfer(request, link)
+    except TransferLimited as e:
+        return Response(
+            {"error": str(e)},
+            status=status.HTTP_429_TOO_MANY_REQUESTS,
+            headers={'Retry-After': str(e.retry_after)}
+        )
+    
+    # Join (or start) the shared decrypt stream for this file; the
+    # first chunk is taken here so read errors still return a 500
+    try:
+        try:
+            chunks = stream_file(file_obj)
+            first_chunk = next(chunks, b'')
+        except Exception:
+            if reload_file is None:
+                raise
+            # Cached metadata may predate a new version or a moved blob
+            file_obj = reload_file()
+            chunks = stream_file(file_obj)
+            first_chunk = next(chunks, b'')
+    except Exception as e:
+        transfer.release()
+        return Response(
+            {"error": f"File read/decrypt failed: {str(e)}"},
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+
+    # Create response with server-decrypted data
+    try:
+        response = StreamingHttpResponse(
+            audit.track(
+                transfer.throttle(itertools.chain([first_chunk], chunks)), request, file_obj,
+                link=link, expected_bytes=file_obj.file_size
+            ),
+            content_type='application/octet-stream'
+        )
+        
+        # Set required headers
+        response['Content-Disposition'] = f'attachment; filename="{smart_str(file_obj.original_name)}"'
+        response['Content-Length'] = file_obj.file_size
+        response['X-Original-Content-Type'] = file_obj.content_type
+        
+        if file_obj.is_client_encrypted:
+            response['X-Encryption-Key'] = str(file_obj.client_encryption_key)
+            response['X-Encryption-IV'] = str(file_obj.client_encryption_iv)
+        
+        # Set CORS headers
+        response['Access-Control-Allow-Origin'] = '*'  # Allow any origin for public links
+        response['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
+        response['Access-Control-Expose-Headers'] = ', '.join([
+            'Content-Disposition',
+            'Content-Length',
+            'Content-Type',
+            'X-Encryption-Key',
+            'X-Encryption-IV',
+            'X-Original-Content-Type'
+        ])
+        
+        return response
+        
+    except Exception as e:
+        transfer.release()
+        return Response(
+            {"error": f"Failed to create response: {str(e)}"},
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+    
+
 class ShareableLinkView(APIView):
     permission_classes = [IsAuthenticated]
     
@@ -430,7 +749,7 @@ class ShareableLinkView(APIView):
             file = File.objects.get(id=file_id)
             
             # Check if user has permission to share
-            if not (request.user == file.uploaded_by or request.user.role == 'ADMIN'):
+            if not (request.user.id == file.uploaded_by_id or request.user.role == 'ADMIN'):
                 return Response(
                     {"error": "You don't have permission to share this file"},
                     status=status.HTTP_403_FORBIDDEN
@@ -467,11 +786,24 @@ class ShareableLinkView(APIView):
             )
 
     def get(self, request, link_id):
+        # Links already found dead are turned away without a query
+        rejection = links.rejected.get(link_id)
+        if rejection:
+            status_code, error = rejection
+            return Response({"error": error}, status=status_code)
         try:
-            link = get_object_or_404(ShareableLink, id=link_id)
+            try:
+                link = ShareableLink.objects.select_related('file', 'created_by').get(id=link_id)
+            except ShareableLink.DoesNotExist:
+                links.rejected.add(link_id, status.HTTP_404_NOT_FOUND, "Link not found")
+                return Response(
+                    {"error": "Link not found"},
+                    status=status.HTTP_404_NOT_FOUND
+                )
             
             # Check if link has expired
             if link.expires_at < timezone.now():
+                links.rejected.add(link_id, status.HTTP_400_BAD_REQUEST, "This link has expired")
                 return Response(
                     {"error": "This link has expired"},
                     status=status.HTTP_400_BAD_REQUEST
@@ -480,54 +812,7 @@ class ShareableLinkView(APIView):
             # Get the file
             file_obj = link.file
             
-            # Read and decrypt server-side encryption
-            try:
-                with file_obj.file.open('rb') as f:
-                    encrypted_data = f.read()
-                
-                decrypted_data = decrypt_file(encrypted_data)
-                
-            except Exception as e:
-                return Response(
-                    {"error": f"File read/decrypt failed: {str(e)}"},
-                    status=status.HTTP_500_INTERNAL_SERVER_ERROR
-                )
-
-            # Create response with server-decrypted data
-            try:
-                response = HttpResponse(
-                    content=decrypted_data,
-                    content_type='application/octet-stream'
-                )
-                
-                # Set required headers
-                response['Content-Disposition'] = f'attachment; filename="{smart_str(file_obj.original_name)}"'
-                response['Content-Length'] = len(decrypted_data)
-                response['X-Original-Content-Type'] = file_obj.content_type
-                
-                if file_obj.is_client_encrypted:
-                    response['X-Encryption-Key'] = str(file_obj.client_encryption_key)
-                    response['X-Encryption-IV'] = str(file_obj.client_encryption_iv)
-                
-                # Set CORS headers
-                response['Access-Control-Allow-Origin'] = '*'  # Allow any origin for public links
-                response['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
-                response['Access-Control-Expose-Headers'] = ', '.join([
-                    'Content-Disposition',
-                    'Content-Length',
-                    'Content-Type',
-                    'X-Encryption-Key',
-                    'X-Encryption-IV',
-                    'X-Original-Content-Type'
-                ])
-                
-                return response
-                
-            except Exception as e:
-                return Response(
-                    {"error": f"Failed to create response: {str(e)}"},
-                    status=status.HTTP_500_INTERNAL_SERVER_ERROR
-                )
+            return serve_link_download(request, link, file_obj)
             
         except Exception as e:
             return Response(
@@ -535,6 +820,270 @@ class ShareableLinkView(APIView):
                 status=status.HTTP_400_BAD_REQUEST
             ) 
 
+class SignedLinkView(APIView):
+    """Public downloads through signed links, checked without the database (see signedlinks.py)"""
+    permission_classes = []
+    # Public: no cookie lookup, the download is counted against the client's IP
+    authentication_classes = []
+
+    def get(self, request, token):
+        try:
+            link = signedlinks.verify(token)
+        except signedlinks.LinkExpired as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except signedlinks.InvalidLink as e:
+            return Response({"error": str(e)}, status=status.HTTP_404_NOT_FOUND)
+        try:
+            file_obj = signedlinks.files.get(link.file_id)
+        except File.DoesNotExist:
+            return Response({"error": "File not found"}, status=status.HTTP_404_NOT_FOUND)
+        return serve_link_download(
+            request, link, file_obj, reload_file=lambda: signedlinks.files.reload(link.file_id)
+        )
+
+class FileVersionView(APIView):
+    permission_classes = [IsAuthenticated]
+    parser_classes = [JSONParser, MultiPartParser, FormParser]
+
+    def get(self, request, file_id):
+        try:
+            file_obj = File.objects.get(id=file_id)
+        except File.DoesNotExist:
+            return Response({"error": "File not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        has_permission = (
+            request.user.role == 'ADMIN' or
+            file_obj.uploaded_by_id == request.user.id or
+            FileShare.objects.filter(file=file_obj, user=request.user).exists()
+        )
+        if not has_permission:
+            return Response(
+                {"error": "You don't have permission to access this file"},
+                status=status.HTTP_403_FORBIDDEN
+            )
+
+        rows = FileVersion.objects.filter(file=file_obj).annotate(
+            chunks=models.Count('entries')
+        ).order_by('-number').values('number', 'size', 'created_at', 'chunks')
+        return Response({
+            'current': file_obj.version,
+            'versions': [{**row, 'current': row['number'] == file_obj.version} for row in rows],
+        })
+
+    def post(self, request, file_id):
+        """Add a version, either as a whole upload or as a list of chunk digests"""
+        try:
+            file_obj = File.objects.select_related('uploaded_by').get(id=file_id)
+        except File.DoesNotExist:
+            return Response({"error": "File not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        if file_obj.uploaded_by_id != request.user.id:
+            return Response(
+                {"error": "Only the owner can upload new versions"},
+                status=status.HTTP_403_FORBIDDEN
+            )
+        if file_obj.is_client_encrypted:
+            return Response(
+                {"error": "Client-encrypted files can't be versioned"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        # Check the quota before the upload body is read
+        try:
+            quotas.check_request_size(request)
+        except quotas.QuotaExceeded as e:
+            return Response({'error': str(e)}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        track_progress(request)
+
+        base_version = request.data.get('base_version')
+        try:
+            base_version = None if base_version in (None, '') else int(base_version)
+        except (TypeError, ValueError):
+            return Response({"error": "base_version must be a number"}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            if 'file' in request.FILES:
+                digests = versions.store_stream(file_obj.uploaded_by_id, request.FILES['file'])
+            else:
+                digests = request.data.get('chunks')
+                if not isinstance(digests, list) or not all(versions.is_digest(digest) for digest in digests):
+                    return Response(
+                        {"error": "Send a file or chunks as a list of SHA-256 hex digests"},
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+            version = versions.commit_version(file_obj, digests, base_version)
+        except versions.MissingChunks as e:
+            return Response({"error": str(e), "missing": e.digests}, status=status.HTTP_400_BAD_REQUEST)
+        except versions.VersionConflict as e:
+            return Response({"error": str(e)}, status=status.HTTP_409_CONFLICT)
+        except quotas.QuotaExceeded as e:
+            return Response({'error': str(e)}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        except Exception as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({
+            'number': version.number,
+            'size': version.size,
+            'chunks': len(digests),
+        }, status=status.HTTP_201_CREATED)
+
+class FileVersionDownloadView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, file_id, number):
+        try:
+            file_obj = File.objects.get(id=file_id)
+            version = FileVersion.objects.get(file=file_obj, number=number)
+        except (File.DoesNotExist, FileVersion.DoesNotExist):
+            return Response({"error": "Version not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        has_permission = (
+            request.user.role == 'ADMIN' or
+            file_obj.uploaded_by_id == request.user.id or
+            FileShare.objects.filter(file=file_obj, user=request.user, permission='DOWNLOAD').exists()
+        )
+        if not has_permission:
+            return Response(
+                {"error": "You don't have permission to download this file"},
+                status=status.HTTP_403_FORBIDDEN
+            )
+
+        try:
+            transfer = start_transfer(request)
+        except TransferLimited as e:
+            return Response(
+                {"error": str(e)},
+                status=status.HTTP_429_TOO_MANY_REQUESTS,
+                headers={'Retry-After': str(e.retry_after)}
+            )
+
+        # The first chunk is read here so read errors still return a 500
+        try:
+            chunks = iter_version(file_obj.pk, number)
+            first_chunk = next(chunks, b'')
+        except Exception as e:
+            transfer.release()
+            return Response(
+                {"error": f"File read/decrypt failed: {str(e)}"},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+        response = StreamingHttpResponse(
+            audit.track(
+                transfer.throttle(itertools.chain([first_chunk], chunks)), request, file_obj,
+                expected_bytes=version.size
+            ),
+            content_type='application/octet-stream'
+        )
+        response['Content-Disposition'] = f'attachment; filename="{smart_str(file_obj.original_name)}"'
+        response['Content-Length'] = version.size
+        response['X-Original-Content-Type'] = file_obj.content_type
+        response['Access-Control-Allow-Origin'] = 'https://localhost:3000'
+        response['Access-Control-Allow-Credentials'] = 'true'
+        response['Access-Control-Expose-Headers'] = 'Content-Disposition, Content-Length, Content-Type, X-Original-Content-Type'
+        return response
+
+class MissingChunksView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        """Tell a client which chunks of a new version it still has to upload"""
+        digests = request.data.get('digests')
+        if not isinstance(digests, list) or not all(versions.is_digest(digest) for digest in digests):
+            return Response(
+                {"error": "digests must be a list of SHA-256 hex digests"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return Response({'missing': versions.missing_digests(request.user.id, digests)})
+
+class ChunkUploadView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def put(self, request, digest):
+        """Store one chunk, sent as the raw request body"""
+        if not versions.is_digest(digest):
+            return Response({"error": "Invalid chunk digest"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            quotas.check_request_size(request)
+        except quotas.QuotaExceeded as e:
+            return Response({'error': str(e)}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+        max_size = chunk_sizes()['max']
+        data = request.read(max_size + 1)
+        if len(data) > max_size:
+            return Response(
+                {"error": f"Chunks can be at most {max_size} bytes"},
+                status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+            )
+        if not data or versions.chunk_digest(data) != digest:
+            return Response({"error": "Chunk does not match its digest"}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            versions.store_pending_chunk(request.user, data, digest)
+        except quotas.QuotaExceeded as e:
+            return Response({'error': str(e)}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        except Exception as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'digest': digest, 'size': len(data)}, status=status.HTTP_201_CREATED)
+
+class StorageStatsView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        """Storage totals, the largest users and daily activity, read from the rollup tables"""
+        if request.user.role != 'ADMIN':
+            return Response(
+                {"error": "Only admins can view storage statistics"},
+                status=status.HTTP_403_FORBIDDEN
+            )
+        limit = parse_limit(request.query_params.get('limit'))
+        days = parse_limit(request.query_params.get('days'), default=30, maximum=366)
+        return Response({
+            'totals': stats.totals(),
+            'users': stats.top_users(limit),
+            'days': stats.daily(days),
+        })
+
+class AccessLogView(APIView):
+    permission_classes = [IsAuthenticated]
+    FILTERS = {'file': 'file_id', 'link': 'link_id'}
+
+    def get(self, request):
+        """Downloads newest first; admins see all of them, other users those of their own files"""
+        events = AccessEvent.objects.all()
+        if request.user.role != 'ADMIN':
+            events = events.filter(file_id__in=File.objects.filter(uploaded_by=request.user).values('pk'))
+
+        params = request.query_params
+        try:
+            for param, field in self.FILTERS.items():
+                if params.get(param):
+                    events = events.filter(**{field: uuid.UUID(params[param])})
+            if params.get('user'):
+                events = events.filter(user_id=int(params['user']))
+        except ValueError:
+            return Response(
+                {"error": "Invalid filter value"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if params.get('kind'):
+            events = events.filter(kind=params['kind'].upper())
+        for param, lookup in (('since', 'occurred_at__gte'), ('until', 'occurred_at__lt')):
+            if params.get(param):
+                moment = parse_datetime(params[param])
+                if moment is None:
+                    return Response(
+                        {"error": f"Invalid {param} timestamp"},
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+                events = events.filter(**{lookup: moment})
+
+        try:
+            rows, next_cursor = audit.page(events, params.get('cursor'), parse_limit(params.get('limit')))
+        except InvalidCursor as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'results': rows, 'next': next_cursor})
+
 @require_GET
 def favicon_view(request):
     file_path = os.path.join(settings.STATIC_ROOT, 'favicon.ico')
@@ -0,0 +1,98 @@
+"""Build ZIP archives on the fly without temp files or seeking."""
+import io
+import os
+import zipfile
+
+# Content types that are already compressed; deflating them wastes CPU
+COMPRESSED_CONTENT_TYPES = {
+    'application/gzip',
+    'application/x-7z-compressed',
+    'application/x-bzip2',
+    'application/x-rar-compressed',
+    'application/x-xz',
+    'application/zip',
+    'application/pdf',
+}
+COMPRESSED_PREFIXES = ('image/', 'video/', 'audio/')
+
+
+def is_compressed(content_type):
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    return content_type in COMPRESSED_CONTENT_TYPES or content_type.startswith(COMPRESSED_PREFIXES)
+
+
+class _StreamSink(io.RawIOBase):
+    """Write-only, unseekable sink that hands written bytes back to the caller.
+
+    zipfile notices the stream can't seek and writes data descriptors after
+    each member instead of going back to patch the local headers.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._buffer = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b''.join(self._buffer)
+        self._buffer.clear()
+        return data
+
+
+class ZipMember:
+    def __init__(self, name, size, chunks, date_time, store_only=False):
+        self.name = name
+        self.size = size
+        self.chunks = chunks
+        self.date_time = date_time
+        self.store_only = store_only
+
+
+def unique_names(names):
+    """Make archive names unique by adding ' (n)' before the extension"""
+    seen = set()
+    for name in names:
+        candidate = name
+        counter = 1
+        while candidate in seen:
+            root, ext = os.path.splitext(name)
+            candidate = f'{root} ({counter}){ext}'
+            counter += 1
+        seen.add(candidate)
+        yield candidate
+
+
+def stream_zip(members):
+    """Yield a ZIP archive of members, at most about one chunk buffered at a time.
+
+    Each member's `chunks` is only iterated when the archive reaches it, so
+    members can be decrypted lazily.
+    """
+    sink = _StreamSink()
+    with zipfile.ZipFile(sink, 'w', allowZip64=True) as archive:
+        for member in members:
+            info = zipfile.ZipInfo(member.name, date_time=member.date_time)
+            info.compress_type = zipfile.ZIP_STORED if member.store_only else zipfile.ZIP_DEFLATED
+            # A known size lets zipfile decide on ZIP64 headers up front
+            info.file_size = member.size
+            with archive.open(info, 'w') as dest:
+                for chunk in member.chunks():
+                    dest.write(chunk)
+                    data = sink.drain()
+                    if data:
+                        yield data
+            data = sink.drain()
+            if data:
+                yield data
+    yield sink.drain()
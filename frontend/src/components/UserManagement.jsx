@@ -5,6 +5,9 @@ import './UserManagement.css';
 
 const UserManagement = () => {
   const [users, setUsers] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [search, setSearch] = useState('');
+  const [roleFilter, setRoleFilter] = useState('');
   const [showEditModal, setShowEditModal] = useState(false);
   const [selectedUser, setSelectedUser] = useState(null);
   const [selectedRole, setSelectedRole] = useState('');
@@ -12,12 +15,18 @@ const UserManagement = () => {
 
   useEffect(() => {
     fetchUsers();
-  }, []);
+    // eslint-disable-next-line react-hooks/exhaustive-deps
+  }, [search, roleFilter]);
 
-  const fetchUsers = async () => {
+  const fetchUsers = async (cursor = null) => {
     try {
-      const data = await getUsers();
-      setUsers(data);
+      const params = {};
+      if (search) params.q = search;
+      if (roleFilter) params.role = roleFilter;
+      if (cursor) params.cursor = cursor;
+      const data = await getUsers(params);
+      setUsers(cursor ? [...users, ...data.results] : data.results);
+      setNextCursor(data.next);
     } catch (error) {
       setError('Failed to fetch users');
     }
@@ -48,6 +57,21 @@ const UserManagement = () => {
     <div className="container-fluid mt-4">
       <h2 className="user-management-title">User Management</h2>
       {error && <div className="alert alert-danger">{error}</div>}
+
+      <div className="d-flex gap-2 mb-3">
+        <Form.Control
+          type="search"
+          placeholder="Search by email"
+          value={search}
+          onChange={(e) => setSearch(e.target.value)}
+        />
+        <Form.Select value={roleFilter} onChange={(e) => setRoleFilter(e.target.value)}>
+          <option value="">All roles</option>
+          <option value="ADMIN">Admin</option>
+          <option value="USER">User</option>
+          <option value="GUEST">Guest</option>
+        </Form.Select>
+      </div>
       
       <Table hover className="user-table">
         <thead>
@@ -76,6 +100,12 @@ const UserManagement = () => {
         </tbody>
       </Table>
 
+      {nextCursor && (
+        <Button variant="outline-dark" onClick={() => fetchUsers(nextCursor)}>
+          Load more
+        </Button>
+      )}
+
       <Modal show={showEditModal} onHide={() => setShowEditModal(false)}>
         <Modal.Header closeButton>
           <Modal.Title>Edit User Role</Modal.Title>
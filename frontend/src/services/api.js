@@ -92,8 +92,8 @@ export const checkAuth = async () => {
   }
 };
 
-export const getUsers = async () => {
-  const response = await api.get('/accounts/users/');
+export const getUsers = async (params = {}) => {
+  const response = await api.get('/accounts/users/', { params });
   return response.data;
 };
 